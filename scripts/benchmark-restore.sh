@@ -0,0 +1,41 @@
+#!/usr/bin/env bash
+
+# measure write speed of --restore_partition, with and without --pre_erase
+#   run from the root of the repo, with the device in USB Burn Mode
+#   usage: scripts/benchmark-restore.sh PARTITION_NAME INPUT_FILE
+#   this overwrites the partition with INPUT_FILE, so use a dump of the same partition
+#   for erase-group aligned writes, first boot the device with adb and run: superbird_tool.py --emmc_geometry
+
+if [ "$(uname -s)" == "Darwin" ] || [ "$(uname -s)" == "Linux" ]; then
+    PYTHON_CMD="python3"
+else
+    # assume Windows
+    PYTHON_CMD="python"
+fi
+
+if [ "$#" -ne 2 ]; then
+    echo "usage: $0 PARTITION_NAME INPUT_FILE"
+    exit 1
+fi
+
+PART_NAME="$1"
+INPUT_FILE="$2"
+
+set -e  # bail on any errors
+
+function benchmark() {
+    # restore the partition with the given extra flags, then print MB/s from its metrics event
+    $PYTHON_CMD superbird_tool.py --progress json "$@" --restore_partition "$PART_NAME" "$INPUT_FILE" \
+        | $PYTHON_CMD -c '
+import sys, json
+for line in sys.stdin:
+    event = json.loads(line)
+    if event.get("event") == "metrics" and event.get("name") == "restore_partition":
+        speed = event["bytes_per_second"] / 1024 / 1024
+        print("%7.2fMB/s  %s  chunk %dKB  erase group %dKB  erased %dMB in %.2fs  %s" % (speed, event["part_name"], event["chunk_size"] // 1024, event["erase_size"] // 1024, event["erased"] // 1024 // 1024, event["erase_seconds"], sys.argv[1]))
+' "$*"
+}
+
+echo "Write speed of $PART_NAME from $INPUT_FILE:"
+benchmark
+benchmark --pre_erase
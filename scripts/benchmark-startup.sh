@@ -0,0 +1,43 @@
+#!/usr/bin/env bash
+
+# measure startup time of superbird_tool, using commands which do not need a device
+#   run from the root of the repo, after make-binary.sh if you want to include the standalone binary
+#   RUNS sets how many times each command is run (default 20)
+
+if [ "$(uname -s)" == "Darwin" ] || [ "$(uname -s)" == "Linux" ]; then
+    PYTHON_CMD="python3"
+    BINARY_FILE="superbird_tool.bin"
+else
+    # assume Windows
+    PYTHON_CMD="python"
+    BINARY_FILE="superbird_tool.exe"
+fi
+
+RUNS="${RUNS:-20}"
+TEMP_DIR="$(mktemp -d)"
+TIMEFORMAT="%R"
+
+set -e  # bail on any errors
+
+function benchmark() {
+    # run a command RUNS times, then print the average time per run
+    local TOTAL
+    TOTAL=$( { time (for _ in $(seq "$RUNS"); do "$@" > /dev/null 2>&1; done) ; } 2>&1 )
+    echo "$(echo "$TOTAL $RUNS" | awk '{printf "%7.1f", $1 * 1000 / $2}')ms  $*"
+}
+
+echo "Average startup time over $RUNS runs:"
+benchmark $PYTHON_CMD -c "pass"
+benchmark $PYTHON_CMD superbird_tool.py --help
+benchmark $PYTHON_CMD superbird_tool.py --convert_env_txt stock_env.txt "$TEMP_DIR/env.dump"
+benchmark $PYTHON_CMD superbird_tool.py --diff_env stock_env.txt stock_env.txt
+if [ -x "$BINARY_FILE" ]; then
+    benchmark "./$BINARY_FILE" --help
+    benchmark "./$BINARY_FILE" --diff_env stock_env.txt stock_env.txt
+fi
+
+echo ""
+echo "Slowest imports for --help:"
+$PYTHON_CMD -X importtime superbird_tool.py --help 2>&1 > /dev/null | sort -t '|' -k 2 -n | tail -n 10
+
+rm -r "$TEMP_DIR"
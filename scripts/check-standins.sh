@@ -0,0 +1,88 @@
+#!/usr/bin/env bash
+
+# round-trip dumps through the stand-ins, which play the device end of a transfer without hardware
+#   run from the root of the repo, no device needed
+#   each check writes a dump (plain and gzipped) through a stand-in, and compares what ended up on the "device" with it
+
+if [ "$(uname -s)" == "Darwin" ] || [ "$(uname -s)" == "Linux" ]; then
+    PYTHON_CMD="python3"
+else
+    # assume Windows
+    PYTHON_CMD="python"
+fi
+
+TEMP_DIR="$(mktemp -d)"
+
+set -e  # bail on any errors
+
+echo "FastbootStandIn (--fastboot):"
+$PYTHON_CMD - "$TEMP_DIR" <<'EOF'
+import os
+import sys
+import gzip
+
+from superbird_partitions import SUPERBIRD_PARTITIONS, SECTOR_SIZE
+from superbird_fastboot import FastbootStandIn, FastbootDevice
+
+temp_dir = sys.argv[1]
+part_size = SUPERBIRD_PARTITIONS['boot_a']['size'] * SECTOR_SIZE
+# zeros in the middle are sent as a fill, and the file does not end on a sparse block
+dump = bytearray(os.urandom(part_size - 5000))
+dump[4 * 1024 * 1024:12 * 1024 * 1024] = bytes(8 * 1024 * 1024)
+with open(os.path.join(temp_dir, 'boot_a.dump'), 'wb') as dmf:
+    dmf.write(dump)
+with gzip.open(os.path.join(temp_dir, 'boot_a.dump.gz'), 'wb') as dmf:
+    dmf.write(dump)
+failed = False
+for name in ['boot_a.dump', 'boot_a.dump.gz']:
+    partitions = {'boot_a': bytearray(b'\xaa' * part_size)}
+    # a small download buffer, so the partition goes in several pieces
+    fastboot = FastbootDevice(FastbootStandIn(partitions, max_download_size=8 * 1024 * 1024), log=lambda message: None)
+    fastboot.flash_file('boot_a', os.path.join(temp_dir, name), part_size)
+    matches = partitions['boot_a'][:len(dump)] == dump
+    print(f'  {"ok" if matches else "FAILED":<6}  restore {name}')
+    failed = failed or not matches
+sys.exit(1 if failed else 0)
+EOF
+
+echo "LoopbackDeviceEnd (--usbnet):"
+$PYTHON_CMD - "$TEMP_DIR" <<'EOF'
+import io
+import os
+import sys
+import gzip
+import contextlib
+
+from superbird_partitions import SUPERBIRD_PARTITIONS, SECTOR_SIZE
+from superbird_net import LoopbackDeviceEnd, net_dump_partition, net_restore_partition, partition_range
+
+temp_dir = sys.argv[1]
+# the disk only needs to reach the end of boot_b, nothing after it is touched
+disk = bytearray((SUPERBIRD_PARTITIONS['boot_b']['offset'] + SUPERBIRD_PARTITIONS['boot_b']['size']) * SECTOR_SIZE)
+bootloader_size = SUPERBIRD_PARTITIONS['bootloader']['size'] * SECTOR_SIZE
+disk[:SECTOR_SIZE + bootloader_size] = os.urandom(SECTOR_SIZE + bootloader_size)
+(_offset, length) = partition_range('boot_a', len(disk))
+dump = os.urandom(length - 5000)
+with open(os.path.join(temp_dir, 'boot.dump'), 'wb') as dmf:
+    dmf.write(dump)
+with gzip.open(os.path.join(temp_dir, 'boot.dump.gz'), 'wb') as dmf:
+    dmf.write(dump)
+device_end = LoopbackDeviceEnd(disk)
+results = []
+with contextlib.redirect_stdout(io.StringIO()):
+    # bootloader dumps start one sector into the partition, same as in USB Burn Mode
+    net_dump_partition(device_end, 'bootloader', os.path.join(temp_dir, 'bootloader.dump'))
+    with open(os.path.join(temp_dir, 'bootloader.dump'), 'rb') as dmf:
+        results.append(('dump bootloader, from +512', dmf.read() == disk[SECTOR_SIZE:SECTOR_SIZE + bootloader_size]))
+    for (part_name, name) in [('boot_a', 'boot.dump'), ('boot_b', 'boot.dump.gz')]:
+        net_restore_partition(device_end, part_name, os.path.join(temp_dir, name))
+        net_dump_partition(device_end, part_name, os.path.join(temp_dir, f'{part_name}.dump'))
+        with open(os.path.join(temp_dir, f'{part_name}.dump'), 'rb') as dmf:
+            results.append((f'restore {name} to {part_name}, then dump it', dmf.read(len(dump)) == dump))
+for (check, matches) in results:
+    print(f'  {"ok" if matches else "FAILED":<6}  {check}')
+sys.exit(0 if all(matches for (_check, matches) in results) else 1)
+EOF
+
+rm -r "$TEMP_DIR"
+echo "all stand-ins round-trip"
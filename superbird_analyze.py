@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Analyze a folder of partition dumps, without needing the device
+
+For each dump file: find zero extents, hash every chunk, detect ext2/3/4 filesystems and how much of them is used,
+and check the env crc. Results are merged into the manifest sidecar of the folder.
+Files are memory-mapped, zero scans use NumPy if it is installed, and chunk hashing is spread across a process pool.
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import mmap
+import struct
+import hashlib
+import binascii
+
+from concurrent.futures import ProcessPoolExecutor
+
+from uboot_env import ENV_SIZE, parse_environ
+from superbird_partitions import DUMP_FILE_NAMES, dump_file_path
+from superbird_manifest import MANIFEST_CHUNK_SIZE, update_manifest
+from superbird_writer import open_dump, decompressed
+
+try:
+    import numpy
+except ImportError:
+    # optional, zero scans just use plain bytes comparisons without it
+    numpy = None
+
+ZERO_BLOCK_SIZE = 64 * 1024  # granularity of zero extents
+HASH_BATCH = 64  # chunks hashed per process pool task
+
+EXT_SUPERBLOCK_OFFSET = 1024
+EXT_MAGIC = 0xEF53
+EXT_COMPAT_HAS_JOURNAL = 0x4
+EXT_INCOMPAT_EXTENTS = 0x40
+EXT_INCOMPAT_64BIT = 0x80
+EXT_INCOMPAT_FLEX_BG = 0x200
+
+
+def zero_block_map(data) -> list:
+    """ for each ZERO_BLOCK_SIZE block of data (the last one may be shorter), True if it is all zeros """
+    length = len(data)
+    full_blocks = length // ZERO_BLOCK_SIZE
+    blocks = []
+    if numpy is not None and full_blocks:
+        words = numpy.frombuffer(data, dtype=numpy.uint64, count=full_blocks * ZERO_BLOCK_SIZE // 8)
+        nonzero = words.reshape(full_blocks, ZERO_BLOCK_SIZE // 8).any(axis=1)
+        blocks = [not value for value in nonzero.tolist()]
+        del words, nonzero  # release our view of the buffer, so that it can be closed
+    else:
+        zero_block = bytes(ZERO_BLOCK_SIZE)
+        for index in range(full_blocks):
+            start = index * ZERO_BLOCK_SIZE
+            blocks.append(data[start:start + ZERO_BLOCK_SIZE] == zero_block)
+    tail = data[full_blocks * ZERO_BLOCK_SIZE:]
+    if tail:
+        blocks.append(tail.count(0) == len(tail))
+    return blocks
+
+
+def zero_extents(data) -> list:
+    """ find runs of zeros in data, at ZERO_BLOCK_SIZE granularity
+        returns a list of [offset, length]
+    """
+    extents = []
+    for index, is_zero in enumerate(zero_block_map(data)):
+        if not is_zero:
+            continue
+        offset = index * ZERO_BLOCK_SIZE
+        length = min(ZERO_BLOCK_SIZE, len(data) - offset)
+        if extents and extents[-1][0] + extents[-1][1] == offset:
+            extents[-1][1] += length
+        else:
+            extents.append([offset, length])
+    return extents
+
+
+def hash_chunks(path:str, first_chunk:int, count:int, chunk_size:int=MANIFEST_CHUNK_SIZE) -> list:
+    """ hash count chunks of a file, starting at first_chunk
+        returns a list of (crc32, sha256) as hex strings
+        runs in a process pool worker, so it opens the file itself
+    """
+    results = []
+    with open(path, 'rb') as dmf:
+        with mmap.mmap(dmf.fileno(), 0, access=mmap.ACCESS_READ) as dmm:
+            for index in range(first_chunk, first_chunk + count):
+                chunk = dmm[index * chunk_size:(index + 1) * chunk_size]
+                results.append((f'{binascii.crc32(chunk):08x}', hashlib.sha256(chunk).hexdigest()))
+    return results
+
+
+def detect_filesystem(data) -> dict:
+    """ detect an ext2/3/4 filesystem from its superblock, and how much of it is used
+        returns None if there is no ext superblock
+    """
+    superblock = data[EXT_SUPERBLOCK_OFFSET:EXT_SUPERBLOCK_OFFSET + 1024]
+    if len(superblock) < 1024:
+        return None
+    (magic,) = struct.unpack_from('<H', superblock, 0x38)
+    if magic != EXT_MAGIC:
+        return None
+    (blocks_lo, _r_blocks_lo, free_blocks_lo) = struct.unpack_from('<III', superblock, 0x04)
+    (log_block_size,) = struct.unpack_from('<I', superblock, 0x18)
+    (compat, incompat, _ro_compat) = struct.unpack_from('<III', superblock, 0x5C)
+    (volume_name,) = struct.unpack_from('16s', superblock, 0x78)
+    blocks = blocks_lo
+    free_blocks = free_blocks_lo
+    if incompat & EXT_INCOMPAT_64BIT:
+        (blocks_hi, _r_blocks_hi, free_blocks_hi) = struct.unpack_from('<III', superblock, 0x150)
+        blocks |= blocks_hi << 32
+        free_blocks |= free_blocks_hi << 32
+    if incompat & (EXT_INCOMPAT_EXTENTS | EXT_INCOMPAT_64BIT | EXT_INCOMPAT_FLEX_BG):
+        fs_type = 'ext4'
+    elif compat & EXT_COMPAT_HAS_JOURNAL:
+        fs_type = 'ext3'
+    else:
+        fs_type = 'ext2'
+    block_size = 1024 << log_block_size
+    return {
+        'type': fs_type,
+        'label': volume_name.rstrip(b'\x00').decode('utf-8', errors='replace'),
+        'block_size': block_size,
+        'size': blocks * block_size,
+        'used': (blocks - free_blocks) * block_size,
+    }
+
+
+def check_env(data) -> dict:
+    """ parse an env dump and check its crc """
+    (environ, _length, crc_ok) = parse_environ(bytes(data[:ENV_SIZE]))
+    return {
+        'crc_ok': crc_ok,
+        'variables': len(environ),
+    }
+
+
+def analyze_file(path:str, part_name:str=None, executor:ProcessPoolExecutor=None) -> dict:
+    """ analyze a single dump file, returns a dict suitable for a manifest entry
+            a gzipped dump is decompressed to a temporary file first, so it can be memory-mapped like any other
+    """
+    if path.endswith('.gz'):
+        with decompressed(path) as plain_path:
+            return analyze_file(plain_path, part_name, executor)
+    size = os.path.getsize(path)
+    result = {
+        'size': size,
+        'partition': part_name,
+        'chunk_size': MANIFEST_CHUNK_SIZE,
+    }
+    if size == 0:
+        result.update({'empty': True, 'zero_bytes': 0, 'zero_extents': [], 'chunk_crc32': [], 'chunk_sha256': [], 'filesystem': None})
+        return result
+    # hashing happens in the pool while we scan for zeros here
+    chunk_count = (size + MANIFEST_CHUNK_SIZE - 1) // MANIFEST_CHUNK_SIZE
+    batches = []
+    for first_chunk in range(0, chunk_count, HASH_BATCH):
+        count = min(HASH_BATCH, chunk_count - first_chunk)
+        if executor is not None:
+            batches.append(executor.submit(hash_chunks, path, first_chunk, count))
+        else:
+            batches.append(hash_chunks(path, first_chunk, count))
+    with open(path, 'rb') as dmf:
+        with mmap.mmap(dmf.fileno(), 0, access=mmap.ACCESS_READ) as dmm:
+            extents = zero_extents(dmm)
+            zero_bytes = sum(length for (_offset, length) in extents)
+            result.update({
+                'empty': zero_bytes == size,
+                'zero_bytes': zero_bytes,
+                'zero_extents': extents,
+                'filesystem': detect_filesystem(dmm),
+            })
+            if part_name == 'env':
+                result['env'] = check_env(dmm)
+    hashes = []
+    for batch in batches:
+        hashes.extend(batch.result() if executor is not None else batch)
+    result['chunk_crc32'] = [crc for (crc, _sha) in hashes]
+    result['chunk_sha256'] = [sha for (_crc, sha) in hashes]
+    return result
+
+
+def file_is_empty(path:str) -> bool:
+    """ test if a dump file is all zeros (like a wiped filesystem) """
+    if path.endswith('.gz'):
+        with open_dump(path) as dmf:
+            while True:
+                data = dmf.read(16 * ZERO_BLOCK_SIZE)
+                if not data:
+                    return True
+                if data.count(0) != len(data):
+                    return False
+    with open(path, 'rb') as dmf:
+        if os.path.getsize(path) == 0:
+            return True
+        with mmap.mmap(dmf.fileno(), 0, access=mmap.ACCESS_READ) as dmm:
+            return all(zero_block_map(dmm))
+
+
+def analyze_folder(folder:str, workers:int=None) -> dict:
+    """ analyze every known dump file in a folder, and merge the results into its manifest
+        returns the results, keyed by file name
+    """
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for part_name in DUMP_FILE_NAMES:
+            path = dump_file_path(folder, part_name)
+            if not os.path.isfile(path):
+                continue
+            print(f'Analyzing {path}')
+            results[os.path.basename(path)] = analyze_file(path, part_name, executor)
+    update_manifest(folder, results)
+    return results
+
+
+def print_analysis(results:dict):
+    """ print a summary of analyze_folder results """
+    print(f'{"file":<18} {"size":>9} {"zeros":>9}  details')
+    for file_name, result in results.items():
+        details = []
+        if result['empty']:
+            details.append('empty')
+        if result['filesystem'] is not None:
+            fsinfo = result['filesystem']
+            details.append(f'{fsinfo["type"]} "{fsinfo["label"]}" used {round(fsinfo["used"] / 1024 / 1024)}MB / {round(fsinfo["size"] / 1024 / 1024)}MB')
+        if 'env' in result:
+            details.append(f'env: {result["env"]["variables"]} variables, crc {"OK" if result["env"]["crc_ok"] else "BAD"}')
+        print(f'{file_name:<18} {round(result["size"] / 1024 / 1024):>7}MB {round(result["zero_bytes"] / 1024 / 1024):>7}MB  {", ".join(details)}')
@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+asyncio wrapper around SuperbirdDevice, for driving many devices from one process
+
+Each AsyncSuperbird owns one worker thread, and everything for that device runs there, one call at a time,
+so USB I/O never blocks the event loop, and calls for the same device never overlap.
+Errors are raised as SuperbirdError subclasses (see superbird_errors), the log, progress and metrics callbacks are called on the event loop,
+and cancelling the awaiting task (or calling cancel()) stops the operation at its next chunk, with OperationCancelled.
+
+    async def dump_env(usb_device):
+        async with await AsyncSuperbird.open(usb_device, progress=show_progress) as bird:
+            await bird.dump_partition('env', 'env.dump')
+
+    await asyncio.gather(*[dump_env(usb_device) for (usb_device, mode) in await list_devices() if mode in ['usb', 'usb-burn']])
+"""
+# pylint: disable=line-too-long,broad-except
+
+import asyncio
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+
+async def list_devices():
+    """ every superbird device connected, see superbird_device.find_devices """
+    from superbird_device import find_devices
+    return await asyncio.get_running_loop().run_in_executor(None, find_devices)
+
+
+def on_loop(loop, callback):
+    """ wrap a callback so it gets called on the event loop, instead of the worker thread """
+    if callback is None:
+        return None
+    def call_soon(*args):
+        loop.call_soon_threadsafe(callback, *args)
+    return call_soon
+
+
+class AsyncSuperbird:
+    """ one device, driven from asyncio
+            use open() rather than creating this directly
+    """
+    def __init__(self, dev, executor:ThreadPoolExecutor):
+        self.dev = dev
+        self.executor = executor
+        # cancel event of the call holding the worker thread, each call gets its own, see run
+        self.running_cancel = None
+
+    @classmethod
+    async def open(cls, usb_device=None, burn_mode:bool=True, log=None, progress=None, metrics=None, **options):
+        """ connect to a device, and enter USB Burn Mode unless burn_mode is False
+                usb_device is a pyusb device from list_devices, otherwise the first device found is used
+                log, progress and metrics are the same as for SuperbirdDevice, other options are passed to it as-is
+        """
+        loop = asyncio.get_running_loop()
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='superbird')
+        def connect():
+            from superbird_device import SuperbirdDevice, ensure_burn_mode
+            dev = SuperbirdDevice(usb_device=usb_device, log=on_loop(loop, log), progress=on_loop(loop, progress), metrics=on_loop(loop, metrics), **options)
+            if burn_mode:
+                dev = ensure_burn_mode(dev)
+            return dev
+        try:
+            dev = await loop.run_in_executor(executor, connect)
+        except BaseException:
+            executor.shutdown(wait=False)
+            raise
+        return cls(dev, executor)
+
+    async def run(self, func, *args, **kwargs):
+        """ run func(*args, **kwargs) on this device's worker thread
+                if the awaiting task is cancelled, the operation is cancelled too
+                each call has its own cancel event, handed to the device only once the call holds the worker,
+                so cancelling a call still waiting in the queue never stops the one running ahead of it
+        """
+        cancel_event = threading.Event()
+        def work():
+            self.dev.cancel = cancel_event
+            self.running_cancel = cancel_event
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.running_cancel = None
+        future = asyncio.get_running_loop().run_in_executor(self.executor, work)
+        try:
+            return await future
+        except asyncio.CancelledError:
+            # if it has not started yet, the executor drops it, and this only marks its own event
+            cancel_event.set()
+            raise
+
+    async def call(self, method:str, *args, **kwargs):
+        """ call any SuperbirdDevice method on the worker thread """
+        return await self.run(lambda: getattr(self.dev, method)(*args, **kwargs))
+
+    def cancel(self):
+        """ stop the running operation at its next chunk, it raises OperationCancelled
+                calls still waiting for the worker thread are not affected
+        """
+        running_cancel = self.running_cancel
+        if running_cancel is not None:
+            running_cancel.set()
+
+    async def enter_burn_mode(self):
+        """ enter USB Burn Mode, if open() was told not to """
+        from superbird_device import ensure_burn_mode
+        self.dev = await self.run(lambda: ensure_burn_mode(self.dev))
+
+    async def bulkcmd(self, command:str, **kwargs):
+        """ see SuperbirdDevice.bulkcmd """
+        return await self.call('bulkcmd', command, **kwargs)
+
+    async def dump_partition(self, part_name:str, outfile:str, **kwargs):
+        """ see SuperbirdDevice.dump_partition """
+        return await self.call('dump_partition', part_name, outfile, **kwargs)
+
+    async def restore_partition(self, part_name:str, infile:str, **kwargs):
+        """ see SuperbirdDevice.restore_partition """
+        return await self.call('restore_partition', part_name, infile, **kwargs)
+
+    async def dump_range(self, part_name:str, offset:int, length:int, outfile:str):
+        """ see SuperbirdDevice.dump_range """
+        return await self.call('dump_range', part_name, offset, length, outfile)
+
+    async def restore_range(self, part_name:str, offset:int, infile:str):
+        """ see SuperbirdDevice.restore_range """
+        return await self.call('restore_range', part_name, offset, infile)
+
+    async def dump_image(self, outfile:str):
+        """ see SuperbirdDevice.dump_image """
+        return await self.call('dump_image', outfile)
+
+    async def restore_image(self, infile:str, skip_partitions:list=None):
+        """ see SuperbirdDevice.restore_image """
+        return await self.call('restore_image', infile, skip_partitions)
+
+    async def read_env(self):
+        """ see SuperbirdDevice.read_env """
+        await self.call('bulkcmd', 'amlmmc env', silent=True)
+        return await self.call('read_env')
+
+    async def sync_env(self, environ:dict, full:bool=False):
+        """ see SuperbirdDevice.sync_env """
+        return await self.call('sync_env', environ, full=full)
+
+    async def close(self):
+        """ wait for the running call to finish, and stop the worker thread """
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_exc_info):
+        await self.close()
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Flash bundles: a dump folder compiled once into a form that can be flashed to many devices with no preprocessing
+
+A bundle is a folder holding:
+    bundle.json: partitions in the order they get written, each split into chunks of BUNDLE_CHUNK_SIZE, with crc32 of each chunk
+    chunks.bin: data of every chunk which is not just one byte repeated (identical chunks are stored once), each aligned to BUNDLE_ALIGN
+    env.bin: binary env image, written straight to the env partition
+Chunks which are one byte repeated (usually zeros) are filled on the device using mw.b, so nothing is uploaded for them.
+Before each chunk is written to mmc, the device calculates crc32 of it in memory, and it must match the bundle.
+chunks.bin is memory-mapped read-only, so any number of flashing processes share it through the page cache.
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import json
+import mmap
+import time
+import hashlib
+import binascii
+
+from superbird_partitions import SUPERBIRD_PARTITIONS, SECTOR_SIZE
+from superbird_writer import open_dump, dump_size
+from superbird_errors import PartitionError
+from uboot_env import ENV_SIZE, build_environ
+
+BUNDLE_VERSION = 1
+BUNDLE_INFO = 'bundle.json'
+BUNDLE_DATA = 'chunks.bin'
+BUNDLE_ENV = 'env.bin'
+BUNDLE_CHUNK_SIZE = 8 * 1024 * 1024  # 8MB, same as SuperbirdDevice.STAGING_CHUNK_SIZE
+BUNDLE_ALIGN = 32 * 1024  # data chunks start and end on this boundary, a multiple of every TRANSFER_BLOCK_SIZE, so they can be uploaded without copying
+BOOTLOADER_SIZE = 2 * 1024 * 1024  # bootloader is only 2MB, but dumps are often zero-padded to 4MB
+
+
+def fill_value(chunk):
+    """ if chunk is one byte value repeated, return that value, otherwise None """
+    if chunk and chunk.count(chunk[:1]) == len(chunk):
+        return chunk[0]
+    return None
+
+
+def fill_crc32(value:int, length:int) -> int:
+    """ crc32 of length bytes of value, without building it all at once """
+    block = bytes([value]) * min(length, 1024 * 1024)
+    crc = 0
+    while length > 0:
+        count = min(length, len(block))
+        crc = binascii.crc32(block[:count], crc)
+        length -= count
+    return crc
+
+
+def build_bundle(bundle:str, restore_list:list, environ:dict, source:str=''):
+    """ compile dump files into a bundle folder
+            restore_list is a list of (part_name, file) in the order they should be written, bootloader should be last, files can be gzipped
+            environ is the env to write
+    """
+    os.makedirs(bundle, exist_ok=True)
+    partitions = []
+    stored = {}  # sha256 of chunk data -> position within chunks.bin
+    start_time = time.monotonic()
+    with open(os.path.join(bundle, BUNDLE_DATA), 'wb') as dfl:
+        for (part_name, infile) in restore_list:
+            part = SUPERBIRD_PARTITIONS[part_name]
+            file_size = dump_size(infile)
+            if part_name == 'bootloader':
+                file_size = min(file_size, BOOTLOADER_SIZE)
+            elif file_size > max(part['size'], part.get('size_alt', 0)) * SECTOR_SIZE:
+                raise PartitionError(f'File is larger than target partition: {infile} vs {part_name}')
+            print(f'bundling partition: "{part_name}" from file: {infile}')
+            chunks = []
+            with open_dump(infile) as ifl:
+                offset = 0
+                while offset < file_size:
+                    chunk = ifl.read(min(BUNDLE_CHUNK_SIZE, file_size - offset))
+                    entry = {'offset': offset, 'length': len(chunk), 'crc32': binascii.crc32(chunk)}
+                    value = fill_value(chunk)
+                    if value is not None and part_name != 'bootloader':
+                        entry['fill'] = value
+                    else:
+                        digest = hashlib.sha256(chunk).digest()
+                        if digest not in stored:
+                            stored[digest] = dfl.tell()
+                            dfl.write(chunk)
+                            dfl.write(bytes(-len(chunk) % BUNDLE_ALIGN))
+                        entry['data'] = stored[digest]
+                    chunks.append(entry)
+                    offset += len(chunk)
+            partitions.append({'name': part_name, 'file': os.path.basename(infile), 'size': file_size, 'chunks': chunks})
+        data_size = dfl.tell()
+    (env_image, _used) = build_environ(environ)
+    with open(os.path.join(bundle, BUNDLE_ENV), 'wb') as efl:
+        efl.write(env_image)
+    info = {
+        'version': BUNDLE_VERSION,
+        'source': source,
+        'chunk_size': BUNDLE_CHUNK_SIZE,
+        'align': BUNDLE_ALIGN,
+        'env': {'file': BUNDLE_ENV, 'crc32': binascii.crc32(env_image)},
+        'partitions': partitions,
+    }
+    with open(os.path.join(bundle, BUNDLE_INFO), 'w', encoding='utf-8') as ifl:
+        json.dump(info, ifl, indent=1)
+    total = sum(part['size'] for part in partitions)
+    print(f'bundle {bundle}: {len(partitions)} partitions, {round(total / 1024 / 1024)}MB of which {round(data_size / 1024 / 1024)}MB stored, in {round(time.monotonic() - start_time, 2)}s')
+    return info
+
+
+def load_bundle(bundle:str):
+    """ read and check bundle.json, returns it as a dict """
+    with open(os.path.join(bundle, BUNDLE_INFO), 'r', encoding='utf-8') as ifl:
+        info = json.load(ifl)
+    if info.get('version') != BUNDLE_VERSION:
+        raise ValueError(f'Unsupported bundle version: {info.get("version")}, rebuild it with --build_bundle')
+    return info
+
+
+def chunk_pieces(chunk:dict, max_length:int):
+    """ split a chunk into pieces of at most max_length, for when the device cannot stage a whole chunk
+        returns a list of (offset within chunk, length, crc32)
+    """
+    if chunk['length'] <= max_length:
+        return [(0, chunk['length'], chunk['crc32'])]
+    pieces = []
+    for start in range(0, chunk['length'], max_length):
+        length = min(max_length, chunk['length'] - start)
+        pieces.append((start, length, None))
+    return pieces
+
+
+def flash_bundle(dev, bundle:str):
+    """ flash a bundle to a device in USB Burn Mode
+            env is written first, bootloader (if in the bundle) last, same as --restore_device
+    """
+    info = load_bundle(bundle)
+    dev.ensure_staging()
+    dev.bulkcmd('amlmmc part 1', silent=True)
+    for part in info['partitions']:
+        if 'size_alt' in SUPERBIRD_PARTITIONS[part['name']]:
+            (part_size, _part_offset) = dev.validate_partition_size(part['name'])
+            if part_size is None:
+                raise PartitionError('Failed to validate partition size!')
+            if part['size'] > part_size:
+                raise PartitionError(f'Bundle is larger than target partition: {part["name"]} {part["size"]} vs {part_size}')
+    with open(os.path.join(bundle, info['env']['file']), 'rb') as efl:
+        env_image = efl.read()
+    if len(env_image) != ENV_SIZE or binascii.crc32(env_image) != info['env']['crc32']:
+        raise ValueError(f'Bundle env does not match {BUNDLE_INFO}, rebuild it with --build_bundle')
+    dev.print('writing env')
+    dev.write_env_image(env_image, ENV_SIZE)
+    dev.catalog_forget([part['name'] for part in info['partitions']])
+    total = sum(part['size'] for part in info['partitions'])
+    done = 0
+    uploaded = 0
+    start_time = time.monotonic()
+    data_file = os.path.join(bundle, BUNDLE_DATA)
+    with open(data_file, 'rb') as dfl:
+        # mmap cannot map an empty file, which is what we get if every chunk is a fill
+        data = memoryview(mmap.mmap(dfl.fileno(), 0, access=mmap.ACCESS_READ)) if os.path.getsize(data_file) else memoryview(b'')
+    for part in info['partitions']:
+        part_name = part['name']
+        dev.print(f'flashing partition: "{part_name}" ({round(part["size"] / 1024 / 1024)}MB) from bundle: {bundle}')
+        for chunk in part['chunks']:
+            if part_name == 'bootloader':
+                # bootloader always causes a timeout, write_part_chunk knows how to handle that
+                length = chunk['length']
+                dev.write_part_chunk(part_name, chunk['offset'], data[chunk['data']:chunk['data'] + length + (-length % BUNDLE_ALIGN)], length)
+                uploaded += length
+            else:
+                for (start, length, crc) in chunk_pieces(chunk, dev.WRITE_CHUNK_SIZE):
+                    if 'fill' in chunk:
+                        crc = chunk['crc32'] if crc is not None else fill_crc32(chunk['fill'], length)
+                        dev.write_checked_chunk(part_name, chunk['offset'] + start, length, crc, fill=chunk['fill'])
+                    else:
+                        position = chunk['data'] + start
+                        # pieces of a chunk end on a block boundary, only the end of a chunk needs its alignment padding
+                        piece = data[position:position + length + (-length % BUNDLE_ALIGN)]
+                        if crc is None:
+                            crc = binascii.crc32(piece[:length])
+                        dev.write_checked_chunk(part_name, chunk['offset'] + start, length, crc, data=piece)
+                        uploaded += length
+            done += chunk['length']
+            dev.report_progress('flash_bundle', part_name, done, total)
+    dev.report_metrics('flash_bundle', total, time.monotonic() - start_time, uploaded=uploaded)
+    dev.print(f'flashed {round(total / 1024 / 1024)}MB, uploaded {round(uploaded / 1024 / 1024)}MB')
@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+"""
+Catalog of devices, dump files and chunk hashes, in a local SQLite database
+
+Every dump_partition and restore_partition records which file now matches that partition of that unit,
+with its sha256, crc32, and crc32 of every CATALOG_CHUNK_SIZE chunk (same as the manifest).
+Existing dump folders can be added from their manifest, without a device.
+Finding the dump closest to a unit, or every unit with a given boot_a, is then an indexed lookup instead of hashing gigabytes.
+
+    devices: one row per unit, see SuperbirdDevice.device_identity
+    partitions: offset and size of each partition, as validated on that unit
+    files: every dump file we know of, with its hashes (device is only set if it was dumped from that unit)
+    chunks: crc32 of every chunk of every file
+    contents: which file each partition of each unit matched, as of its last dump or restore
+    emmc: erase group size of every eMMC measured with --emmc_geometry, keyed by its CID
+"""
+# pylint: disable=line-too-long
+
+import os
+import gzip
+import time
+import sqlite3
+import contextlib
+
+from superbird_manifest import MANIFEST_CHUNK_SIZE, load_manifest, update_manifest
+from superbird_partitions import DUMP_FILE_NAMES
+
+CATALOG_ENV = 'SUPERBIRD_CATALOG'  # environment variable to use another catalog, or none to disable it
+CATALOG_DEFAULT = os.path.join(os.path.expanduser('~'), '.superbird_catalog.db')
+CATALOG_CHUNK_SIZE = MANIFEST_CHUNK_SIZE  # 1MB, so manifest entries can be used as-is
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS devices (
+    id TEXT PRIMARY KEY,
+    port TEXT,
+    first_seen REAL NOT NULL,
+    last_seen REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS partitions (
+    device TEXT NOT NULL REFERENCES devices (id) ON DELETE CASCADE,
+    part_name TEXT NOT NULL,
+    part_offset INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    PRIMARY KEY (device, part_name)
+);
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    folder TEXT NOT NULL,
+    part_name TEXT NOT NULL,
+    device TEXT,
+    size INTEGER NOT NULL,
+    sha256 TEXT NOT NULL,
+    crc32 TEXT NOT NULL,
+    added REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_part_name ON files (part_name);
+CREATE INDEX IF NOT EXISTS files_sha256 ON files (sha256);
+CREATE INDEX IF NOT EXISTS files_crc32 ON files (crc32);
+CREATE TABLE IF NOT EXISTS chunks (
+    file INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+    idx INTEGER NOT NULL,
+    crc32 INTEGER NOT NULL,
+    PRIMARY KEY (file, idx)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS contents (
+    device TEXT NOT NULL REFERENCES devices (id) ON DELETE CASCADE,
+    part_name TEXT NOT NULL,
+    file INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+    source TEXT NOT NULL,
+    updated REAL NOT NULL,
+    PRIMARY KEY (device, part_name)
+);
+CREATE INDEX IF NOT EXISTS contents_file ON contents (file);
+CREATE TABLE IF NOT EXISTS emmc (
+    cid TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    erase_size INTEGER NOT NULL,
+    preferred_erase_size INTEGER NOT NULL,
+    measured REAL NOT NULL
+);
+"""
+
+
+def catalog_path(path:str=None):
+    """ which catalog to use: path if given, otherwise $SUPERBIRD_CATALOG, otherwise CATALOG_DEFAULT
+        returns None if that is "none", meaning no catalog
+    """
+    path = path or os.environ.get(CATALOG_ENV) or CATALOG_DEFAULT
+    if path.lower() == 'none':
+        return None
+    return path
+
+
+def hash_dump_file(path:str) -> dict:
+    """ hash a dump file (gzipped if it ends in .gz) the same way DumpPipeline does, returns a manifest entry """
+    from superbird_writer import FileHashes
+    hashes = FileHashes(CATALOG_CHUNK_SIZE)
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'rb') as dmf:
+        while True:
+            data = dmf.read(16 * CATALOG_CHUNK_SIZE)
+            if not data:
+                break
+            hashes.update(data)
+    entry = hashes.entry()
+    entry['compressed'] = path.endswith('.gz')
+    return entry
+
+
+class Catalog:
+    """ SQLite catalog of devices and dumps
+            every call uses its own connection, so it can be used from the dump writer thread, and by several processes at once
+    """
+    def __init__(self, path:str):
+        self.path = path
+        with self.connect() as db:
+            db.executescript(CATALOG_SCHEMA)
+
+    @contextlib.contextmanager
+    def connect(self):
+        """ a connection for one transaction, committed if the block finishes without an error """
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            db.execute('PRAGMA foreign_keys = ON')
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def record_device(self, device:str, port:str=None):
+        """ note that we have seen a unit """
+        now = time.time()
+        with self.connect() as db:
+            db.execute('INSERT INTO devices (id, port, first_seen, last_seen) VALUES (?, ?, ?, ?) ON CONFLICT (id) DO UPDATE SET port = excluded.port, last_seen = excluded.last_seen', (device, port, now, now))
+
+    def record_partition(self, device:str, part_name:str, part_offset:int, size:int):
+        """ offset and size of a partition, as validated on a unit """
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO partitions (device, part_name, part_offset, size) VALUES (?, ?, ?, ?)', (device, part_name, part_offset, size))
+
+    def record_dump(self, device:str, part_name:str, path:str, entry:dict):
+        """ a partition of a unit was dumped to path, entry is its manifest entry """
+        with self.connect() as db:
+            file_id = self.add_file(db, path, part_name, entry, device)
+            self.set_contents(db, device, part_name, file_id, 'dump')
+
+    def record_restore(self, device:str, part_name:str, path:str, entry:dict):
+        """ a partition of a unit was restored from path, entry is its manifest entry """
+        with self.connect() as db:
+            file_id = self.add_file(db, path, part_name, entry)
+            self.set_contents(db, device, part_name, file_id, 'restore')
+
+    def forget(self, device:str, part_names:list):
+        """ partitions of a unit were written some other way, so we no longer know what is on them """
+        with self.connect() as db:
+            db.executemany('DELETE FROM contents WHERE device = ? AND part_name = ?', [(device, part_name) for part_name in part_names])
+
+    def record_emmc(self, geometry:dict):
+        """ erase group size of an eMMC, from superbird_net DeviceEnd.emmc_geometry """
+        with self.connect() as db:
+            db.execute('INSERT OR REPLACE INTO emmc (cid, name, erase_size, preferred_erase_size, measured) VALUES (?, ?, ?, ?, ?)',
+                       (geometry['cid'], geometry['name'], geometry['erase_size'], geometry['preferred_erase_size'], time.time()))
+
+    def erase_size(self):
+        """ erase group size to align writes to, in bytes: the largest of every eMMC measured, so it suits all of them
+            returns None if none has been measured
+        """
+        with self.connect() as db:
+            (size,) = db.execute('SELECT MAX(MAX(erase_size, preferred_erase_size)) FROM emmc').fetchone()
+        return size
+
+    @staticmethod
+    def set_contents(db, device:str, part_name:str, file_id:int, source:str):
+        """ record which file a partition of a unit now matches """
+        db.execute('INSERT OR REPLACE INTO contents (device, part_name, file, source, updated) VALUES (?, ?, ?, ?, ?)', (device, part_name, file_id, source, time.time()))
+
+    @staticmethod
+    def add_file(db, path:str, part_name:str, entry:dict, device:str=None) -> int:
+        """ add a dump file with its hashes, or find it if it is already there and unchanged, returns its id """
+        path = os.path.abspath(path)
+        row = db.execute('SELECT id, sha256, size FROM files WHERE path = ?', (path,)).fetchone()
+        if row is not None:
+            if (row[1], row[2]) == (entry['sha256'], entry['size']):
+                return row[0]
+            # the file changed since we saw it, so units which matched it no longer do
+            db.execute('DELETE FROM files WHERE id = ?', (row[0],))
+        cursor = db.execute(
+            'INSERT INTO files (path, folder, part_name, device, size, sha256, crc32, added) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (path, os.path.dirname(path), part_name, device, entry['size'], entry['sha256'], entry['crc32'], time.time()))
+        file_id = cursor.lastrowid
+        db.executemany('INSERT INTO chunks (file, idx, crc32) VALUES (?, ?, ?)', [(file_id, idx, int(crc, 16)) for (idx, crc) in enumerate(entry['chunk_crc32'])])
+        return file_id
+
+    def add_folder(self, folder:str) -> int:
+        """ add every dump file in a folder, using hashes from its manifest
+                files the manifest has no hashes for (like from --analyze_dump, or an older version) are hashed, and the manifest updated
+            returns the number of files added
+        """
+        manifest = load_manifest(folder)
+        if manifest['chunk_size'] != CATALOG_CHUNK_SIZE:
+            raise ValueError(f'Manifest of {folder} uses {manifest["chunk_size"]} byte chunks, catalog needs {CATALOG_CHUNK_SIZE}')
+        found = []
+        hashed = {}
+        for (part_name, file_name) in DUMP_FILE_NAMES.items():
+            for name in [file_name, f'{file_name}.gz']:
+                if not os.path.isfile(os.path.join(folder, name)):
+                    continue
+                entry = manifest['files'].get(name, {})
+                if 'sha256' not in entry or 'chunk_crc32' not in entry:
+                    print(f'Hashing {os.path.join(folder, name)}')
+                    entry = hashed[name] = hash_dump_file(os.path.join(folder, name))
+                found.append((part_name, name, entry))
+        if hashed:
+            update_manifest(folder, hashed)
+        with self.connect() as db:
+            for (part_name, name, entry) in found:
+                self.add_file(db, os.path.join(folder, name), part_name, entry)
+        return len(found)
+
+    def devices(self) -> list:
+        """ every unit, most recently seen first, each a dict with a list of what is on its partitions """
+        with self.connect() as db:
+            devices = [{'id': row[0], 'port': row[1], 'first_seen': row[2], 'last_seen': row[3], 'contents': []} for row in db.execute('SELECT id, port, first_seen, last_seen FROM devices ORDER BY last_seen DESC')]
+            for device in devices:
+                for row in db.execute('SELECT c.part_name, c.source, c.updated, f.path, f.sha256 FROM contents c JOIN files f ON f.id = c.file WHERE c.device = ? ORDER BY c.part_name', (device['id'],)):
+                    device['contents'].append(dict(zip(['part_name', 'source', 'updated', 'path', 'sha256'], row)))
+        return devices
+
+    def find(self, part_name:str, digest:str):
+        """ units and dump files whose partition has the given sha256 (64 hex digits) or crc32 (8 hex digits)
+            returns a tuple of: list of (device, port, source, updated, path), list of (path, device, added)
+        """
+        digest = digest.lower()
+        if len(digest) == 64:
+            column = 'sha256'
+        elif len(digest) == 8:
+            column = 'crc32'
+        else:
+            raise ValueError(f'Not a sha256 (64 hex digits) or crc32 (8 hex digits): {digest}')
+        with self.connect() as db:
+            units = db.execute(f'SELECT c.device, d.port, c.source, c.updated, f.path FROM contents c JOIN files f ON f.id = c.file JOIN devices d ON d.id = c.device WHERE c.part_name = ? AND f.{column} = ? ORDER BY c.updated DESC', (part_name, digest)).fetchall()
+            files = db.execute(f'SELECT path, device, added FROM files WHERE part_name = ? AND {column} = ? ORDER BY added DESC', (part_name, digest)).fetchall()
+        return (units, files)
+
+    def match(self, device:str) -> list:
+        """ rank dump folders by how much of them differs from what is on a unit, by comparing chunk crc32
+                only partitions whose contents we know (from the last dump or restore of that unit) are compared
+            returns a list of (folder, partitions compared, chunks which differ, chunks compared), closest first
+        """
+        with self.connect() as db:
+            totals = db.execute(
+                'SELECT f.folder, COUNT(*), SUM((f.size + ? - 1) / ?) FROM contents c JOIN files f ON f.part_name = c.part_name WHERE c.device = ? GROUP BY f.folder',
+                (CATALOG_CHUNK_SIZE, CATALOG_CHUNK_SIZE, device)).fetchall()
+            matching = dict(db.execute(
+                'SELECT f.folder, COUNT(*) FROM contents c '
+                'JOIN chunks mine ON mine.file = c.file '
+                'JOIN files f ON f.part_name = c.part_name '
+                'JOIN chunks theirs ON theirs.file = f.id AND theirs.idx = mine.idx '
+                'WHERE c.device = ? AND theirs.crc32 = mine.crc32 GROUP BY f.folder',
+                (device,)).fetchall())
+        ranked = [(folder, parts, chunks - matching.get(folder, 0), chunks) for (folder, parts, chunks) in totals]
+        ranked.sort(key=lambda row: (row[2], -row[1]))
+        return ranked
+
+
+def format_time(timestamp:float) -> str:
+    """ local time, for showing catalog timestamps """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+
+
+def print_devices(devices:list):
+    """ show the output of Catalog.devices """
+    if not devices:
+        print('No devices in catalog')
+    for device in devices:
+        port = f' on port {device["port"]}' if device['port'] else ''
+        print(f'{device["id"]}: last seen {format_time(device["last_seen"])}{port}, first seen {format_time(device["first_seen"])}')
+        for content in device['contents']:
+            print(f'  {content["part_name"]:<10} {content["sha256"][:16]}  {content["source"]} {format_time(content["updated"])}  {content["path"]}')
+
+
+def print_match(device:str, ranked:list):
+    """ show the output of Catalog.match """
+    if not ranked:
+        print(f'Nothing to compare against: no known contents for {device}, or no dumps of those partitions')
+    for (folder, parts, differ, chunks) in ranked:
+        print(f'{folder}: {round(differ * CATALOG_CHUNK_SIZE / 1024 / 1024)}MB of {round(chunks * CATALOG_CHUNK_SIZE / 1024 / 1024)}MB differs, over {parts} partitions')
+
+
+def print_find(units:list, files:list):
+    """ show the output of Catalog.find """
+    print(f'{len(units)} units:')
+    for (device, port, source, updated, path) in units:
+        print(f'  {device}' + (f' (port {port})' if port else '') + f': {source} {format_time(updated)} from {path}')
+    print(f'{len(files)} dump files:')
+    for (path, device, added) in files:
+        print(f'  {path}' + (f' (dumped from {device})' if device else '') + f', added {format_time(added)}')
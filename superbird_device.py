@@ -5,10 +5,16 @@ Wrapper for performing tasks on superbird device
 # pylint: disable=line-too-long,broad-except
 
 import os
+import re
 import sys
+import mmap
 import time
-import traceback
+import struct
+import binascii
 import platform
+import contextlib
+
+from pathlib import Path
 
 try:
     from pyamlboot import pyamlboot
@@ -52,14 +58,67 @@ except ImportError:
     """)
     sys.exit(1)
 
+try:
+    import usb1
+except ImportError:
+    # optional, python-libusb1 lets us wait for the device using libusb hotplug events instead of polling
+    usb1 = None
+
 from superbird_partitions import SUPERBIRD_PARTITIONS
+from superbird_partitions import image_partitions, image_end, partition_image_offset
+from superbird_writer import DumpPipeline, FileHashes, open_dump, dump_size, decompressed
+from superbird_fastboot import FastbootDevice, UsbTransport
+from superbird_transport import PyamlbootTransport, select_transport
+from superbird_errors import DeviceNotFoundError, DeviceAccessError, PyamlbootVersionError, BulkcmdException, BulkcmdTimeoutError
+from superbird_errors import BurnModeError, PartitionError, TransferError, OperationCancelled
+from uboot_env import ENV_SIZE, environ_used_length, iter_environ, parse_environ, diff_environ, format_env_text
+
+IMAGES_PATH = Path(os.path.dirname(os.path.abspath(__file__))).joinpath('images')
+BL2_IMAGE = IMAGES_PATH.joinpath('superbird.bl2.encrypted.bin')
+BOOTLOADER_IMAGE = IMAGES_PATH.joinpath('superbird.bootloader.img')
 
 BURN_MODE_TIMEOUT = 10  # seconds, how long to wait for device to enter USB Burn Mode
+POLL_INTERVAL = 0.02  # seconds, between checks while waiting for the device, when hotplug events are not available
+BL2_TIMEOUT = 5  # seconds, how long to wait for bl2 to start asking for the bootloader
 
-class BulkcmdException(Exception):
-    """
-    So we can catch this specifically
+# vendor id, product id of the device in each mode
+DEVICE_IDS = {
+    'normal': (0x18d1, 0x4e40),
+    'usb': (0x1b8e, 0xc003),
+    'usb-burn': (0x1b8e, 0xc003),
+}
+
+# bus number and port numbers of the last device we found
+#   the device stays on the same port when it re-enumerates in another mode, so we can watch just that port
+DEVICE_PORT_PATH = None
+
+# images loaded by load_image, kept open (memory-mapped) for the life of the process
+IMAGE_CACHE = {}
+
+# DRAM as burn-mode u-boot uses it, for finding somewhere to stage multi-MB eMMC transfers
+DRAM_SIZE = 0x20000000  # 512MB
+UBOOT_RELOC_ADDR = 0x17e42000  # where u-boot relocates itself, its malloc area (64MB) is just below
+# ranges which staging must stay out of: start, end, what is there
+RESERVED_RAM = [
+    (0x00000000, 0x05000000, 'kernel (ADDR_KERNEL)'),
+    (0x05000000, 0x08400000, 'secure monitor'),
+    (0x12fff000, 0x13e42000, 'scratch (ADDR_CRC, ADDR_TMP), initrd (ADDR_INITRD) and u-boot stack'),
+    (0x13e42000, UBOOT_RELOC_ADDR, 'u-boot malloc'),
+    (UBOOT_RELOC_ADDR, 0x1f800000, 'relocated u-boot'),
+    (0x1f800000, DRAM_SIZE, 'framebuffer'),
+]
+
+class PortAmlogicSoC(pyamlboot.AmlogicSoC):
+    """ AmlogicSoC for a usb device we already found (see find_devices),
+            AmlogicSoC() itself always takes the first device usb.core.find returns
     """
+    def __init__(self, usb_device):  # pylint: disable=super-init-not-called
+        # AmlogicSoC.__init__ would look the device up again with usb.core.find, and might pick another one
+        #   all it does is set self.dev (or raise ValueError if nothing was found), as of pyamlboot 1.0.0,
+        #   so everything it sets is set here too, if a newer pyamlboot sets more, it has to be added here as well
+        if usb_device is None:
+            raise ValueError('Device not found')
+        self.dev = usb_device
 
 def find_device(silent:bool=False):
     """ Find a superbird device and return its mode
@@ -68,12 +127,14 @@ def find_device(silent:bool=False):
     try:
         found_devices = usb.core.find(idVendor=0x18d1, idProduct=0x4e40)
         if found_devices is not None:
+            remember_port_path(found_devices)
             dev_product = found_devices[0].device.product
             if not silent:
                 print('Found device booted normally, with USB Gadget (adb/usbnet) enabled')
             return 'normal'
         found_devices = usb.core.find(idVendor=0x1b8e, idProduct=0xc003)
         if found_devices is not None:
+            remember_port_path(found_devices)
             dev_product = found_devices[0].device.product
             # I don't understand it, just documenting it and fixing the bug.
             # --burn_mode somehow has dev_product set to M8-CHIP, --find_device has dev_product be None
@@ -92,6 +153,181 @@ def find_device(silent:bool=False):
             print('Found a potential device that is not ready')
     return 'not-found'
 
+def find_devices():
+    """ Find every superbird device connected, for driving more than one at a time
+        returns a list of tuples: pyusb device (pass it to SuperbirdDevice as usb_device), mode
+    """
+    found = []
+    for (vendor_id, product_id) in sorted(set(DEVICE_IDS.values())):
+        for usb_device in usb.core.find(find_all=True, idVendor=vendor_id, idProduct=product_id) or []:
+            found.append((usb_device, usb_device_mode(usb_device)))
+    return found
+
+def usb_device_mode(usb_device):
+    """ mode of a pyusb device (see find_device) """
+    try:
+        product = usb_device.product
+    except Exception:
+        # strings are not readable until the device is ready
+        product = None
+    return mode_from_ids(usb_device.idVendor, usb_device.idProduct, product)
+
+def free_dram_range(reserved:list=None):
+    """ largest range of DRAM which is not in reserved (RESERVED_RAM by default)
+        returns a tuple of: start, end
+    """
+    position = 0
+    best = (0, 0)
+    for (start, end, _what) in sorted(reserved or RESERVED_RAM):
+        if start - position > best[1] - best[0]:
+            best = (position, start)
+        position = max(position, end)
+    if DRAM_SIZE - position > best[1] - best[0]:
+        best = (position, DRAM_SIZE)
+    return best
+
+def load_image(path):
+    """ memory-map an image file once, and return a read-only memoryview of it
+            slices of the memoryview do not copy any data
+    """
+    path = os.path.abspath(path)
+    if path not in IMAGE_CACHE:
+        with open(path, 'rb') as imf:
+            IMAGE_CACHE[path] = memoryview(mmap.mmap(imf.fileno(), 0, access=mmap.ACCESS_READ))
+    return IMAGE_CACHE[path]
+
+@contextlib.contextmanager
+def map_file(path):
+    """ memory-map a file for the duration of a with block, as a read-only memoryview
+            slices of it are handed to the transport without copying, and pages are only read in as they are sent,
+            so memory use does not grow with file size, and restores running at the same time share the page cache
+    """
+    with open(path, 'rb') as mpf:
+        if os.fstat(mpf.fileno()).st_size == 0:
+            # mmap cannot map an empty file
+            yield memoryview(b'')
+            return
+        mapped = mmap.mmap(mpf.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)
+        try:
+            yield view
+        finally:
+            view.release()
+            try:
+                mapped.close()
+            except BufferError:
+                pass  # a slice is still referenced somewhere, the mapping goes away along with it
+
+def usb_port_path(found_device):
+    """ bus number and port numbers of where a device is plugged in, or None if the backend cannot tell us """
+    try:
+        if found_device.port_numbers:
+            return (found_device.bus, tuple(found_device.port_numbers))
+    except Exception:
+        pass
+    return None
+
+def remember_port_path(found_device):
+    """ remember where a device is plugged in, for wait_for_device_mode """
+    global DEVICE_PORT_PATH
+    DEVICE_PORT_PATH = usb_port_path(found_device)
+
+def mode_from_ids(vendor_id:int, product_id:int, product:str):
+    """ device mode, from usb vendor id, product id, and product string (same logic as find_device) """
+    if (vendor_id, product_id) == DEVICE_IDS['normal']:
+        return 'normal'
+    if (vendor_id, product_id) == DEVICE_IDS['usb-burn']:
+        if product is None or product == 'M8-CHIP':
+            return 'usb-burn'
+        if product == 'GX-CHIP':
+            return 'usb'
+    return 'not-found'
+
+def sysfs_device_mode(port_path:tuple):
+    """ device mode of whatever is plugged into the given port, read from Linux sysfs without enumerating the bus
+        returns None if sysfs is not available
+    """
+    (bus, ports) = port_path
+    sysfs_path = f'/sys/bus/usb/devices/{bus}-{".".join(str(port) for port in ports)}'
+    if not os.path.isdir('/sys/bus/usb/devices'):
+        return None
+    try:
+        with open(f'{sysfs_path}/idVendor', 'r', encoding='ascii') as idf:
+            vendor_id = int(idf.read(), 16)
+        with open(f'{sysfs_path}/idProduct', 'r', encoding='ascii') as idf:
+            product_id = int(idf.read(), 16)
+    except (OSError, ValueError):
+        # nothing plugged in there right now
+        return 'not-found'
+    try:
+        with open(f'{sysfs_path}/product', 'r', encoding='utf-8') as pdf:
+            product = pdf.read().strip()
+    except OSError:
+        product = None
+    return mode_from_ids(vendor_id, product_id, product)
+
+def wait_hotplug(mode:str, timeout:float):
+    """ wait for a device in the given mode to arrive, using libusb hotplug events
+        returns None if hotplug is not supported here, otherwise True or False
+    """
+    with usb1.USBContext() as context:
+        if not context.hasCapability(usb1.CAP_HAS_HOTPLUG):
+            return None
+        arrived = []
+        def on_arrival(_context, _device, _event):
+            arrived.append(True)
+        (vendor_id, product_id) = DEVICE_IDS[mode]
+        handle = context.hotplugRegisterCallback(on_arrival, events=usb1.HOTPLUG_EVENT_DEVICE_ARRIVED, vendor_id=vendor_id, product_id=product_id)
+        try:
+            deadline = time.monotonic() + timeout
+            # it may have already arrived before we registered
+            if find_device(silent=True) == mode:
+                return True
+            while time.monotonic() < deadline:
+                context.handleEventsTimeout(tv=min(0.1, max(0, deadline - time.monotonic())))
+                if arrived:
+                    arrived.clear()
+                    # usb and usb-burn modes share ids, so check which one arrived (it can take a moment before strings are readable)
+                    while time.monotonic() < deadline:
+                        dev_mode = find_device(silent=True)
+                        if dev_mode == mode:
+                            return True
+                        if dev_mode != 'not-found':
+                            break
+                        time.sleep(POLL_INTERVAL)
+            return False
+        finally:
+            context.hotplugDeregisterCallback(handle)
+
+def wait_for_device_mode(mode:str, timeout:float=BURN_MODE_TIMEOUT):
+    """ wait until a device in the given mode shows up, and return as soon as it does
+            uses libusb hotplug events if python-libusb1 is installed,
+            otherwise polls the port where we last saw the device through sysfs (Linux), or polls find_device
+        returns True if the device showed up in time
+    """
+    if usb1 is not None:
+        try:
+            result = wait_hotplug(mode, timeout)
+            if result is not None:
+                return result
+        except Exception:
+            pass  # fall back to polling
+    deadline = time.monotonic() + timeout
+    while True:
+        dev_mode = None
+        if DEVICE_PORT_PATH is not None:
+            dev_mode = sysfs_device_mode(DEVICE_PORT_PATH)
+            if dev_mode == mode:
+                # make sure libusb sees it too, before we try to talk to it
+                dev_mode = find_device(silent=True)
+        if dev_mode is None:
+            dev_mode = find_device(silent=True)
+        if dev_mode == mode:
+            return True
+        if time.monotonic() >= deadline:
+            return False
+        time.sleep(POLL_INTERVAL if DEVICE_PORT_PATH is not None else 0.1)
+
 def check_device_mode(mode:str, silent:bool=False):
     """ confirm if device is in the mode we need """
     dev_mode = find_device(silent=True)
@@ -112,50 +348,46 @@ def check_device_mode(mode:str, silent:bool=False):
         return False
     return True
 
+def ensure_burn_mode(dev, dev_mode:str=None):
+    """ check device mode and enter burn mode if needed, raising instead of printing on failure
+            dev_mode is the mode if we already know it, otherwise it is looked up
+        returns a device object in USB Burn Mode (a new one, if the device had to re-enumerate)
+    """
+    if dev_mode is None:
+        dev_mode = dev.mode()
+    if dev_mode == 'usb-burn':
+        dev.select_transport()
+        return dev
+    if dev_mode != 'usb':
+        raise BurnModeError(f'Cannot enter burn mode from current mode: {dev_mode}')
+    dev.print('Entering USB Burn Mode')
+    dev.bl2_boot()
+    dev.print('Waiting for device...')
+    usb_device = dev.wait_reenumerate(BURN_MODE_TIMEOUT)
+    dev.print('Device is now in USB Burn Mode')
+    dev = SuperbirdDevice(connect_timeout=BURN_MODE_TIMEOUT, usb_device=usb_device, **dev.options)
+    dev.select_transport()
+    dev.bulkcmd('amlmmc part 1')
+    return dev
+
 def enter_burn_mode(dev):
     """ check device mode and enter burn mode if needed
         returns a new device object, or None if failure
     """
     dev_mode = find_device()
-    if dev_mode == 'usb-burn':
-        return dev
-    elif dev_mode == 'usb':
-        print('Entering USB Burn Mode')
-        dev.bl2_boot('images/superbird.bl2.encrypted.bin', 'images/superbird.bootloader.img')
-        print('Waiting for device...')
-        # wait for it to boot up in USB Burn Mode
-        wait_time = 0
-        while wait_time <= BURN_MODE_TIMEOUT:
-            time.sleep(1)
-            if check_device_mode('usb-burn', silent=True):
-                break
-            wait_time += 1
-        if check_device_mode('usb-burn'):
-            print('Device is now in USB Burn Mode')
-            time.sleep(0.5)
-            dev = SuperbirdDevice()
-            time.sleep(1)
-            dev.bulkcmd('amlmmc part 1')
-            return dev
-        else:
-            print('Failed to enter USB Burn Mode!')
-            return None
-    else:
-        print(f'Cannot enter burn mode from current mode: {dev_mode}')
+    try:
+        return ensure_burn_mode(dev, dev_mode)
+    except BurnModeError as ex:
+        print(ex)
         return None
 
-def stdout_clear_lines(num:int=1):
-    """ un-print the last N lines """
-    while num > 0:
-        sys.stdout.write("\x1b[1A\x1b[2K")  # move cursor up one line, and delete that whole line
-        num -= 1
-
 class SuperbirdDevice:
     """ convenience wrapper for superbird device """
     ADDR_BL2 = 0xfffa0000
     ADDR_KERNEL = 0x01080000
     ADDR_INITRD = 0x13000000
     ADDR_TMP = 0x13000000
+    ADDR_CRC = ADDR_TMP - 0x1000  # small results like crc32 go just below ADDR_TMP
     # commands which cause a usb timeout when reading response
     #   for any other commands, we raise an exception if they cause a timeout
     TIMEOUT_COMMANDS = ['booti', 'bootm', 'bootp', 'mw.b', 'reset', 'reboot']
@@ -165,11 +397,46 @@ class SuperbirdDevice:
     TRANSFER_BLOCK_SIZE = ( 8 * MULTIPLIER ) * PART_SECTOR_SIZE  # 4KB data transfered into memory one block at a time
     WRITE_CHUNK_SIZE = ( 1024 * MULTIPLIER ) * PART_SECTOR_SIZE  # 512KB chunk written to memory, then gets written to mmc
     READ_CHUNK_SIZE = 128 * PART_SECTOR_SIZE  # 128KB chunk read from mmc into memory, then read out to local file
+    ENV_DELETE_BATCH = 16  # names per env delete command, u-boot limits the number of arguments
+    SIBLING_CHUNK_SIZE = 2048 * PART_SECTOR_SIZE  # 1MB chunk compared against the other A/B slot, before reading it out
+
+    ADDR_STAGE = ADDR_TMP  # where read_part_chunk and write_part_chunk stage data, see discover_staging
+    STAGING_CHUNK_SIZE = 16384 * PART_SECTOR_SIZE  # 8MB per amlmmc read or write, once a staging area is found
+    STAGING_PROBE_SIZE = 4096  # bytes, written at both ends of a staging area to check it
+
+    DEVICE_ID_KEYS = ['usid', 'serialno']  # unifykeys which may hold the serial number of a unit, tried in order
+    ADB_KERNEL_MAGIC = b'SBADBKRN'
+    ADB_KERNEL_HEADER = struct.Struct('<8sIIIIII')  # magic, then offset, length and crc32 of kernel, then of initrd
+    ADB_KERNEL_ALIGN = 4096  # kernel and initrd are stored on this boundary, after the header
 
     # writes larger than threshold will be broken into chunks of WRITE_CHUNK_SIZE
     TRANSFER_SIZE_THRESHOLD = 2 * 1024 * 1024  # 2MB
+    ERASE_SIZE = 1024 * PART_SECTOR_SIZE  # 512KB, erase group size assumed if the catalog has not measured one (see --emmc_geometry)
+    ERASE_BATCH = 131072 * PART_SECTOR_SIZE  # 64MB erased per amlmmc erase, so no single command takes too long
 
-    def __init__(self, slowBurn = False, slowerBurn = False) -> None:
+    def __init__(self, slowBurn = False, slowerBurn = False, connect_timeout:float=0, usb_device=None, log=None, progress=None, metrics=None, cancel=None, catalog=None, erase_size:int=None, pre_erase:bool=False) -> None:
+        """ connect to the device, raises a SuperbirdError if we cannot
+                usb_device is a pyusb device from find_devices, to pick one when several are connected, otherwise the first one found is used
+                log(message) gets every message, instead of printing it to console
+                progress(operation, target, done, total) is called after each chunk of a dump or restore, done and total are in bytes
+                metrics(name, values) gets a dict of measurements (bytes, seconds, bytes_per_second) when a dump or restore finishes
+                cancel is a threading.Event, once it is set the running operation stops at the next chunk, raising OperationCancelled
+                catalog is a superbird_catalog.Catalog, which dump_partition and restore_partition keep up to date
+                erase_size is the erase group size of the eMMC in bytes (ERASE_SIZE if not given), restore_partition writes whole groups
+                with pre_erase, restore_partition erases the partition before writing it, see erase_range
+        """
+        # kept so a new object for the same device (after it re-enumerates) gets the same options
+        self.options = {'slowBurn': slowBurn, 'slowerBurn': slowerBurn, 'log': log, 'progress': progress, 'metrics': metrics, 'cancel': cancel, 'catalog': catalog, 'erase_size': erase_size, 'pre_erase': pre_erase}
+        self.usb_device = usb_device
+        self.log = log
+        self.progress = progress
+        self.metrics = metrics
+        self.cancel = cancel
+        self.catalog = catalog
+        self.identity = None  # see device_identity
+        self.erase_size = erase_size or self.ERASE_SIZE
+        self.warn_erase_size = erase_size is None  # the first restore_partition warns that ERASE_SIZE is only a guess
+        self.pre_erase = pre_erase
         if slowerBurn:
             self.MULTIPLIER = 1
             self.TRANSFER_BLOCK_SIZE = ( 8 * self.MULTIPLIER ) * self.PART_SECTOR_SIZE  # Base 4KB data transfered into memory one block at a time
@@ -179,55 +446,242 @@ class SuperbirdDevice:
             self.TRANSFER_BLOCK_SIZE = ( 8 * self.MULTIPLIER ) * self.PART_SECTOR_SIZE  # Base 4KB data transfered into memory one block at a time
             self.WRITE_CHUNK_SIZE = ( 1024 * self.MULTIPLIER ) * self.PART_SECTOR_SIZE  # 512KB chunk written to memory, then gets written to mmc
         try:
-            self.device = pyamlboot.AmlogicSoC()
-        except ValueError:
-            print('Device not found, is it in usb burn mode?')
-            sys.exit(1)
+            self.device = self.connect(connect_timeout, usb_device)
+        except ValueError as exv:
+            raise DeviceNotFoundError('Device not found, is it in usb burn mode?') from exv
         except USBError as exu:
             if exu.errno == 13:
                 # [Errno 13] Access denied (insufficient permissions)
-                print(f'{exu}, need to run as root')
-                sys.exit(1)
-            else:
-                print(f'Error: {exu}')
-                print(traceback.format_exc())
-                sys.exit(1)
-        else:
-            if not hasattr(self.device, 'bulkCmd'):
-                self.print('Detected an old version of pyamlboot which lacks AmlogicSoC.bulkCmd')
-                self.print('Need to install from the github master branch')
-                self.print(' need to uninstall the current version, then install from github')
-                self.print('  python3 -m pip uninstall pyamlboot')
-                self.print('  python3 -m pip install git+https://github.com/superna9999/pyamlboot')
-                sys.exit(1)
+                raise DeviceAccessError(f'{exu}, need to run as root') from exu
+            raise TransferError(f'Error: {exu}') from exu
+        if not hasattr(self.device, 'bulkCmd'):
+            raise PyamlbootVersionError('\n'.join([
+                'Detected an old version of pyamlboot which lacks AmlogicSoC.bulkCmd',
+                'Need to install from the github master branch',
+                ' need to uninstall the current version, then install from github',
+                '  python3 -m pip uninstall pyamlboot',
+                '  python3 -m pip install git+https://github.com/superna9999/pyamlboot',
+            ]))
+        # all device I/O goes through self.transport, see select_transport for upgrading it once in USB Burn Mode
+        self.transport = PyamlbootTransport(self.device)
+        self.staging_pending = False  # see ensure_staging
 
-    @staticmethod
-    def decode(response):
-        """ decode a response """
-        return response.tobytes().decode("utf-8")
+    def select_transport(self):
+        """ pick the fastest transport the device supports, only in USB Burn Mode (the probe reads DRAM) """
+        self.transport = select_transport(self.device, self.ADDR_TMP)
+        self.READ_CHUNK_SIZE = self.transport.read_chunk_size
+        self.print(f'Using transport: {self.transport.name}')
+        # discover_staging costs several bulkcmds, so it waits for the first transfer that can use it
+        self.staging_pending = True
+
+    def ensure_staging(self):
+        """ run discover_staging once, if select_transport has been called, before a transfer that picks its chunk size
+                small reads and writes (env, single sectors) stay at ADDR_TMP, so commands which only do those never pay for it
+        """
+        if self.staging_pending:
+            self.staging_pending = False
+            self.discover_staging()
+
+    def discover_staging(self):
+        """ find somewhere in DRAM to stage multi-MB eMMC transfers, so each amlmmc read or write moves STAGING_CHUNK_SIZE
+                starts from the largest range not in RESERVED_RAM, then cuts it short of anything the running env points into,
+                and checks that memory at both ends holds what we write there
+                if anything is uncertain, we keep staging at ADDR_TMP with the normal chunk sizes
+        """
+        self.ADDR_STAGE = self.ADDR_TMP
+        try:
+            (start, end) = free_dram_range()
+            for address in self.env_addresses():
+                if start <= address < end:
+                    # we do not know how much is used there, so only keep what is below it
+                    end = address
+            if end - start < self.STAGING_CHUNK_SIZE:
+                raise ValueError(f'only {hex(end - start)} bytes free at {hex(start)}')
+            if not self.verify_staging(start, self.STAGING_CHUNK_SIZE):
+                raise ValueError(f'memory at {hex(start)} did not hold what we wrote')
+        except Exception as ex:
+            self.print(f'No staging area found ({ex}), staging at {hex(self.ADDR_TMP)}')
+            return
+        self.ADDR_STAGE = start
+        self.READ_CHUNK_SIZE = self.STAGING_CHUNK_SIZE
+        if self.MULTIPLIER == SuperbirdDevice.MULTIPLIER:
+            # --slow_burn and --slower_burn keep their smaller writes
+            self.WRITE_CHUNK_SIZE = self.STAGING_CHUNK_SIZE
+        self.print(f'Staging eMMC transfers at {hex(start)}, {self.STAGING_CHUNK_SIZE // 1024 // 1024}MB at a time')
+
+    def env_addresses(self):
+        """ addresses that the running env points at (loadaddr, fb_addr, and so on), using env export
+            returns a list of int, raises ValueError if the export could not be read back
+        """
+        self.bulkcmd(f'env export -b {hex(self.ADDR_TMP)}', silent=True)
+        # same as read_env, read progressively more until we find the terminator
+        data = self.read_memory(self.ADDR_TMP, 4096)
+        while environ_used_length(data, start=0) is None and len(data) < ENV_SIZE:
+            data += self.read_memory(self.ADDR_TMP + len(data), min(len(data), ENV_SIZE - len(data)))
+        used = environ_used_length(data, start=0)
+        if used is None:
+            raise ValueError('env export did not end where expected')
+        addresses = []
+        for (key, value) in iter_environ(data[:used], start=0):
+            if 'addr' not in key:
+                continue
+            for word in value.split():
+                # u-boot takes addresses as hex, with or without 0x
+                if re.fullmatch(r'(0x)?[0-9a-fA-F]+', word):
+                    addresses.append(int(word, 16))
+        return addresses
+
+    def verify_staging(self, address:int, length:int):
+        """ check that memory at both ends of a staging area holds what we write there, after running a command
+            returns True if it does
+        """
+        pattern = bytes(range(256)) * (self.STAGING_PROBE_SIZE // 256)
+        probes = [address, address + length - self.STAGING_PROBE_SIZE]
+        for probe in probes:
+            self.transport.write_memory(probe, pattern, self.STAGING_PROBE_SIZE, append_zeros=False)
+        # give u-boot a chance to use its own memory, before checking ours
+        self.bulkcmd('amlmmc part 1', silent=True)
+        return all(self.device_crc32(probe, self.STAGING_PROBE_SIZE) == binascii.crc32(pattern) for probe in probes)
 
     @staticmethod
-    def print(message:str):
-        """ print a message to console
+    def connect(timeout:float=0, usb_device=None):
+        """ connect to the device, retrying for up to timeout seconds while it is still coming up
+                AmlogicSoC() always takes the first device it finds, so for a given usb_device we use PortAmlogicSoC instead
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if usb_device is not None:
+                    return PortAmlogicSoC(usb_device)
+                return pyamlboot.AmlogicSoC()
+            except (ValueError, USBError) as exc:
+                if getattr(exc, 'errno', None) == 13 or time.monotonic() >= deadline:
+                    raise
+                time.sleep(POLL_INTERVAL)
+
+    def mode(self):
+        """ current mode of this device (see find_device) """
+        if self.usb_device is None:
+            return find_device(silent=True)
+        return usb_device_mode(self.usb_device)
+
+    def wait_reenumerate(self, timeout:float=BURN_MODE_TIMEOUT):
+        """ wait for this device to show up in USB Burn Mode, after it re-enumerates
+                with usb_device, only the port it is plugged into is watched, so other devices are left alone
+            returns the new pyusb device (or None, when not using usb_device), raises BurnModeError if it did not show up in time
+        """
+        if self.usb_device is None:
+            if not wait_for_device_mode('usb-burn', timeout):
+                raise BurnModeError('Failed to enter USB Burn Mode!')
+            return None
+        port_path = usb_port_path(self.usb_device)
+        deadline = time.monotonic() + timeout
+        while True:
+            for (usb_device, dev_mode) in find_devices():
+                if dev_mode == 'usb-burn' and usb_port_path(usb_device) == port_path:
+                    return usb_device
+            if time.monotonic() >= deadline:
+                raise BurnModeError('Failed to enter USB Burn Mode!')
+            time.sleep(POLL_INTERVAL)
+
+    def print(self, message:str):
+        """ print a message to console, or pass it to the log callback
             on Windows, need to flush after printing
             or nothing will show up until script is complete
         """
+        if self.log is not None:
+            self.log(message)
+            return
         print(message)
         sys.stdout.flush()
 
+    def check_cancel(self):
+        """ raise OperationCancelled if the cancel event is set """
+        if self.cancel is not None and self.cancel.is_set():
+            raise OperationCancelled('Operation cancelled')
+
+    def report_progress(self, operation:str, target:str, done:int, total:int):
+        """ pass progress of a dump or restore to the progress callback, and stop here if cancelled """
+        if self.progress is not None:
+            self.progress(operation, target, done, total)
+        self.check_cancel()
+
+    def report_metrics(self, name:str, length:int, elapsed:float, **values):
+        """ pass measurements of a finished operation to the metrics callback """
+        if self.metrics is not None:
+            self.metrics(name, {'bytes': length, 'seconds': elapsed, 'bytes_per_second': length / elapsed if elapsed > 0 else 0, **values})
+
+    def device_identity(self):
+        """ identity of this unit, for the catalog, recorded there the first time we ask
+                the first unifykey in DEVICE_ID_KEYS which keyman can read into memory, otherwise where the unit is plugged in
+        """
+        if self.identity is None:
+            for key in self.DEVICE_ID_KEYS:
+                # mw.b is in TIMEOUT_COMMANDS, so it gets its own bulkcmd, otherwise a keyman failure would be ignored along with it
+                self.bulkcmd(f'mw.b {hex(self.ADDR_CRC)} 0 0x100', silent=True)
+                try:
+                    self.bulkcmd(f'keyman init 0x1234;keyman read {key} {hex(self.ADDR_CRC)} str', silent=True)
+                except BulkcmdException:
+                    continue
+                value = bytes(self.read_memory(self.ADDR_CRC, 0x100)).split(b'\0')[0]
+                if value and value.isascii() and value.decode('ascii').isprintable():
+                    self.identity = f'{key}:{value.decode("ascii")}'
+                    break
+            port = usb_port_path(self.device.dev)
+            port_name = f'{port[0]}-{".".join(str(number) for number in port[1])}' if port else None
+            if self.identity is None:
+                self.identity = f'port:{port_name}'
+            if self.catalog is not None:
+                self.catalog.record_device(self.identity, port_name)
+        return self.identity
+
+    def catalog_partition(self, part_name:str, part_offset:int, part_size:int):
+        """ record the geometry of a partition we are about to dump or restore in the catalog
+            returns the identity of this unit, or None if the catalog could not be updated (which is only a warning)
+        """
+        try:
+            identity = self.device_identity()
+            self.catalog.record_partition(identity, part_name, part_offset, part_size)
+            return identity
+        except Exception as ex:
+            self.print(f'Warning: could not update catalog: {ex}')
+            return None
+
+    def catalog_record(self, identity:str, operation:str, part_name:str, path:str, entry:dict):
+        """ record a finished dump or restore in the catalog, a catalog problem is only a warning
+                this may run on the dump writer thread, so it must not talk to the device
+        """
+        try:
+            if operation == 'dump':
+                self.catalog.record_dump(identity, part_name, path, entry)
+            else:
+                self.catalog.record_restore(identity, part_name, path, entry)
+        except Exception as ex:
+            self.print(f'Warning: could not record {operation} of {part_name} in catalog: {ex}')
+
+    def catalog_forget(self, part_names:list):
+        """ partitions were written without hashing them, so the catalog no longer knows what is on them """
+        if self.catalog is None:
+            return
+        try:
+            self.catalog.forget(self.device_identity(), part_names)
+        except Exception as ex:
+            self.print(f'Warning: could not update catalog: {ex}')
+
     def bulkcmd(self, command:str, ignore_timeout=False, silent=False, is_shell = False):
-        """ perform a bulkcmd, separated by semicolon """
+        """ perform a bulkcmd, separated by semicolon
+                raises BulkcmdException if it fails, or BulkcmdTimeoutError if the device does not answer
+        """
         if not (is_shell or silent):
             self.print(f' executing bulkcmd: "{command}"')
         try:
-            resp = self.device.bulkCmd(command)
-            response = self.decode(resp)
+            response = self.transport.bulk_cmd(command)
             if not silent:
                 self.print(f'  result: {response}')
             if 'success' not in response:
                 if not is_shell:
                     self.print(f'Bulkcmd failed: {command} -> {response}')
-                    raise BulkcmdException('Bulkcmd failed')
+                    raise BulkcmdException(f'Bulkcmd failed: {command} -> {response}')
             time.sleep(0.2)
         except (USBTimeoutError, BulkcmdException) as ex:
             # if you use booti or mw.b, it wont return, thus will raise USBTimeoutError
@@ -235,38 +689,84 @@ class SuperbirdDevice:
                 if not silent:
                     self.print('  ...')
             else:
-                self.print(f' Error ({ex.__class__.__name__}): bulkcmd timed out or failed!')
-                self.print(' This can happen if the device ends up in a strange state, like as the result of a previously failed command')
-                self.print(' Try power cycling the device by pulling the cable, and then boot up and try again')
-                self.print('  You might need to do this multiple times')
-                self.print('    If the device is connected through a USB hub, try connecting it directly to a port on your machine')
-                sys.exit(1)
-        except USBError:
+                if not silent:
+                    self.print(f' Error ({ex.__class__.__name__}): bulkcmd timed out or failed!')
+                    self.print_bulkcmd_help()
+                if isinstance(ex, BulkcmdException):
+                    raise
+                raise BulkcmdTimeoutError(f'Bulkcmd timed out: {command}') from ex
+        except USBError as ex:
             # on Windows, raises USBError instead of USBTimeoutError
             if [word for word in self.TIMEOUT_COMMANDS if word in command] or ignore_timeout:
                 if not silent:
                     self.print('  ...')
             else:
-                self.print(' Error: bulkcmd timed out!')
-                self.print(' This can happen if the device ends up in a strange state, like as the result of a previously failed command')
-                self.print(' Try power cycling the device by pulling the cable, and then boot up and try again')
-                self.print('  You might need to do this multiple times')
-                self.print('    If the device is connected through a USB hub, try connecting it directly to a port on your machine')
-                sys.exit(1)
+                if not silent:
+                    self.print(' Error: bulkcmd timed out!')
+                    self.print_bulkcmd_help()
+                raise BulkcmdTimeoutError(f'Bulkcmd timed out: {command}') from ex
+
+    def print_bulkcmd_help(self):
+        """ what to try when a bulkcmd fails """
+        self.print(' This can happen if the device ends up in a strange state, like as the result of a previously failed command')
+        self.print(' Try power cycling the device by pulling the cable, and then boot up and try again')
+        self.print('  You might need to do this multiple times')
+        self.print('    If the device is connected through a USB hub, try connecting it directly to a port on your machine')
 
     def write(self, address:int, data, chunk_size=8, append_zeros=True):
         """ write data to an address """
         self.print(f' writing to: {hex(address)}')
-        self.device.writeLargeMemory(address, data, chunk_size, append_zeros)
+        self.transport.write_memory(address, data, chunk_size, append_zeros)
 
-    def send_env(self, env_string:str):
-        """ send given env string to device, space-separated kernel args on one line """
+    def send_env(self, env_string:str, replace:bool=False):
+        """ send given env string to device, space-separated kernel args on one line
+                with replace=True, the env in memory is cleared before importing (env import -d)
+        """
         env_size = len(env_string.encode('ascii'))
         self.print('initializing env subsystem')
         self.bulkcmd('amlmmc env')  # initialize env subsystem
         self.print(f'sending env ({env_size} bytes)')
         self.write(self.ADDR_TMP, env_string.encode('ascii'))  # write env string somewhere
-        self.bulkcmd(f'env import -t {hex(self.ADDR_TMP)} {hex(env_size)}')  # read env from string
+        self.bulkcmd(f'env import{" -d" if replace else ""} -t {hex(self.ADDR_TMP)} {hex(env_size)}')  # read env from string
+
+    def write_env_image(self, env_image:bytes, length:int):
+        """ write a binary env image (see uboot_env.build_environ) straight to the env partition, in one amlmmc write
+                only the first length bytes (rounded up to a whole sector) are written,
+                so length must cover both the used part of the new env, and of the env currently on the device,
+                since the crc expects everything after the used part to be zeros
+                this bypasses u-boot's env in memory, so do not "env save" afterwards in the same session
+        """
+        length = min(len(env_image), -(-length // self.PART_SECTOR_SIZE) * self.PART_SECTOR_SIZE)
+        self.print(f'writing env image ({length} of {len(env_image)} bytes)')
+        self.write_part_chunk('env', 0, env_image[:length], length)
+
+    def sync_env(self, environ:dict, full:bool=False):
+        """ bring the env on device in line with environ, sending only what differs
+                the current env is read from the env partition, and compared against environ
+                added and changed values are sent in one env import, and with full=True, values missing from environ are deleted
+                env save only happens if something actually changed
+            returns a tuple containing: added, changed, removed (see uboot_env.diff_environ)
+        """
+        self.bulkcmd('amlmmc env', silent=True)
+        (current, _length, crc_ok) = parse_environ(self.read_env())
+        if not crc_ok:
+            # u-boot is running on its built-in default env, which we cannot read back, so send everything
+            self.print('env on device is not valid, sending the whole env')
+            self.send_env(format_env_text(environ), replace=full)
+            self.bulkcmd('env save')
+            return (dict(environ), {}, [])
+        (added, changed, removed) = diff_environ(current, environ)
+        if not full:
+            removed = []
+        if not (added or changed or removed):
+            self.print('env on device already matches, nothing to send')
+            return (added, changed, removed)
+        if added or changed:
+            self.send_env(format_env_text({**added, **changed}))
+        for index in range(0, len(removed), self.ENV_DELETE_BATCH):
+            self.bulkcmd(f'env delete {" ".join(removed[index:index + self.ENV_DELETE_BATCH])}')
+        self.bulkcmd('env save')
+        return (added, changed, removed)
 
     def send_env_file(self, env_file:str):
         """ read env.txt, then send it to device """
@@ -276,42 +776,64 @@ class SuperbirdDevice:
         self.send_env(env_data)
 
     def send_file(self, filepath:str, address:int, chunk_size:int=512, append_zeros=True):
-        """ write given file to device memory at given address """
+        """ write given file to device memory at given address, straight from a memory-mapped file """
         self.print(f'writing {filepath} at {hex(address)}')
-        file_data = None
-        with open(filepath, 'rb') as flp:
-            file_data = flp.read()
-        self.write(address, file_data, chunk_size, append_zeros)
+        with map_file(filepath) as file_data:
+            self.write(address, file_data, chunk_size, append_zeros)
 
-    def bl2_boot(self, bl2_file:str, bootloader_file:str):
-        """ send a bl2 and then chain a uboot image with it """
+    def bl2_boot(self, bl2_file:str=BL2_IMAGE, bootloader_file:str=BOOTLOADER_IMAGE):
+        """ send a bl2 and then chain a uboot image with it
+                bl2 asks for the bootloader piece by piece (AMLC), each piece is served straight from the memory-mapped image
+            returns a list of (seq, offset, length, seconds) for each AMLC step
+        """
         # TODO there is something wrong with bl2_boot
-        self.send_file(bl2_file, self.ADDR_BL2, chunk_size=4096, append_zeros=True)
-        self.device.run(self.ADDR_BL2)
-        data = None
-        with open(bootloader_file, 'rb') as blf:
-            data = blf.read()
-        time.sleep(2)
+        start_time = time.monotonic()
+        self.send_file(str(bl2_file), self.ADDR_BL2, chunk_size=4096, append_zeros=True)
+        self.transport.run(self.ADDR_BL2)
+        data = load_image(bootloader_file)
+        upload_time = time.monotonic() - start_time
 
+        timings = []
         prev_length = -1
         prev_offset = -1
         seq = 0
         while True:
-            (length, offset) = self.device.getBootAMLC()
+            step_time = time.monotonic()
+            if seq == 0:
+                (length, offset) = self.wait_boot_amlc()
+            else:
+                (length, offset) = self.transport.get_boot_amlc()
 
             if length == prev_length and offset == prev_offset:
-                self.print("[BL2 END]")
+                # bl2 repeats its last request once it is done
+                #   this is the only exit: stopping as soon as the end of the image was sent would save this last getBootAMLC,
+                #   but pyamlboot always makes it, and skipping it has not been tried on hardware
                 break
 
             prev_length = length
             prev_offset = offset
 
-            self.print(f'AMLC dataSize={length}, offset={offset}, seq={seq}')
-            self.device.writeAMLCData(seq, offset, data[offset:offset+length])
-            self.print("[DONE]")
-
+            self.transport.write_amlc_data(seq, offset, data[offset:offset+length])
+            timings.append((seq, offset, length, time.monotonic() - step_time))
             seq = seq + 1
 
+        total_bytes = sum(length for (_seq, _offset, length, _seconds) in timings)
+        self.print(f'[BL2 END] bl2 upload: {upload_time:.2f}s, bootloader: {len(timings)} AMLC steps, {total_bytes // 1024}KB in {sum(seconds for (*_step, seconds) in timings):.2f}s')
+        return timings
+
+    def wait_boot_amlc(self, timeout:float=BL2_TIMEOUT):
+        """ wait for bl2 to start up and make its first request for the bootloader
+                bl2 does not answer until it is ready, so keep asking instead of sleeping a fixed time
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.transport.get_boot_amlc()
+            except USBError:
+                if time.monotonic() >= deadline:
+                    raise
+                time.sleep(POLL_INTERVAL)
+
     def boot(self, env_file:str, kernel:str, initrd:str):
         """ boot using given env.txt, kernel, kernel address, and initrd, intitrd_address """
         self.print(f'Booting {env_file}, {kernel}, {initrd}')
@@ -321,27 +843,296 @@ class SuperbirdDevice:
         self.print('Booting kernel with initrd')
         self.bulkcmd(f'booti {hex(self.ADDR_KERNEL)} {hex(self.ADDR_INITRD)}')
 
+    def boot_stored(self, env_file:str, kernel:str, initrd:str, store_part:str):
+        """ boot like boot(), but keep kernel and initrd in store_part, so they are only uploaded when they change
+                store_part starts with a header (ADB_KERNEL_HEADER) holding offset, length and crc32 of each image
+                if it matches the local images, they are read from mmc, and the device checks their crc32 before booting
+                otherwise they are uploaded, checked the same way, and written to store_part, header last
+        """
+        with map_file(kernel) as kernel_data, map_file(initrd) as initrd_data:
+            kernel_offset = self.ADB_KERNEL_ALIGN
+            initrd_offset = kernel_offset + len(kernel_data) + (-len(kernel_data) % self.ADB_KERNEL_ALIGN)
+            part_size = self.PARTITIONS[store_part]['size'] * self.PART_SECTOR_SIZE
+            if initrd_offset + len(initrd_data) > part_size:
+                raise PartitionError(f'kernel and initrd do not fit in {store_part}: {initrd_offset + len(initrd_data)} vs {part_size} bytes')
+            images = [
+                (kernel, kernel_data, self.ADDR_KERNEL, kernel_offset, binascii.crc32(kernel_data)),
+                (initrd, initrd_data, self.ADDR_INITRD, initrd_offset, binascii.crc32(initrd_data)),
+            ]
+            header = self.ADB_KERNEL_HEADER.pack(self.ADB_KERNEL_MAGIC, *[value for (_name, data, _address, offset, crc) in images for value in (offset, len(data), crc)])
+            self.print(f'Booting {env_file}, {kernel}, {initrd} (stored in {store_part})')
+            self.send_env_file(env_file)
+            loaded = False
+            if bytes(self.read_part_chunk(store_part, 0, self.PART_SECTOR_SIZE)[:len(header)]) == header:
+                self.print(f'loading kernel and initrd from {store_part}')
+                for (_name, data, address, offset, _crc) in images:
+                    self.mmc_to_memory(store_part, address, offset, len(data))
+                loaded = all(self.device_crc32(address, len(data)) == crc for (_name, data, address, _offset, crc) in images)
+                if not loaded:
+                    self.print(f'kernel or initrd in {store_part} failed crc32 check, uploading them again')
+            else:
+                self.print(f'kernel or initrd not stored in {store_part}, or changed since, uploading them')
+            if not loaded:
+                # invalidate the header first, so an interrupted store is never trusted
+                self.write_part_chunk(store_part, 0, bytes(self.PART_SECTOR_SIZE), self.PART_SECTOR_SIZE)
+                for (name, data, address, offset, crc) in images:
+                    self.print(f'writing {name} at {hex(address)}')
+                    self.transport.write_memory(address, data, 512, append_zeros=True)
+                    device_crc = self.device_crc32(address, len(data))
+                    if device_crc != crc:
+                        raise TransferError(f'crc32 of {name} in memory is {device_crc:08x}, expected {crc:08x}')
+                    self.memory_to_mmc(store_part, address, offset, len(data))
+                # initrd may be sitting in the staging area, so the header goes through the small scratch area below it
+                self.transport.write_memory(self.ADDR_CRC, header, self.PART_SECTOR_SIZE, append_zeros=True)
+                self.bulkcmd(f'amlmmc write {store_part} {hex(self.ADDR_CRC)} 0x0 {hex(self.PART_SECTOR_SIZE)}', silent=True)
+                self.print(f'stored kernel and initrd in {store_part}, next boot will load them from there')
+            self.print('Booting kernel with initrd')
+            self.bulkcmd(f'booti {hex(self.ADDR_KERNEL)} {hex(self.ADDR_INITRD)}')
+
+    def mmc_to_memory(self, part_name:str, address:int, offset:int, length:int):
+        """ read a range of a partition straight into device memory, STAGING_CHUNK_SIZE per command """
+        for start in range(0, length, self.STAGING_CHUNK_SIZE):
+            count = min(self.STAGING_CHUNK_SIZE, length - start)
+            self.bulkcmd(f'amlmmc read {part_name} {hex(address + start)} {hex(offset + start)} {hex(count)}', silent=True)
+
+    def memory_to_mmc(self, part_name:str, address:int, offset:int, length:int):
+        """ write a range of device memory straight into a partition, STAGING_CHUNK_SIZE per command """
+        for start in range(0, length, self.STAGING_CHUNK_SIZE):
+            count = min(self.STAGING_CHUNK_SIZE, length - start)
+            self.bulkcmd(f'amlmmc write {part_name} {hex(address + start)} {hex(offset + start)} {hex(count)}', silent=True)
+
     def read_memory(self, address, length):
         """Read some data from memory"""
-        data = None
-        offset = 0
-        while length:
-            if length >= 64:
-                read_data = self.device.readSimpleMemory(address + offset, 64).tobytes()
-                if data is not None:
-                    data = data + read_data
-                else:
-                    data = read_data
-                length = length - 64
-                offset = offset + 64
-            else:
-                read_data = self.device.readSimpleMemory(address + offset, length).tobytes()
-                if data is not None:
-                    data = data + read_data
-                else:
-                    data = read_data
-                break
-        return data
+        return self.transport.read_memory(address, length)
+
+    def read_part_chunk(self, part_name:str, offset:int, length:int):
+        """ read one chunk of a partition: from mmc into memory, then from memory back to us """
+        self.bulkcmd(f'amlmmc read {part_name} {hex(self.ADDR_STAGE)} {hex(offset)} {hex(length)}', silent=True)
+        return self.read_memory(self.ADDR_STAGE, length)
+
+    def write_part_chunk(self, part_name:str, offset:int, data, length:int):
+        """ write one chunk of a partition: from us into memory, then from memory to mmc
+            data is zero-padded up to TRANSFER_BLOCK_SIZE, but only length bytes are written to mmc
+        """
+        self.transport.write_memory(self.ADDR_STAGE, data, self.TRANSFER_BLOCK_SIZE, append_zeros=True)
+        if part_name == 'bootloader':
+            # bootloader always causes timeout
+            self.bulkcmd(f'amlmmc write {part_name} {hex(self.ADDR_STAGE)} {hex(offset)} {hex(length)}', silent=True, ignore_timeout=True)
+            time.sleep(2)  # let bootloader settle
+        else:
+            self.bulkcmd(f'amlmmc write {part_name} {hex(self.ADDR_STAGE)} {hex(offset)} {hex(length)}', silent=True)
+
+    def write_checked_chunk(self, part_name:str, offset:int, length:int, crc:int, data=None, fill:int=None):
+        """ write one chunk of a partition, only once the device has checked it in memory
+                data is uploaded to the staging area, or with fill, the device fills the staging area with that byte value (mw.b), so nothing is uploaded
+                the device calculates crc32 of the staging area, and if it does not match crc, nothing is written and TransferError is raised
+        """
+        if fill is None:
+            self.transport.write_memory(self.ADDR_STAGE, data, self.TRANSFER_BLOCK_SIZE, append_zeros=True)
+        else:
+            # mw.b is in TIMEOUT_COMMANDS, so it gets its own bulkcmd, otherwise a failed crc32 would be ignored along with it
+            self.bulkcmd(f'mw.b {hex(self.ADDR_STAGE)} {hex(fill)} {hex(length)}', silent=True)
+        device_crc = self.device_crc32(self.ADDR_STAGE, length)
+        if device_crc != crc:
+            raise TransferError(f'crc32 of staged chunk {part_name} {hex(offset)}+{hex(length)} is {device_crc:08x}, expected {crc:08x}, not writing it')
+        self.bulkcmd(f'amlmmc write {part_name} {hex(self.ADDR_STAGE)} {hex(offset)} {hex(length)}', silent=True)
+
+    def write_reused_chunk(self, part_name:str, sibling_part:str, offset:int, data, length:int):
+        """ write one chunk of a partition, uploading it only if the device does not already have it
+                the device calculates crc32 of the chunk as it is now, and if it matches, nothing is written
+                then of the same chunk of sibling_part (the other A/B slot), and if that matches, it is written from the staging area
+                otherwise it is filled with zeros on the device, or uploaded, see write_checked_chunk
+            returns how the chunk was written: unchanged, sibling, filled or uploaded
+        """
+        crc = binascii.crc32(data[:length])
+        for (source, result) in [(part_name, 'unchanged'), (sibling_part, 'sibling')]:
+            read_cmd = f'amlmmc read {source} {hex(self.ADDR_STAGE)} {hex(offset)} {hex(length)}'
+            if self.device_crc32(self.ADDR_STAGE, length, prefix=read_cmd) == crc:
+                if result == 'sibling':
+                    self.bulkcmd(f'amlmmc write {part_name} {hex(self.ADDR_STAGE)} {hex(offset)} {hex(length)}', silent=True)
+                return result
+        if data[:length] == bytes(length):
+            # zeros are filled in on the device, there is nothing to upload
+            self.write_checked_chunk(part_name, offset, length, crc, fill=0)
+            return 'filled'
+        self.write_checked_chunk(part_name, offset, length, crc, data=data)
+        return 'uploaded'
+
+    def device_crc32(self, address:int, length:int, prefix:str=''):
+        """ have the device calculate crc32 of a region of its memory, and read back only the 4-byte result
+                prefix is an optional command to run first, in the same bulkcmd
+        """
+        command = f'crc32 {hex(address)} {hex(length)} {hex(self.ADDR_CRC)}'
+        if prefix:
+            command = f'{prefix};{command}'
+        self.bulkcmd(command, silent=True)
+        # u-boot stores the result big-endian
+        (crc,) = struct.unpack('>I', self.read_memory(self.ADDR_CRC, 4))
+        return crc
+
+    def range_partition_size(self, part_name:str):
+        """ size of a partition, for byte-range operations
+                only partitions with an alternate size (data) need a validate_partition_size probe
+        """
+        if part_name == 'bootloader':
+            raise ValueError('Byte-range operations are not supported on bootloader, dump or restore the whole partition instead')
+        if part_name not in self.PARTITIONS or part_name in ['reserved', 'cache']:
+            raise ValueError(f'Cannot read or write partition: "{part_name}"')
+        if 'size_alt' in self.PARTITIONS[part_name]:
+            (part_size, _part_offset) = self.validate_partition_size(part_name)
+            if part_size is None:
+                raise PartitionError('Failed to validate partition size!')
+            return part_size
+        return self.PARTITIONS[part_name]['size'] * self.PART_SECTOR_SIZE
+
+    def read_range(self, part_name:str, offset:int, length:int):
+        """ read any byte range of a partition, which does not need to be sector-aligned
+                whole sectors are read from mmc, then trimmed down to the requested range
+        """
+        aligned_start = offset - (offset % self.PART_SECTOR_SIZE)
+        aligned_end = -(-(offset + length) // self.PART_SECTOR_SIZE) * self.PART_SECTOR_SIZE
+        data = bytearray()
+        position = aligned_start
+        while position < aligned_end:
+            chunk_size = min(self.READ_CHUNK_SIZE, aligned_end - position)
+            data += self.read_part_chunk(part_name, position, chunk_size)
+            position += chunk_size
+        start = offset - aligned_start
+        return bytes(data[start:start + length])
+
+    def write_range(self, part_name:str, offset:int, data:bytes):
+        """ write data to any byte range of a partition, which does not need to be sector-aligned
+                partial sectors at either end are read first, and merged with data (read-modify-write)
+        """
+        aligned_start = offset - (offset % self.PART_SECTOR_SIZE)
+        aligned_end = -(-(offset + len(data)) // self.PART_SECTOR_SIZE) * self.PART_SECTOR_SIZE
+        head = b''
+        tail = b''
+        if offset > aligned_start:
+            head = self.read_range(part_name, aligned_start, offset - aligned_start)
+        if offset + len(data) < aligned_end:
+            tail = self.read_range(part_name, offset + len(data), aligned_end - offset - len(data))
+        if head or tail:
+            data = head + data + tail
+        position = 0
+        while position < len(data):
+            chunk_size = min(self.WRITE_CHUNK_SIZE, len(data) - position)
+            self.write_part_chunk(part_name, aligned_start + position, data[position:position + chunk_size], chunk_size)
+            position += chunk_size
+
+    def dump_range(self, part_name:str, offset:int, length:int, outfile:str):
+        """ dump a byte range of a partition to a file """
+        self.ensure_staging()
+        part_size = self.range_partition_size(part_name)
+        if offset < 0 or length <= 0 or offset + length > part_size:
+            raise ValueError(f'Range {hex(offset)}+{hex(length)} does not fit within partition {part_name} ({hex(part_size)})')
+        self.print(f'dumping range: "{part_name}" {hex(offset)}+{hex(length)} into file: {outfile}')
+        with open(outfile, 'wb') as ofl:
+            position = offset
+            while position < offset + length:
+                # keep every chunk but the first aligned to READ_CHUNK_SIZE
+                chunk_end = min(offset + length, (position // self.READ_CHUNK_SIZE + 1) * self.READ_CHUNK_SIZE)
+                ofl.write(self.read_range(part_name, position, chunk_end - position))
+                position = chunk_end
+                self.report_progress('dump_range', part_name, position - offset, length)
+
+    def restore_range(self, part_name:str, offset:int, infile:str):
+        """ write a file into a partition, starting at a byte offset """
+        self.ensure_staging()
+        self.bulkcmd('amlmmc part 1', silent=True)
+        part_size = self.range_partition_size(part_name)
+        length = os.path.getsize(infile)
+        if offset < 0 or length <= 0 or offset + length > part_size:
+            raise ValueError(f'Range {hex(offset)}+{hex(length)} does not fit within partition {part_name} ({hex(part_size)})')
+        self.print(f'writing range: "{part_name}" {hex(offset)}+{hex(length)} from file: {infile}')
+        self.catalog_forget([part_name])
+        with map_file(infile) as file_data:
+            position = offset
+            while position < offset + length:
+                # keep every chunk but the first aligned to WRITE_CHUNK_SIZE, so only the ends need read-modify-write
+                chunk_end = min(offset + length, (position // self.WRITE_CHUNK_SIZE + 1) * self.WRITE_CHUNK_SIZE)
+                self.write_range(part_name, position, file_data[position - offset:chunk_end - offset])
+                position = chunk_end
+                self.report_progress('restore_range', part_name, position - offset, length)
+
+    def read_env(self, initial_length:int=4096):
+        """ read only the used part of the env partition, using progressively larger reads until the terminator is found
+                returns raw env data, which uboot_env.parse_environ can check and parse
+        """
+        data = self.read_range('env', 0, initial_length)
+        while environ_used_length(data) is None and len(data) < ENV_SIZE:
+            data += self.read_range('env', len(data), min(len(data), ENV_SIZE - len(data)))
+        used = environ_used_length(data)
+        if used is None:
+            return data
+        return data[:used]
+
+    def enter_fastboot(self, transport=None):
+        """ start fastboot on the device (from USB Burn Mode), and return a FastbootDevice
+                transport defaults to the fastboot interface found over USB, pass a FastbootStandIn to use that instead
+        """
+        self.print('Starting fastboot')
+        # fastboot does not return until we leave it, so this bulkcmd always times out
+        self.bulkcmd('fastboot 0', ignore_timeout=True)
+        if transport is None:
+            transport = UsbTransport.find()
+        # so fastboot messages go wherever ours do (the log callback, or the json progress stream)
+        return FastbootDevice(transport, log=self.print)
+
+    def leave_fastboot(self, fastboot:FastbootDevice):
+        """ leave fastboot, and reconnect once the device is back in USB Burn Mode
+            returns True if it came back
+        """
+        fastboot.continue_boot()
+        fastboot.transport.close()
+        try:
+            usb_device = self.wait_reenumerate(BURN_MODE_TIMEOUT)
+        except BurnModeError:
+            return False
+        if usb_device is not None:
+            self.usb_device = usb_device
+        self.device = self.connect(BURN_MODE_TIMEOUT, usb_device)
+        self.select_transport()
+        self.bulkcmd('amlmmc part 1', silent=True)
+        return True
+
+    def restore_partitions_fastboot(self, restore_list:list, transport=None):
+        """ Restore partitions using fastboot, which is much faster than writing through memory one block at a time
+                restore_list is a list of (part_name, infile), bootloader cannot be restored this way
+                partition sizes are validated first, while we can still use bulkcmd
+            returns True if the device came back to USB Burn Mode afterwards
+        """
+        self.bulkcmd('amlmmc part 1', silent=True)
+        part_sizes = {}
+        for (part_name, infile) in restore_list:
+            if part_name == 'bootloader':
+                raise ValueError('bootloader cannot be restored using fastboot')
+            (part_size, _part_offset) = self.validate_partition_size(part_name)
+            if part_size is None:
+                raise PartitionError('Failed to validate partition size!')
+            if dump_size(infile) > part_size:
+                raise ValueError(f'File is larger than target partition: {infile} vs {part_name}')
+            part_sizes[part_name] = part_size
+        # forget before leaving USB Burn Mode, finding the identity of the unit needs bulkcmd
+        self.catalog_forget([part_name for (part_name, _infile) in restore_list])
+        fastboot = self.enter_fastboot(transport)
+        total = sum(dump_size(infile) for (_part_name, infile) in restore_list)
+        done = 0
+        start_time = time.monotonic()
+        try:
+            for (part_name, infile) in restore_list:
+                self.check_cancel()
+                self.print(f'flashing partition: "{part_name}" from file: {infile}')
+                fastboot.flash_file(part_name, infile, part_sizes[part_name])
+                done += dump_size(infile)
+                self.report_progress('fastboot', part_name, done, total)
+        except OperationCancelled:
+            raise
+        except Exception as ex:
+            # same as restore_partition, stop everything to prevent further possible damage
+            raise TransferError(f'Error while restoring partitions using fastboot, {ex}') from ex
+        self.report_metrics('restore_partitions_fastboot', total, time.monotonic() - start_time, partitions=len(restore_list))
+        return self.leave_fastboot(fastboot)
 
     def validate_partition_size(self, part_name):
         """ Validate the partition size by attempting to read the last sector
@@ -358,98 +1149,140 @@ class SuperbirdDevice:
             return (None, None)
         part_size = self.PARTITIONS[part_name]['size'] * self.PART_SECTOR_SIZE
         part_offset = self.PARTITIONS[part_name]['offset']
-        print(f'Validating size of partition: {part_name} size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB - ...')
         try:
             self.bulkcmd(f'amlmmc read {part_name} {hex(self.ADDR_TMP)} {hex(part_size - self.PART_SECTOR_SIZE)} {hex(self.PART_SECTOR_SIZE)}', silent=True)
         except Exception as extest:
-            stdout_clear_lines(2)
-            print(f'Validating size of partition: {part_name} size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB - FAIL')
+            self.print(f'Validating size of partition: {part_name} size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB - FAIL')
             if part_name == 'data':
                 part_size = self.PARTITIONS[part_name]['size_alt'] * self.PART_SECTOR_SIZE
-                print(f'Failed while fetching last chunk of partition: {part_name}, trying alternate size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB')
-                print(f'Validating size of partition: {part_name} size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB - ...')
+                self.print(f'Failed while fetching last chunk of partition: {part_name}, trying alternate size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB')
                 try:
                     self.bulkcmd(f'amlmmc read {part_name} {hex(self.ADDR_TMP)} {hex(part_size - self.PART_SECTOR_SIZE)} {hex(self.PART_SECTOR_SIZE)}', silent=True)
                 except Exception as extestt:
-                    stdout_clear_lines(2)
-                    print(f'Validating size of partition: {part_name} size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB - FAIL')
-                    print(f'Failed while validating size of partition: {part_name}, is partition size {hex(part_size)} correct? error: {extestt}')
+                    self.print(f'Validating size of partition: {part_name} size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB - FAIL')
+                    self.print(f'Failed while validating size of partition: {part_name}, is partition size {hex(part_size)} correct? error: {extestt}')
                     return (None, None)
             else:
-                print(f'Failed while validating size of partition: {part_name}, is partition size {hex(part_size)} correct? error: {extest}')
+                self.print(f'Failed while validating size of partition: {part_name}, is partition size {hex(part_size)} correct? error: {extest}')
                 return (None, None)
-        stdout_clear_lines(1)
-        print(f'\nValidating size of partition: {part_name} size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB - OK')
+        self.print(f'Validating size of partition: {part_name} size: {hex(part_size)} {round(part_size / 1024 / 1024)}MB - OK')
         return (part_size, part_offset)
 
-    def dump_partition(self, part_name:str, outfile:str):
+    def dump_partition(self, part_name:str, outfile:str, sibling_file:str=None, pipeline:DumpPipeline=None, compress:bool=None, post_process=None):
         """ dump given partition to a file
                 we cannot access the mmc directly,
                 but we can read from mmc into memory,
                 so we read it into memory, then read it from memory and append it to file, one chunk at a time
-                this is excruciatingly slow, compared to dumping using the offical amlogic tool, about 500KB/s, roughly 110 minutes to dump
+                with 64-byte reads this is excruciatingly slow, compared to dumping using the offical amlogic tool, about 500KB/s, roughly 110 minutes to dump
+                so select_transport uses large reads (and larger chunks) whenever the device supports them
+            sibling_file is an optional dump of the other A/B slot, as returned by dump_partition (gzipped if it was compressed)
+                for each chunk, the device calculates crc32 after reading it into memory,
+                and any chunk which matches the sibling dump is copied from there instead of being transferred
+            pipeline is an optional DumpPipeline shared across several dumps,
+                if not given, one is created just for this dump and we wait for it to finish
+                compress and post_process are passed to pipeline.open()
+            returns the path of the dump, with .gz added if it was compressed
         """
+        self.ensure_staging()
         (part_size, part_offset) = self.validate_partition_size(part_name)
         if part_size is None:
-            raise ValueError('Failed to validate partition size!')
+            raise PartitionError('Failed to validate partition size!')
         else:
             chunk_size = self.READ_CHUNK_SIZE
+            own_pipeline = pipeline is None
+            if own_pipeline:
+                pipeline = DumpPipeline()
+            if self.catalog is not None:
+                post_process = self.catalog_post_process(part_name, part_offset, part_size, pipeline, post_process)
+            sibling = None
+            if sibling_file is not None:
+                # the sibling dump may still be in the pipeline
+                pipeline.flush()
+                if not os.path.isfile(sibling_file) or dump_size(sibling_file) != part_size:
+                    self.print(f'Sibling dump {sibling_file} is missing or does not match partition size, not comparing against it')
+                else:
+                    sibling = open_dump(sibling_file)
+                    chunk_size = self.SIBLING_CHUNK_SIZE
+            reused = 0
             # now we are ready to actually dump the partition
             try:
-                # open(outfile, 'wb').close()  # empty the file
-                with open(outfile, 'wb') as ofl:
-                    offset = 0
-                    if part_name == 'bootloader':
-                        # when writing bootloader, it is actually written one sector after beginning of the partition
-                        offset = self.PART_SECTOR_SIZE
-                    first_chunk = True
-                    last_chunk = False
-                    remaining = part_size
-                    start_time = time.time()
-                    while remaining:
-                        if first_chunk:
-                            first_chunk = False
-                        else:
-                            stdout_clear_lines(2)
-                        if remaining <= chunk_size:
-                            chunk_size = remaining
-                            last_chunk = True
-                        progress = round((offset / part_size) * 100)
-                        elapsed = time.time() - start_time
-                        if elapsed < 1:
-                            # on a quick enough system, elapsed can be zero, and cause divbyzero error when calculating speed
-                            speed = 0
+                outfile = pipeline.open(outfile, compress=compress, post_process=post_process)
+                offset = 0
+                if part_name == 'bootloader':
+                    # when writing bootloader, it is actually written one sector after beginning of the partition
+                    offset = self.PART_SECTOR_SIZE
+                last_chunk = False
+                remaining = part_size
+                start_time = time.time()
+                # progress is only reported through the progress callback, printing every chunk slows the transfer down
+                self.print(f'dumping partition: "{part_name}" {hex(part_offset)} ({round(part_size / 1024 / 1024)}MB, {chunk_size // 1024}KB chunks) into file: {outfile}')
+                while remaining:
+                    if remaining <= chunk_size:
+                        chunk_size = remaining
+                        last_chunk = True
+                    if sibling is not None:
+                        # read into memory and calculate crc32 in one bulkcmd, then only transfer it if it differs
+                        sibling_data = sibling.read(chunk_size)
+                        read_cmd = f'amlmmc read {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(chunk_size)}'
+                        if self.device_crc32(self.ADDR_TMP, chunk_size, prefix=read_cmd) == binascii.crc32(sibling_data):
+                            pipeline.copy(sibling_file, offset, sibling_data)
+                            reused += chunk_size
                         else:
-                            speed = round((offset / elapsed) / 1024)  # in KB/s
-                        self.print(f'dumping partition: "{part_name}" {hex(part_offset)}+{hex(offset)} into file: {outfile} ')
-                        self.print(f'chunk_size: {chunk_size / 1024}KB | speed: {speed}KB/s | progress: {progress}% | remaining: {round(remaining / 1024 / 1024)}MB / {round(part_size / 1024 / 1024)}MB')
-                        self.bulkcmd(f'amlmmc read {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(chunk_size)}', silent=True)
-                        rdata = self.read_memory(self.ADDR_TMP, chunk_size)
-                        ofl.raw.write(rdata)
-                        ofl.flush()
-                        if last_chunk:
-                            break
-                        offset += chunk_size
-                        remaining -= chunk_size
+                            pipeline.write(self.read_memory(self.ADDR_TMP, chunk_size))
+                    else:
+                        pipeline.write(self.read_part_chunk(part_name, offset, chunk_size))
+                    self.report_progress('dump', part_name, part_size - remaining + chunk_size, part_size)
+                    if last_chunk:
+                        break
+                    offset += chunk_size
+                    remaining -= chunk_size
+                pipeline.close_file()
+                if own_pipeline:
+                    pipeline.close()
+            except OperationCancelled:
+                if own_pipeline:
+                    pipeline.abort()
+                raise
             except Exception as ex:
-                # in the event of any failure while reading partitions,
-                #   force the entire script to exit
-                print(f'Error while reading partition {part_name}, {ex}')
-                print(traceback.format_exc())
-                sys.exit(1)
+                # in the event of any failure while reading partitions, stop here
+                if own_pipeline:
+                    pipeline.abort()
+                raise TransferError(f'Error while reading partition {part_name}, {ex}') from ex
+            finally:
+                if sibling is not None:
+                    sibling.close()
+            if reused:
+                self.print(f'Reused {round(reused / 1024 / 1024)}MB of {round(part_size / 1024 / 1024)}MB from {sibling_file}')
+            self.report_metrics('dump_partition', part_size, time.time() - start_time, part_name=part_name, reused=reused)
+            return outfile
 
-    def restore_partition(self, part_name:str, infile:str):
+    def catalog_post_process(self, part_name:str, part_offset:int, part_size:int, pipeline:DumpPipeline, post_process=None):
+        """ wrap post_process of a dump, so the finished file is recorded in the catalog, from the writer thread """
+        identity = self.catalog_partition(part_name, part_offset, part_size)
+        if identity is None:
+            return post_process
+        def record(path:str):
+            if post_process is not None:
+                post_process(path)
+            self.catalog_record(identity, 'dump', part_name, path, pipeline.entries[os.path.basename(path)])
+        return record
+
+    def restore_partition(self, part_name:str, infile:str, sibling_part:str=None, entry:dict=None):
         """ Restore given partition from given dump
             Like with dump_partition, we first have to read it into RAM, then instruct the device to write it to mmc, one chunk at a time
+            sibling_part is an optional partition of the same size, usually the other A/B slot (see superbird_partitions.sibling_partition)
+                chunks already on the device, in this partition or in sibling_part, are not uploaded, see write_reused_chunk
+            entry is an optional manifest entry of infile, for the catalog, so it does not need hashing while writing (see superbird_preflight)
         """
+        self.ensure_staging()
         self.bulkcmd('amlmmc part 1', silent=True)
         (part_size, part_offset) = self.validate_partition_size(part_name)
         if part_size is None:
-            raise ValueError('Failed to validate partition size!')
+            raise PartitionError('Failed to validate partition size!')
         else:
             try:
                 chunk_size = self.WRITE_CHUNK_SIZE
-                file_size = os.path.getsize(infile)
+                file_size = dump_size(infile)
                 if part_name == 'bootloader':
                     # bootloader is only 2MB, but dumps are often zero-padded to 4MB
                     part_size = 2 * 1024 * 1024
@@ -459,48 +1292,193 @@ class SuperbirdDevice:
                 if file_size <= self.TRANSFER_SIZE_THRESHOLD:
                     # 2MB and lower, send as one chunk
                     chunk_size = file_size
-                with open(infile, 'rb') as ifl:
+                if sibling_part is not None:
+                    if part_name == 'bootloader' or SUPERBIRD_PARTITIONS[sibling_part]['size'] * self.PART_SECTOR_SIZE < part_size:
+                        raise ValueError(f'Cannot reuse chunks of {sibling_part} for {part_name}')
+                    # small chunks, so a change only costs the chunk it is in
+                    chunk_size = min(self.SIBLING_CHUNK_SIZE, part_size)
+                written = {'unchanged': 0, 'sibling': 0, 'filled': 0, 'uploaded': 0}
+                identity = self.catalog_partition(part_name, part_offset, part_size) if self.catalog is not None else None
+                hashes = FileHashes() if identity is not None and entry is None else None
+                erased = 0
+                erase_time = 0
+                if self.warn_erase_size and part_name != 'bootloader':
+                    self.warn_erase_size = False
+                    self.print(f'Warning: eMMC erase group size is not known, assuming {self.ERASE_SIZE // 1024}KB, boot with adb and run --emmc_geometry to measure it')
+                # a gzipped dump is decompressed to a temporary file first, so it can be memory-mapped
+                with decompressed(infile) as plain_file, map_file(plain_file) as file_data:
                     # now we are ready to actually write to the partition
-                    offset = 0
-                    first_chunk = True
-                    last_chunk = False
-                    remaining = part_size
                     start_time = time.time()
+                    if self.pre_erase and sibling_part is None and part_name != 'bootloader' and file_size > self.TRANSFER_SIZE_THRESHOLD:
+                        # erased groups can be written without the eMMC having to clear them first
+                        erased = self.erase_range(part_name, part_offset, 0, part_size)
+                        erase_time = time.time() - start_time
+                        self.print(f'erased {round(erased / 1024 / 1024)}MB of partition: "{part_name}" in {round(erase_time, 2)}s')
                     # TODO right now get_status always fails, it does not seem to be tracking our write progress
                     # self.device.bulkCmd(f'download store {part_name} normal {hex(part_size)}')
-                    while remaining:
-                        if first_chunk:
-                            first_chunk = False
+                    self.print(f'writing partition: "{part_name}" {hex(part_offset)} ({round(part_size / 1024 / 1024)}MB, {chunk_size // 1024}KB chunks) from file: {infile}')
+                    for (offset, length) in self.aligned_chunks(part_offset, part_size, chunk_size):
+                        data = file_data[offset:offset + length]
+                        if hashes is not None:
+                            hashes.update(data)
+                        if sibling_part is not None:
+                            if len(data) < length:
+                                # past the end of the file, the rest of the partition is compared against zeros
+                                data = bytes(data) + bytes(length - len(data))
+                            written[self.write_reused_chunk(part_name, sibling_part, offset, data, length)] += length
                         else:
-                            stdout_clear_lines(2)
-                        if remaining <= chunk_size:
-                            chunk_size = remaining
-                            last_chunk = True
-                        progress = round((offset / part_size) * 100)
-                        elapsed = time.time() - start_time
-                        if elapsed < 1:
-                            # on a quick enough system, elapsed can be zero, and cause divbyzero error when calculating speed
-                            speed = 0
-                        else:
-                            speed = round((offset / elapsed) / 1024 / 1024, 2)  # in MB/s
-                        data = ifl.read(chunk_size)
-                        remaining -= chunk_size
-                        self.print(f'writing partition: "{part_name}" {hex(part_offset)}+{hex(offset)} from file: {infile}')
-                        self.print(f'chunk_size: {chunk_size / 1024}KB | speed: {speed}MB/s | progress: {progress}% | remaining: {round(remaining / 1024 / 1024)}MB / {round(part_size / 1024 / 1024)}MB')
-                        self.device.writeLargeMemory(self.ADDR_TMP, data, self.TRANSFER_BLOCK_SIZE, appendZeros=True)
-                        if part_name == 'bootloader':
-                            # bootloader always causes timeout
-                            self.bulkcmd(f'amlmmc write {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(chunk_size)}', silent=True, ignore_timeout=True)
-                            time.sleep(2)  # let bootloader settle
-                        else:
-                            self.bulkcmd(f'amlmmc write {part_name} {hex(self.ADDR_TMP)} {hex(offset)} {hex(chunk_size)}', silent=True)
-                        offset += chunk_size
-                        if last_chunk:
-                            break
+                            self.write_part_chunk(part_name, offset, data, length)
+                        self.report_progress('restore', part_name, offset + length, part_size)
                     # self.bulkcmd('download get_status', silent=False)  #  get_status always fails
+            except OperationCancelled:
+                raise
             except Exception as ex:
                 # in the event of any failure while writing partitions,
-                #   force the entire script to exit to prevent further possible damage
-                print(f'Error while restoring partition {part_name}, {ex}')
-                print(traceback.format_exc())
-                sys.exit(1)
+                #   stop here to prevent further possible damage
+                raise TransferError(f'Error while restoring partition {part_name}, {ex}') from ex
+            if identity is not None:
+                self.catalog_record(identity, 'restore', part_name, infile, entry if hashes is None else hashes.entry())
+            if sibling_part is not None:
+                self.print(f'Uploaded {round(written["uploaded"] / 1024 / 1024)}MB of {round(part_size / 1024 / 1024)}MB, copied {round(written["sibling"] / 1024 / 1024)}MB from {sibling_part}, filled {round(written["filled"] / 1024 / 1024)}MB with zeros, {round(written["unchanged"] / 1024 / 1024)}MB was unchanged')
+            self.report_metrics('restore_partition', part_size, time.time() - start_time, part_name=part_name, chunk_size=chunk_size, erase_size=self.erase_size, erased=erased, erase_seconds=erase_time, **written)
+
+    def aligned_chunks(self, part_offset:int, length:int, chunk_size:int):
+        """ split a write of length bytes, from the start of a partition at part_offset (in sectors), into chunks of at most chunk_size
+                if chunk_size is at least one erase group, every chunk ends on an erase group boundary of the eMMC (except the last),
+                so apart from the ends, whole erase groups are written at once, and the eMMC never has to read-modify-write one
+            returns a list of tuples: offset within partition, length
+        """
+        start = part_offset * self.PART_SECTOR_SIZE
+        chunks = []
+        offset = 0
+        while offset < length:
+            end = offset + chunk_size
+            if chunk_size >= self.erase_size:
+                end -= (start + end) % self.erase_size
+            end = min(end, length)
+            chunks.append((offset, end - offset))
+            offset = end
+        return chunks
+
+    def erase_range(self, part_name:str, part_offset:int, offset:int, length:int):
+        """ erase the whole erase groups within a range of a partition at part_offset (in sectors), ERASE_BATCH per command
+                groups which are only partly within the range are left alone, they may hold data of the neighbouring partition
+            returns how many bytes were erased
+        """
+        start = part_offset * self.PART_SECTOR_SIZE
+        first = -(-(start + offset) // self.erase_size) * self.erase_size - start
+        end = (start + offset + length) // self.erase_size * self.erase_size - start
+        position = first
+        while position < end:
+            count = min(self.ERASE_BATCH, end - position)
+            self.bulkcmd(f'amlmmc erase {part_name} {hex(position)} {hex(count)}', silent=True)
+            position += count
+            self.check_cancel()
+        return max(0, end - first)
+
+    def image_plan(self):
+        """ Build the list of partitions to sweep for a raw eMMC image
+                only partitions with an alternate size (data) need a validate_partition_size probe,
+                the rest have a fixed size
+            returns a list of tuples: (partition name, offset within partition, length, offset within image)
+        """
+        plan = []
+        for part_name in image_partitions():
+            if 'size_alt' in self.PARTITIONS[part_name]:
+                (part_size, _part_offset) = self.validate_partition_size(part_name)
+                if part_size is None:
+                    raise PartitionError('Failed to validate partition size!')
+            else:
+                part_size = self.PARTITIONS[part_name]['size'] * self.PART_SECTOR_SIZE
+            offset = 0
+            if part_name == 'bootloader':
+                # bootloader data starts one sector after beginning of the partition, same as dump_partition
+                offset = self.PART_SECTOR_SIZE
+            plan.append((part_name, offset, part_size, partition_image_offset(part_name)))
+        return plan
+
+    def check_image(self, infile:str):
+        """ check that a raw eMMC image from dump_image matches the partitions of this unit, before anything is written
+                the image must be exactly the size dump_image would make here, an image from a unit with the other data partition size is not
+            returns the image_plan, raises PartitionError if it does not match
+        """
+        self.bulkcmd('amlmmc part 1', silent=True)
+        plan = self.image_plan()
+        if os.path.getsize(infile) != image_end(plan):
+            raise PartitionError(f'Image is {os.path.getsize(infile)} bytes, but a dump of this device is {image_end(plan)} bytes, is it from a unit with a different data partition size? {infile}')
+        return plan
+
+    def dump_image(self, outfile:str):
+        """ Dump the whole eMMC user area into one sparse raw image, in a single sequential sweep
+                partitions are read in on-disk order and written at their real offset within the image,
+                gaps between partitions, reserved and cache are left as holes
+        """
+        self.ensure_staging()
+        self.bulkcmd('amlmmc part 1', silent=True)
+        plan = self.image_plan()
+        total = sum(length for (_part_name, _offset, length, _image_offset) in plan)
+        chunk_size = self.READ_CHUNK_SIZE
+        try:
+            with open(outfile, 'wb') as ofl:
+                done = 0
+                start_time = time.time()
+                self.print(f'dumping image: {round(total / 1024 / 1024)}MB in {len(plan)} partitions into file: {outfile}')
+                for (part_name, part_start, length, image_offset) in plan:
+                    ofl.seek(image_offset)
+                    offset = 0
+                    while offset < length:
+                        this_chunk = min(chunk_size, length - offset)
+                        ofl.write(self.read_part_chunk(part_name, part_start + offset, this_chunk))
+                        offset += this_chunk
+                        done += this_chunk
+                        self.report_progress('dump_image', part_name, done, total)
+                # extend to full size, leaving a hole for anything we did not write at the end
+                #   the size is exact for this unit, so restore_image can tell an image from a unit with a different data partition
+                ofl.truncate(image_end(plan))
+        except OperationCancelled:
+            raise
+        except Exception as ex:
+            # in the event of any failure while reading partitions, stop here
+            raise TransferError(f'Error while dumping image, {ex}') from ex
+        self.report_metrics('dump_image', total, time.time() - start_time)
+
+    def restore_image(self, infile:str, skip_partitions:list=None):
+        """ Restore partitions from a raw eMMC image made by dump_image, in a single sequential sweep
+                follows the same rules as restoring a device from a folder:
+                the env partition is imported as text (do that separately), and bootloader is written last
+        """
+        self.ensure_staging()
+        skip_partitions = ['env'] + (skip_partitions or [])
+        plan = [entry for entry in self.check_image(infile) if entry[0] not in skip_partitions]
+        # always do bootloader last
+        plan.sort(key=lambda entry: entry[0] == 'bootloader')
+        for index, (part_name, _part_start, length, image_offset) in enumerate(plan):
+            if part_name == 'bootloader':
+                # the dumped bootloader data gets written from the beginning of the partition, and only its first 2MB, same as restore_partition
+                plan[index] = (part_name, 0, 2 * 1024 * 1024, image_offset)
+        total = sum(length for (_part_name, _offset, length, _image_offset) in plan)
+        self.catalog_forget([part_name for (part_name, _offset, _length, _image_offset) in plan])
+        chunk_size = self.WRITE_CHUNK_SIZE
+        try:
+            with map_file(infile) as image_data:
+                done = 0
+                start_time = time.time()
+                self.print(f'writing image: {round(total / 1024 / 1024)}MB in {len(plan)} partitions from file: {infile}')
+                for (part_name, part_start, length, image_offset) in plan:
+                    offset = 0
+                    # 2MB and lower (bootloader) is sent as one chunk, same as restore_partition
+                    part_chunk = length if length <= self.TRANSFER_SIZE_THRESHOLD else chunk_size
+                    while offset < length:
+                        this_chunk = min(part_chunk, length - offset)
+                        data = image_data[image_offset + offset:image_offset + offset + this_chunk]
+                        self.write_part_chunk(part_name, part_start + offset, data, this_chunk)
+                        offset += this_chunk
+                        done += this_chunk
+                        self.report_progress('restore_image', part_name, done, total)
+        except OperationCancelled:
+            raise
+        except Exception as ex:
+            # in the event of any failure while writing partitions,
+            #   stop here to prevent further possible damage
+            raise TransferError(f'Error while restoring image, {ex}') from ex
+        self.report_metrics('restore_image', total, time.time() - start_time)
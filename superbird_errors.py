@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Exceptions raised by SuperbirdDevice and friends
+
+Everything derives from SuperbirdError, so a program driving devices can catch that,
+and superbird_tool turns it into a message and exit status 1.
+This module has no dependencies, so it can be imported without pyusb or pyamlboot installed.
+"""
+
+
+class SuperbirdError(Exception):
+    """
+    Base class for every error raised by the device layer
+    """
+
+
+class DeviceNotFoundError(SuperbirdError):
+    """
+    No device in the mode we need
+    """
+
+
+class DeviceAccessError(SuperbirdError):
+    """
+    Found a device, but we are not allowed to talk to it (usually need to run as root)
+    """
+
+
+class PyamlbootVersionError(SuperbirdError):
+    """
+    Installed pyamlboot is too old
+    """
+
+
+class BulkcmdException(SuperbirdError):
+    """
+    A bulkcmd failed, kept under this name so existing code which catches it still works
+    """
+
+
+class BulkcmdTimeoutError(BulkcmdException):
+    """
+    A bulkcmd did not answer in time, the device is probably in a strange state
+    """
+
+
+class BurnModeError(SuperbirdError):
+    """
+    Could not get the device into USB Burn Mode
+    """
+
+
+class PreflightError(SuperbirdError, ValueError):
+    """
+    A dump folder cannot be restored, found before writing anything to the device
+    """
+
+
+class PartitionError(SuperbirdError, ValueError):
+    """
+    Invalid partition name, or its size could not be validated
+    """
+
+
+class TransferError(SuperbirdError):
+    """
+    Reading or writing a partition failed part way, the original exception is in __cause__
+    """
+
+
+class OperationCancelled(SuperbirdError):
+    """
+    The cancel event was set while an operation was running
+    """
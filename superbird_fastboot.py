@@ -0,0 +1,301 @@
+#!/usr/bin/env python3
+"""
+Fastboot transport, for faster restores
+
+u-boot on the device includes a fastboot command. Fastboot download moves data into RAM using large bulk transfers,
+instead of the small blocks used by writeLargeMemory, and fastboot flash then writes it to mmc.
+Partitions are sent as a series of sparse images, each one carrying a single piece of the partition,
+with the rest marked as "don't care", so a partition can be larger than the download buffer,
+and pieces which are all zeros are sent as a fill instead of as data.
+
+FastbootStandIn speaks the device side of the protocol, at the same level as the pyusb endpoints,
+so that FastbootDevice can be exercised without hardware.
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import time
+import struct
+
+from superbird_errors import SuperbirdError
+from superbird_writer import open_dump, dump_size
+
+FASTBOOT_INTERFACE = (0xFF, 0x42, 0x03)  # class, subclass, protocol of a fastboot interface
+FASTBOOT_TIMEOUT = 10  # seconds, how long to wait for the device to show up in fastboot
+FASTBOOT_PIECE_SIZE = 16 * 1024 * 1024  # 16MB, largest piece of a partition sent in one download
+USB_TIMEOUT = 5000  # ms, for each bulk transfer
+USB_TRANSFER_SIZE = 1024 * 1024  # 1MB, largest single bulk transfer
+RESPONSE_SIZE = 64  # bytes, fastboot responses (and commands) are at most 64 bytes
+
+SPARSE_MAGIC = 0xED26FF3A
+SPARSE_BLOCK_SIZE = 4096
+SPARSE_HEADER = struct.Struct('<IHHHHIIII')  # magic, major, minor, file header size, chunk header size, block size, total blocks, total chunks, checksum
+SPARSE_CHUNK_HEADER = struct.Struct('<HHII')  # type, reserved, size in blocks, total size in bytes (including this header)
+CHUNK_TYPE_RAW = 0xCAC1
+CHUNK_TYPE_FILL = 0xCAC2
+CHUNK_TYPE_DONT_CARE = 0xCAC3
+# largest overhead of a sparse image from sparse_piece: file header, and up to three chunk headers, plus a fill value
+SPARSE_OVERHEAD = SPARSE_HEADER.size + 3 * SPARSE_CHUNK_HEADER.size + 4
+
+
+class FastbootError(SuperbirdError):
+    """
+    The device answered FAIL, or something unexpected
+    """
+
+
+def sparse_piece(data, offset:int, total_size:int, block_size:int=SPARSE_BLOCK_SIZE):
+    """ build a sparse image which writes data at offset, and leaves the rest of a total_size partition alone
+            offset must be a multiple of block_size, data is zero-padded up to a whole block
+        returns a list of buffers, so that data itself never gets copied
+    """
+    if offset % block_size:
+        raise ValueError(f'Sparse piece offset {hex(offset)} is not a multiple of {block_size}')
+    total_blocks = -(-total_size // block_size)
+    start_block = offset // block_size
+    data_blocks = -(-len(data) // block_size)
+    end_blocks = total_blocks - start_block - data_blocks
+    if end_blocks < 0:
+        raise ValueError(f'Sparse piece {hex(offset)}+{hex(len(data))} does not fit in {hex(total_size)}')
+    chunks = []
+    if start_block:
+        chunks.append([SPARSE_CHUNK_HEADER.pack(CHUNK_TYPE_DONT_CARE, 0, start_block, SPARSE_CHUNK_HEADER.size)])
+    if data.count(0) == len(data):
+        chunks.append([SPARSE_CHUNK_HEADER.pack(CHUNK_TYPE_FILL, 0, data_blocks, SPARSE_CHUNK_HEADER.size + 4), bytes(4)])
+    else:
+        padding = bytes(data_blocks * block_size - len(data))
+        chunks.append([SPARSE_CHUNK_HEADER.pack(CHUNK_TYPE_RAW, 0, data_blocks, SPARSE_CHUNK_HEADER.size + data_blocks * block_size), data, padding])
+    if end_blocks:
+        chunks.append([SPARSE_CHUNK_HEADER.pack(CHUNK_TYPE_DONT_CARE, 0, end_blocks, SPARSE_CHUNK_HEADER.size)])
+    buffers = [SPARSE_HEADER.pack(SPARSE_MAGIC, 1, 0, SPARSE_HEADER.size, SPARSE_CHUNK_HEADER.size, block_size, total_blocks, len(chunks), 0)]
+    for chunk in chunks:
+        buffers.extend(buffer for buffer in chunk if len(buffer))
+    return buffers
+
+
+def apply_sparse(image:bytes, target:bytearray):
+    """ write a sparse image into target, the way fastboot flash would """
+    (magic, _major, _minor, header_size, chunk_header_size, block_size, _total_blocks, total_chunks, _checksum) = SPARSE_HEADER.unpack_from(image, 0)
+    if magic != SPARSE_MAGIC:
+        raise FastbootError('not a sparse image')
+    position = header_size
+    block = 0
+    for _chunk in range(total_chunks):
+        (chunk_type, _reserved, chunk_blocks, chunk_bytes) = SPARSE_CHUNK_HEADER.unpack_from(image, position)
+        body = image[position + chunk_header_size:position + chunk_bytes]
+        start = block * block_size
+        end = min(len(target), start + chunk_blocks * block_size)
+        if chunk_type == CHUNK_TYPE_RAW:
+            target[start:end] = body[:end - start]
+        elif chunk_type == CHUNK_TYPE_FILL:
+            target[start:end] = body[:4] * ((end - start) // 4)
+        elif chunk_type != CHUNK_TYPE_DONT_CARE:
+            raise FastbootError(f'unknown sparse chunk type: {hex(chunk_type)}')
+        block += chunk_blocks
+        position += chunk_bytes
+
+
+class UsbTransport:
+    """ bulk endpoints of a fastboot interface, using pyusb """
+    def __init__(self, device, interface, ep_in, ep_out):
+        self.device = device
+        self.interface = interface
+        self.ep_in = ep_in
+        self.ep_out = ep_out
+
+    @classmethod
+    def find(cls, timeout:float=FASTBOOT_TIMEOUT):
+        """ wait for a device with a fastboot interface to show up, and claim it """
+        # imported here, so that FastbootDevice and FastbootStandIn work without pyusb
+        import usb.core
+        import usb.util
+
+        def fastboot_interface(device):
+            for config in device:
+                for interface in config:
+                    if (interface.bInterfaceClass, interface.bInterfaceSubClass, interface.bInterfaceProtocol) == FASTBOOT_INTERFACE:
+                        return interface
+            return None
+
+        deadline = time.monotonic() + timeout
+        while True:
+            device = usb.core.find(custom_match=lambda found: fastboot_interface(found) is not None)
+            if device is not None:
+                break
+            if time.monotonic() >= deadline:
+                raise FastbootError('Timed out waiting for device to show up in fastboot')
+            time.sleep(0.05)
+        interface = fastboot_interface(device)
+        ep_in = usb.util.find_descriptor(interface, custom_match=lambda ep: usb.util.endpoint_direction(ep.bEndpointAddress) == usb.util.ENDPOINT_IN)
+        ep_out = usb.util.find_descriptor(interface, custom_match=lambda ep: usb.util.endpoint_direction(ep.bEndpointAddress) == usb.util.ENDPOINT_OUT)
+        usb.util.claim_interface(device, interface.bInterfaceNumber)
+        return cls(device, interface, ep_in, ep_out)
+
+    def write(self, data):
+        """ one bulk OUT transfer """
+        self.ep_out.write(data, USB_TIMEOUT)
+
+    def read(self, size:int=RESPONSE_SIZE) -> bytes:
+        """ one bulk IN transfer """
+        return bytes(self.ep_in.read(size, USB_TIMEOUT))
+
+    def close(self):
+        """ release the interface """
+        import usb.util
+        usb.util.release_interface(self.device, self.interface.bInterfaceNumber)
+        usb.util.dispose_resources(self.device)
+
+
+class FastbootStandIn:
+    """ stand-in for a device in fastboot, with the same write/read interface as UsbTransport
+            partitions is a dict of name: bytearray, which flash writes into
+            every command received is recorded in commands
+    """
+    def __init__(self, partitions:dict, max_download_size:int=32 * 1024 * 1024):
+        self.partitions = partitions
+        self.max_download_size = max_download_size
+        self.commands = []
+        self.continued = False
+        self._responses = []
+        self._download = None
+        self._expected = 0
+
+    def write(self, data):
+        if self._expected:
+            self._download += bytes(data)
+            if len(self._download) > self._expected:
+                raise FastbootError('received more data than requested')
+            if len(self._download) == self._expected:
+                self._expected = 0
+                self._responses.append(b'OKAY')
+            return
+        command = bytes(data).decode('ascii')
+        self.commands.append(command)
+        if len(data) > RESPONSE_SIZE:
+            self._responses.append(b'FAILcommand too long')
+        elif command.startswith('getvar:'):
+            value = {'max-download-size': f'0x{self.max_download_size:08x}', 'product': 'superbird'}.get(command[7:], '')
+            self._responses.append(f'OKAY{value}'.encode('ascii'))
+        elif command.startswith('download:'):
+            size = int(command[9:], 16)
+            if size > self.max_download_size:
+                self._responses.append(b'FAILdata too large')
+            else:
+                self._download = bytearray()
+                self._expected = size
+                self._responses.append(f'DATA{size:08x}'.encode('ascii'))
+        elif command.startswith('flash:'):
+            name = command[6:]
+            if name not in self.partitions:
+                self._responses.append(b'FAILpartition does not exist')
+            else:
+                self._responses.append(b'INFOwriting')
+                apply_sparse(bytes(self._download), self.partitions[name])
+                self._responses.append(b'OKAY')
+        elif command == 'continue':
+            self.continued = True
+            self._responses.append(b'OKAY')
+        elif command.startswith('oem '):
+            self._responses.append(b'OKAY')
+        else:
+            self._responses.append(b'FAILunknown command')
+
+    def read(self, size:int=RESPONSE_SIZE) -> bytes:
+        if not self._responses:
+            raise FastbootError('stand-in has nothing to send (read timed out)')
+        return self._responses.pop(0)[:size]
+
+    def close(self):
+        pass
+
+
+class FastbootDevice:
+    """ fastboot protocol, over a transport with write(data) and read(size) (UsbTransport or FastbootStandIn) """
+    def __init__(self, transport, log=None):
+        """ log(message) gets every message, instead of printing it to console, SuperbirdDevice passes its own print """
+        self.transport = transport
+        self.log = log
+
+    def print(self, message:str):
+        """ print a message to console, or hand it to log if given, same as SuperbirdDevice.print """
+        if self.log is not None:
+            self.log(message)
+            return
+        print(message, flush=True)
+
+    def command(self, command:str) -> str:
+        """ send a command, and wait for the final response
+            returns the text after OKAY (or the size after DATA, as hex)
+        """
+        if len(command) > RESPONSE_SIZE:
+            raise FastbootError(f'fastboot command too long: {command}')
+        self.transport.write(command.encode('ascii'))
+        return self.response()
+
+    def response(self) -> str:
+        """ read responses until OKAY, FAIL or DATA, printing any INFO along the way """
+        while True:
+            response = self.transport.read(RESPONSE_SIZE).decode('ascii', errors='replace')
+            (status, message) = (response[:4], response[4:])
+            if status == 'INFO':
+                self.print(f'  fastboot: {message}')
+            elif status in ('OKAY', 'DATA'):
+                return message
+            elif status == 'FAIL':
+                raise FastbootError(f'fastboot failed: {message}')
+            else:
+                raise FastbootError(f'unexpected fastboot response: {response}')
+
+    def getvar(self, name:str) -> str:
+        """ get a fastboot variable """
+        return self.command(f'getvar:{name}')
+
+    def max_download_size(self) -> int:
+        """ size of the download buffer on the device """
+        try:
+            return int(self.getvar('max-download-size'), 0)
+        except (FastbootError, ValueError):
+            return FASTBOOT_PIECE_SIZE + SPARSE_OVERHEAD
+
+    def download(self, buffers:list):
+        """ send data into the download buffer on the device, given as a list of buffers (sent without joining them) """
+        total = sum(len(buffer) for buffer in buffers)
+        size = int(self.command(f'download:{total:08x}'), 16)
+        if size != total:
+            raise FastbootError(f'device asked for {size} bytes, instead of {total}')
+        for buffer in buffers:
+            view = memoryview(buffer)
+            for start in range(0, len(view), USB_TRANSFER_SIZE):
+                self.transport.write(view[start:start + USB_TRANSFER_SIZE])
+        self.response()
+
+    def flash(self, part_name:str):
+        """ write what is in the download buffer to a partition """
+        self.command(f'flash:{part_name}')
+
+    def oem(self, command:str) -> str:
+        """ run an oem command """
+        return self.command(f'oem {command}')
+
+    def continue_boot(self):
+        """ leave fastboot """
+        self.command('continue')
+
+    def flash_file(self, part_name:str, infile:str, part_size:int):
+        """ write a file to a partition, one sparse piece at a time, infile can be gzipped """
+        file_size = dump_size(infile)
+        if file_size > part_size:
+            raise ValueError(f'File is larger than target partition: {file_size} vs {part_size}')
+        piece_size = min(FASTBOOT_PIECE_SIZE, self.max_download_size() - SPARSE_OVERHEAD)
+        piece_size -= piece_size % SPARSE_BLOCK_SIZE
+        start_time = time.monotonic()
+        with open_dump(infile) as ifl:
+            offset = 0
+            while offset < file_size:
+                data = ifl.read(piece_size)
+                self.download(sparse_piece(data, offset, part_size))
+                self.flash(part_name)
+                offset += len(data)
+        elapsed = time.monotonic() - start_time
+        speed = round(file_size / elapsed / 1024 / 1024, 2) if elapsed > 0 else 0
+        self.print(f'flashed partition: "{part_name}" from file: {infile} ({round(file_size / 1024 / 1024)}MB at {speed}MB/s)')
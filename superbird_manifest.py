@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Manifest sidecar for a folder of partition dumps
+
+manifest.json records, for each dump file: size, sha256, crc32, and crc32 of every MANIFEST_CHUNK_SIZE chunk
+"""
+# pylint: disable=line-too-long
+
+import os
+import json
+
+MANIFEST_NAME = 'manifest.json'
+MANIFEST_VERSION = 1
+MANIFEST_CHUNK_SIZE = 1024 * 1024  # 1MB, granularity of per-chunk crc32
+
+
+def manifest_path(folder:str) -> str:
+    """ path to the manifest within a dump folder """
+    return os.path.join(folder, MANIFEST_NAME)
+
+
+def load_manifest(folder:str) -> dict:
+    """ load the manifest from a dump folder, or return an empty one if there is none """
+    try:
+        with open(manifest_path(folder), 'r', encoding='utf-8') as mff:
+            manifest = json.load(mff)
+    except FileNotFoundError:
+        manifest = {}
+    manifest.setdefault('version', MANIFEST_VERSION)
+    manifest.setdefault('chunk_size', MANIFEST_CHUNK_SIZE)
+    manifest.setdefault('files', {})
+    return manifest
+
+
+def update_manifest(folder:str, entries:dict):
+    """ merge entries (keyed by file name) into the manifest of a dump folder
+            fields already present for a file, but not in the new entry, are kept
+    """
+    manifest = load_manifest(folder)
+    for name, entry in entries.items():
+        manifest['files'].setdefault(name, {}).update(entry)
+    tmp_path = manifest_path(folder) + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as mff:
+        json.dump(manifest, mff, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path(folder))
+    return manifest
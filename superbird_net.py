@@ -0,0 +1,356 @@
+#!/usr/bin/env python3
+"""
+USB networking (RNDIS) data path, for dumping and restoring a device which is booted up with the USB Gadget enabled
+
+scripts/usb-gadget gives the device a fixed address of 192.168.7.2, and a static busybox.
+Each partition is split into ranges, and each range is moved over its own TCP connection:
+on the device, busybox dd reads or writes /dev/mmcblk0 at the partition's real offset, through busybox nc listening on a port,
+and we connect to it. Every range is then checked against an md5sum calculated on the device.
+Dump files are the same as from SuperbirdDevice.dump_partition, and restore reads the same files as restore_partition.
+
+Restoring a partition which is mounted on the running device will corrupt it,
+so boot with --boot_adb_kernel (which runs from RAM) before restoring system, data or settings.
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import time
+import socket
+import hashlib
+import threading
+import subprocess
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+
+from superbird_partitions import SUPERBIRD_PARTITIONS, SECTOR_SIZE, DUMP_FILE_NAMES, partition_image_offset
+from superbird_errors import SuperbirdError
+from superbird_writer import dump_size, decompressed
+
+DEVICE_ADDRESS = '192.168.7.2'
+MMC_DEVICE = '/dev/mmcblk0'
+MMC_SYSFS = '/sys/block/mmcblk0/device'
+EMMC_GEOMETRY_FIELDS = ['name', 'cid', 'erase_size', 'preferred_erase_size']  # from MMC_SYSFS, sizes are in bytes
+BASE_PORT = 7700  # stream N listens on BASE_PORT + N
+NET_STREAMS = 4  # parallel TCP streams per partition
+CONNECT_TIMEOUT = 10  # seconds, how long to keep trying to connect while the device end starts up
+RECV_SIZE = 1024 * 1024
+HASH_SIZE = 1024 * 1024  # read at a time while hashing a range we sent
+RANGE_ALIGN = 1024 * 1024  # ranges are split on 1MB boundaries
+NET_SKIP_PARTITIONS = ['reserved', 'cache']
+
+
+class NetTransferError(SuperbirdError):
+    """
+    A stream failed, or a checksum did not match
+    """
+
+
+def partition_range(part_name:str, disk_size:int=None):
+    """ byte offset and length of a partition within the whole eMMC, matching what dump_partition reads
+            data has an alternate size, which is used if the normal size does not fit on the disk
+        returns a tuple of: offset, length
+    """
+    if part_name not in SUPERBIRD_PARTITIONS or part_name in NET_SKIP_PARTITIONS:
+        raise ValueError(f'Cannot read or write partition: "{part_name}"')
+    part = SUPERBIRD_PARTITIONS[part_name]
+    offset = partition_image_offset(part_name)
+    length = part['size'] * SECTOR_SIZE
+    if 'size_alt' in part and disk_size is not None and offset + length > disk_size:
+        length = part['size_alt'] * SECTOR_SIZE
+    return (offset, length)
+
+
+def split_ranges(offset:int, length:int, streams:int):
+    """ split a region into up to streams ranges, on RANGE_ALIGN boundaries
+        returns a list of (offset, length)
+    """
+    per_stream = -(-length // streams)
+    per_stream = max(RANGE_ALIGN, -(-per_stream // RANGE_ALIGN) * RANGE_ALIGN)
+    ranges = []
+    position = offset
+    while position < offset + length:
+        count = min(per_stream, offset + length - position)
+        ranges.append((position, count))
+        position += count
+    return ranges
+
+
+def dd_block_size(offset:int) -> int:
+    """ largest dd block size (up to 1MB) which offset is a multiple of """
+    block_size = 1024 * 1024
+    while block_size > 1 and offset % block_size:
+        block_size //= 2
+    return block_size
+
+
+def dd_read_command(offset:int, length:int) -> str:
+    """ shell command which writes exactly length bytes of MMC_DEVICE, starting at offset, to stdout """
+    block_size = dd_block_size(offset)
+    count = -(-length // block_size)
+    command = f'busybox dd if={MMC_DEVICE} bs={block_size} skip={offset // block_size} count={count} 2>/dev/null'
+    if count * block_size != length:
+        command += f' | busybox head -c {length}'
+    return command
+
+
+class DeviceEnd(ABC):
+    """ interface for the device end of a transfer
+            host is the address to connect to
+            serve_read and serve_write start listening on port before they return, and return an object with wait()
+    """
+    host = DEVICE_ADDRESS
+
+    @abstractmethod
+    def disk_size(self) -> int:
+        """ size of the whole eMMC, in bytes """
+        raise NotImplementedError
+
+    @abstractmethod
+    def serve_read(self, offset:int, length:int, port:int):
+        """ send a range of the eMMC to whoever connects to port """
+        raise NotImplementedError
+
+    @abstractmethod
+    def serve_write(self, offset:int, port:int):
+        """ write whatever is received on port to the eMMC, starting at offset """
+        raise NotImplementedError
+
+    @abstractmethod
+    def md5(self, offset:int, length:int) -> str:
+        """ md5 of a range of the eMMC, as hex """
+        raise NotImplementedError
+
+    @abstractmethod
+    def sync(self):
+        """ flush writes to the eMMC """
+        raise NotImplementedError
+
+    @abstractmethod
+    def emmc_geometry(self) -> dict:
+        """ identity and erase group size of the eMMC, as the kernel sees it, keyed by EMMC_GEOMETRY_FIELDS """
+        raise NotImplementedError
+
+
+class AdbProcess:
+    """ a command running on the device through adb shell """
+    def __init__(self, command:list):
+        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def wait(self):
+        """ wait for it to finish, raise NetTransferError if it failed """
+        (_stdout, stderr) = self.process.communicate()
+        if self.process.returncode != 0:
+            raise NetTransferError(f'device command failed: {stderr.decode("utf-8", errors="replace").strip()}')
+
+
+class AdbDeviceEnd(DeviceEnd):
+    """ the real device, with commands run using adb shell """
+    def __init__(self, adb:str='adb', host:str=DEVICE_ADDRESS):
+        self.adb = adb
+        self.host = host
+
+    def shell(self, command:str) -> str:
+        """ run a command on the device, and return its output """
+        result = subprocess.run([self.adb, 'shell', command], capture_output=True, check=True)
+        return result.stdout.decode('utf-8', errors='replace')
+
+    def start(self, command:str) -> AdbProcess:
+        """ start a command on the device, without waiting for it
+                nc needs a moment to start listening, connect() keeps retrying until it does
+        """
+        return AdbProcess([self.adb, 'shell', command])
+
+    def disk_size(self) -> int:
+        return int(self.shell(f'busybox blockdev --getsize64 {MMC_DEVICE}').strip())
+
+    def serve_read(self, offset:int, length:int, port:int):
+        return self.start(f'{dd_read_command(offset, length)} | busybox nc -l -p {port}')
+
+    def serve_write(self, offset:int, port:int):
+        block_size = dd_block_size(offset)
+        return self.start(f'busybox nc -l -p {port} | busybox dd of={MMC_DEVICE} bs={block_size} seek={offset // block_size} 2>/dev/null')
+
+    def md5(self, offset:int, length:int) -> str:
+        return self.shell(f'{dd_read_command(offset, length)} | busybox md5sum').split()[0]
+
+    def sync(self):
+        self.shell('sync')
+
+    def emmc_geometry(self) -> dict:
+        lines = self.shell(' '.join(['cat'] + [f'{MMC_SYSFS}/{field}' for field in EMMC_GEOMETRY_FIELDS])).split()
+        if len(lines) != len(EMMC_GEOMETRY_FIELDS):
+            raise NetTransferError(f'Could not read eMMC geometry from {MMC_SYSFS}: {lines}')
+        geometry = dict(zip(EMMC_GEOMETRY_FIELDS, lines))
+        geometry['erase_size'] = int(geometry['erase_size'])
+        geometry['preferred_erase_size'] = int(geometry['preferred_erase_size'])
+        return geometry
+
+
+class LoopbackServer:
+    """ one stream of LoopbackDeviceEnd, served from a thread """
+    def __init__(self, target, port:int):
+        self.error = None
+        self.listener = socket.create_server(('127.0.0.1', port))
+        self.thread = threading.Thread(target=self.run, args=(target,), daemon=True)
+        self.thread.start()
+
+    def run(self, target):
+        try:
+            (conn, _address) = self.listener.accept()
+            with conn:
+                target(conn)
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self.listener.close()
+
+    def wait(self):
+        """ wait for the stream to finish, raise NetTransferError if it failed """
+        self.thread.join()
+        if self.error is not None:
+            raise NetTransferError(f'loopback stream failed: {self.error}')
+
+
+class LoopbackDeviceEnd(DeviceEnd):
+    """ stand-in for the device end, serving disk (a bytearray standing in for the whole eMMC) on 127.0.0.1 """
+    host = '127.0.0.1'
+
+    def __init__(self, disk:bytearray):
+        self.disk = disk
+
+    def disk_size(self) -> int:
+        return len(self.disk)
+
+    def serve_read(self, offset:int, length:int, port:int):
+        def send(conn):
+            conn.sendall(memoryview(self.disk)[offset:offset + length])
+        return LoopbackServer(send, port)
+
+    def serve_write(self, offset:int, port:int):
+        def receive(conn):
+            position = offset
+            while True:
+                data = conn.recv(RECV_SIZE)
+                if not data:
+                    break
+                self.disk[position:position + len(data)] = data
+                position += len(data)
+        return LoopbackServer(receive, port)
+
+    def md5(self, offset:int, length:int) -> str:
+        return hashlib.md5(memoryview(self.disk)[offset:offset + length]).hexdigest()
+
+    def sync(self):
+        pass
+
+    def emmc_geometry(self) -> dict:
+        return {'name': 'loopback', 'cid': '0' * 32, 'erase_size': 512 * 1024, 'preferred_erase_size': 512 * 1024}
+
+
+def connect(host:str, port:int, timeout:float=CONNECT_TIMEOUT) -> socket.socket:
+    """ connect to the device end, retrying until it is listening """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return socket.create_connection((host, port), timeout=timeout)
+        except OSError:
+            if time.monotonic() >= deadline:
+                raise
+            time.sleep(0.05)
+
+
+def receive_range(device_end:DeviceEnd, outfile:str, part_offset:int, offset:int, length:int, port:int):
+    """ receive one range into a file, at its offset within the partition, and check it
+            each stream opens the file itself, so they do not share a file position
+    """
+    server = device_end.serve_read(offset, length, port)
+    md5 = hashlib.md5()
+    received = 0
+    with open(outfile, 'r+b') as ofl, connect(device_end.host, port) as sock:
+        ofl.seek(offset - part_offset)
+        buffer = bytearray(RECV_SIZE)
+        view = memoryview(buffer)
+        while received < length:
+            count = sock.recv_into(view, min(RECV_SIZE, length - received))
+            if count == 0:
+                break
+            ofl.write(view[:count])
+            md5.update(view[:count])
+            received += count
+    server.wait()
+    if received != length:
+        raise NetTransferError(f'stream on port {port} ended after {received} of {length} bytes')
+    if md5.hexdigest() != device_end.md5(offset, length):
+        raise NetTransferError(f'checksum mismatch for range {hex(offset)}+{hex(length)}')
+
+
+def send_range(device_end:DeviceEnd, infile:str, part_offset:int, offset:int, length:int, port:int):
+    """ send one range of a file, at its offset within the partition, and check it
+            each stream opens the file itself, since sendfile moves the file position
+    """
+    server = device_end.serve_write(offset, port)
+    with open(infile, 'rb') as ifl:
+        with connect(device_end.host, port) as sock:
+            sock.sendfile(ifl, offset - part_offset, length)
+            sock.shutdown(socket.SHUT_WR)
+            # wait for the device end to close, so we know everything was written
+            sock.recv(1)
+        # hashed a piece at a time, a range can be hundreds of MB
+        md5 = hashlib.md5()
+        ifl.seek(offset - part_offset)
+        remaining = length
+        while remaining > 0:
+            data = ifl.read(min(HASH_SIZE, remaining))
+            if not data:
+                break
+            md5.update(data)
+            remaining -= len(data)
+    server.wait()
+    if md5.hexdigest() != device_end.md5(offset, length):
+        raise NetTransferError(f'checksum mismatch for range {hex(offset)}+{hex(length)}')
+
+
+def net_dump_partition(device_end:DeviceEnd, part_name:str, outfile:str, streams:int=NET_STREAMS):
+    """ dump a partition to a file over the network, using parallel streams """
+    (offset, length) = partition_range(part_name, device_end.disk_size())
+    print(f'dumping partition: "{part_name}" over usbnet into file: {outfile}, using {streams} streams')
+    start_time = time.monotonic()
+    with open(outfile, 'wb') as ofl:
+        ofl.truncate(length)
+    with ThreadPoolExecutor(max_workers=streams) as executor:
+        futures = [executor.submit(receive_range, device_end, outfile, offset, start, count, BASE_PORT + index)
+                   for index, (start, count) in enumerate(split_ranges(offset, length, streams))]
+        for future in futures:
+            future.result()
+    elapsed = time.monotonic() - start_time
+    print(f'dumped partition: "{part_name}" {round(length / 1024 / 1024)}MB in {round(elapsed, 2)}s')
+
+
+def net_restore_partition(device_end:DeviceEnd, part_name:str, infile:str, streams:int=NET_STREAMS):
+    """ restore a partition from a file over the network, using parallel streams
+            a .gz dump is decompressed to a temporary file first, since each stream sends its own range of it
+    """
+    if part_name == 'bootloader':
+        raise ValueError('bootloader can only be restored in USB Burn Mode')
+    (offset, length) = partition_range(part_name, device_end.disk_size())
+    file_size = dump_size(infile)
+    if file_size > length:
+        raise ValueError(f'File is larger than target partition: {file_size} vs {length}')
+    print(f'restoring partition: "{part_name}" over usbnet from file: {infile}, using {streams} streams')
+    start_time = time.monotonic()
+    with decompressed(infile) as plain_file, ThreadPoolExecutor(max_workers=streams) as executor:
+        futures = [executor.submit(send_range, device_end, plain_file, offset, start, count, BASE_PORT + index)
+                   for index, (start, count) in enumerate(split_ranges(offset, file_size, streams))]
+        for future in futures:
+            future.result()
+    device_end.sync()
+    elapsed = time.monotonic() - start_time
+    print(f'restored partition: "{part_name}" {round(file_size / 1024 / 1024)}MB in {round(elapsed, 2)}s')
+
+
+def net_dump_device(device_end:DeviceEnd, folder:str, streams:int=NET_STREAMS):
+    """ dump every partition into a folder over the network, with the same file names as dump_device """
+    os.makedirs(folder, exist_ok=True)
+    for part_name, file_name in DUMP_FILE_NAMES.items():
+        net_dump_partition(device_end, part_name, os.path.join(folder, file_name), streams)
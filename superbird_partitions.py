@@ -4,10 +4,12 @@ Partitions for superbird, extracted from output of: bulkcmd 'amlmmc part 1'
 """
 # pylint: disable=line-too-long
 
+import os
+
 # TODO we have an alternate size for data partition, but is the offset always the same?
 
-# offset is in bytes
-# size is in 512-byte sectors
+# offset and size are both in 512-byte sectors
+#   (compare against the kernel boot log below, where they are in bytes)
 
 SUPERBIRD_PARTITIONS = {
     'bootloader': {
@@ -85,6 +87,73 @@ SUPERBIRD_PARTITIONS = {
     },
 }
 
+SECTOR_SIZE = 512  # bytes, size of sectors used in partition table
+
+# file names used for each partition in a dump folder, see --dump_device and --restore_device
+DUMP_FILE_NAMES = {
+    'bootloader': 'bootloader.dump',
+    'env': 'env.dump',
+    'fip_a': 'fip_a.dump',
+    'fip_b': 'fip_b.dump',
+    'logo': 'logo.dump',
+    'dtbo_a': 'dtbo_a.dump',
+    'dtbo_b': 'dtbo_b.dump',
+    'vbmeta_a': 'vbmeta_a.dump',
+    'vbmeta_b': 'vbmeta_b.dump',
+    'boot_a': 'boot_a.dump',
+    'boot_b': 'boot_b.dump',
+    'misc': 'misc.dump',
+    'settings': 'settings.ext4',
+    'system_a': 'system_a.ext2',
+    'system_b': 'system_b.ext2',
+    'data': 'data.ext4',
+}
+
+# partitions which are never read or written when sweeping the whole eMMC
+#   reserved cannot be read or written, and cache is zero-length
+IMAGE_SKIP_PARTITIONS = ['reserved', 'cache']
+
+
+def partition_image_offset(part_name:str) -> int:
+    """ byte offset of a partition's data within a raw eMMC image
+        bootloader dumps start one sector after the beginning of the partition, see SuperbirdDevice.dump_partition
+    """
+    offset = SUPERBIRD_PARTITIONS[part_name]['offset'] * SECTOR_SIZE
+    if part_name == 'bootloader':
+        offset += SECTOR_SIZE
+    return offset
+
+
+def dump_file_path(folder:str, part_name:str) -> str:
+    """ path of the dump file of a partition in a dump folder, the gzipped one (see --compress) if only that exists """
+    path = os.path.join(folder, DUMP_FILE_NAMES[part_name])
+    if not os.path.isfile(path) and os.path.isfile(f'{path}.gz'):
+        return f'{path}.gz'
+    return path
+
+
+def sibling_partition(part_name:str):
+    """ name of the other A/B slot of a partition, or None if it does not have one """
+    if part_name[-2:] not in ['_a', '_b']:
+        return None
+    sibling = part_name[:-1] + ('b' if part_name.endswith('_a') else 'a')
+    if SUPERBIRD_PARTITIONS.get(sibling, {}).get('size') != SUPERBIRD_PARTITIONS.get(part_name, {}).get('size'):
+        return None
+    return sibling
+
+
+def image_partitions() -> list:
+    """ names of partitions included in a raw eMMC image, in on-disk order """
+    names = sorted(SUPERBIRD_PARTITIONS, key=lambda name: SUPERBIRD_PARTITIONS[name]['offset'])
+    return [name for name in names if name not in IMAGE_SKIP_PARTITIONS]
+
+
+def image_end(plan:list) -> int:
+    """ size in bytes of a raw eMMC image, the end of the last partition in plan (see SuperbirdDevice.image_plan)
+            the data partition comes in two sizes, so this depends on the unit the plan was made for
+    """
+    return max(image_offset + length for (_part_name, _offset, length, image_offset) in plan)
+
 
 # output of: bulkcmd 'amlmmc part 1'
 
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Host-side checks and planning for --restore_device, done while the device is still entering USB Burn Mode
+
+check_restore_folder is quick (file names and sizes only), and runs before the device is touched, so a bad folder is rejected right away.
+RestorePreflight does everything that reads the dump files in a background thread: env crc checks (and env.dump to env.txt),
+zero scans of data and settings, and hashing for the catalog. By the time the device is ready, the write plan usually is too.
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import threading
+
+from uboot_env import read_environ, parse_env_text, format_env_text, build_environ
+from superbird_partitions import SUPERBIRD_PARTITIONS, SECTOR_SIZE, DUMP_FILE_NAMES, dump_file_path
+from superbird_manifest import load_manifest
+from superbird_writer import open_dump, dump_size
+from superbird_errors import PreflightError
+
+# partitions --restore_device always writes, in order; data and settings are added after them if they are not empty
+RESTORE_PARTITIONS = [
+    'fip_a', 'fip_b', 'logo', 'dtbo_a', 'dtbo_b', 'vbmeta_a', 'vbmeta_b', 'boot_a', 'boot_b', 'misc', 'system_a', 'system_b',
+]
+# restored only if present and not empty, otherwise the device is factory reset at first boot instead
+OPTIONAL_PARTITIONS = ['data', 'settings']
+
+
+def test_if_empty(path:str):
+    """ test if a dump file is actually all zeros (dumped a wiped filesystem)
+            A true stock image has the data and settings partitions erased, and they get formatted at first boot
+            if this dump is from stock, then we can save time by just erasing those partitions
+        uses the manifest, if one was written alongside the dump, otherwise scans the file
+    """
+    manifest = load_manifest(os.path.dirname(path) or '.')
+    entry = manifest['files'].get(os.path.basename(path), {})
+    if 'empty' in entry and entry.get('size') == dump_size(path):
+        return entry['empty']
+    from superbird_analyze import file_is_empty
+    return file_is_empty(path)
+
+
+def check_restore_folder(folder:str):
+    """ check a dump folder has every file --restore_device needs, and that each fits its partition
+            only looks at names and sizes, so it is quick
+            raises PreflightError listing every problem found
+    """
+    problems = []
+    for part_name in RESTORE_PARTITIONS + OPTIONAL_PARTITIONS + ['bootloader']:
+        path = dump_file_path(folder, part_name)
+        if not os.path.isfile(path):
+            if part_name in RESTORE_PARTITIONS:
+                problems.append(f'missing expected dump file: {path}')
+            continue
+        part = SUPERBIRD_PARTITIONS[part_name]
+        # bootloader dumps are often zero-padded, restore_partition only writes the start of them
+        if part_name != 'bootloader' and dump_size(path) > max(part['size'], part.get('size_alt', 0)) * SECTOR_SIZE:
+            problems.append(f'dump file is larger than partition {part_name}: {path}')
+    env_txt = os.path.join(folder, 'env.txt')
+    env_dump = os.path.join(folder, DUMP_FILE_NAMES['env'])
+    if not os.path.isfile(env_txt) and not os.path.isfile(env_dump):
+        problems.append(f'missing expected dump file: {env_dump}')
+    if problems:
+        raise PreflightError('\n'.join([f'Cannot restore from {folder}:'] + [f'  {problem}' for problem in problems]))
+
+
+class RestorePreflight:
+    """ builds the write plan for --restore_device in a background thread
+            call check_restore_folder first, then create this, then result() once the device is ready
+    """
+    def __init__(self, folder:str, dont_reset:bool=False, hash_files:bool=False):
+        """ dont_reset keeps firstboot at 0 when data or settings are not restored
+            with hash_files, every file is hashed for the catalog (unless the manifest already has it), see SuperbirdDevice.restore_partition
+        """
+        self.folder = folder
+        self.dont_reset = dont_reset
+        self.hash_files = hash_files
+        self.plan = None
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='preflight', daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """ background thread, keeps any error for result() to raise """
+        try:
+            self.plan = self.build_plan()
+        except Exception as ex:
+            self.error = ex
+
+    def result(self) -> dict:
+        """ wait for the plan, raises PreflightError if the folder cannot be restored
+            the plan is a dict:
+                env_file: env.txt to send
+                partitions: list of (part_name, path, entry) in the order to write them, entry is the hashes of the file or None
+                bootloader: path of bootloader.dump, or None if there is none
+                firstboot: '0' or '1' if data or settings are not restored, and the device should factory reset (or not), otherwise None
+                messages: what was found along the way, to print
+        """
+        self.thread.join()
+        if self.error is not None:
+            if isinstance(self.error, PreflightError):
+                raise self.error
+            raise PreflightError(f'Cannot restore from {self.folder}: {self.error}') from self.error
+        return self.plan
+
+    def build_plan(self) -> dict:
+        """ read the dump files, and decide what to write """
+        messages = []
+        manifest = load_manifest(self.folder)
+        # we use the .txt instead of .dump because sometimes the partition size does not line up perfectly
+        #   also probably the safer way to interact with env partition
+        #   if txt version does not exist, we create it for you
+        env_file = os.path.join(self.folder, 'env.txt')
+        if not os.path.isfile(env_file):
+            env_dump = os.path.join(self.folder, DUMP_FILE_NAMES['env'])
+            messages.append(f'Converting partition dump: {env_dump} to textfile: {env_file}')
+            (environ, _length, crc_ok) = read_environ(env_dump)
+            if not crc_ok:
+                messages.append(f'Warning: env crc does not match in {env_dump}, u-boot would ignore this env and use its defaults')
+            with open(env_file, 'w', encoding='utf-8') as oef:
+                oef.write(format_env_text(environ))
+        with open(env_file, 'r', encoding='utf-8') as ief:
+            environ = parse_env_text(ief.read())
+        # raises ValueError if it does not fit the env partition
+        build_environ(environ)
+        partitions = [(part_name, dump_file_path(self.folder, part_name)) for part_name in RESTORE_PARTITIONS]
+        firstboot = None
+        for part_name in OPTIONAL_PARTITIONS:
+            path = dump_file_path(self.folder, part_name)
+            if os.path.exists(path) and not test_if_empty(path):
+                partitions.append((part_name, path))
+            else:
+                messages.append(f'did not find {path}, or it is empty, factory resetting instead')
+                firstboot = '0' if self.dont_reset else '1'
+        bootloader = dump_file_path(self.folder, 'bootloader')
+        if not os.path.isfile(bootloader):
+            messages.append(f'did not find {bootloader}, not restoring bootloader')
+            bootloader = None
+        return {
+            'env_file': env_file,
+            'partitions': [(part_name, path, self.file_entry(manifest, path)) for (part_name, path) in partitions],
+            'bootloader': bootloader,
+            'firstboot': firstboot,
+            'messages': messages,
+        }
+
+    def file_entry(self, manifest:dict, path:str):
+        """ hashes of a dump file for the catalog: from the manifest if it is up to date, otherwise calculated here
+            returns None without hash_files
+        """
+        if not self.hash_files:
+            return None
+        entry = manifest['files'].get(os.path.basename(path), {})
+        if all(key in entry for key in ['sha256', 'crc32', 'chunk_crc32']) and entry.get('size') == dump_size(path):
+            return entry
+        from superbird_writer import FileHashes
+        hashes = FileHashes()
+        with open_dump(path) as dmf:
+            while True:
+                chunk = dmf.read(hashes.chunk_size)
+                if not chunk:
+                    break
+                hashes.update(chunk)
+        return hashes.entry()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+Progress display for dumps and restores, decoupled from the transfer loop
+
+SuperbirdDevice reports progress through a callback after every chunk, which only records the latest numbers.
+A background thread redraws at a fixed rate (RENDER_RATE), so the transfer loop never waits on the console.
+    text: one line, redrawn in place
+    json: one JSON object per line (events: progress, log, metrics), for dashboards and log collectors
+          superbird_tool replaces sys.stdout with a LogStream, so every other message becomes a log event too
+    none: no progress, messages are still printed
+"""
+# pylint: disable=line-too-long,broad-except
+
+import sys
+import json
+import time
+import threading
+
+PROGRESS_MODES = ['text', 'json', 'none']
+RENDER_RATE = 5  # redraws per second
+
+
+class ProgressRenderer:
+    """ renders progress reported by SuperbirdDevice
+            pass update, log and metrics to SuperbirdDevice as its progress, log and metrics callbacks,
+            and call close() when done
+    """
+    def __init__(self, mode:str='text', stream=None, rate:float=RENDER_RATE):
+        if mode not in PROGRESS_MODES:
+            raise ValueError(f'Invalid progress mode: {mode}, must be one of: {", ".join(PROGRESS_MODES)}')
+        self.mode = mode
+        self.stream = stream or sys.stdout
+        self.interval = 1 / rate
+        self.lock = threading.Lock()
+        self.state = None  # (operation, target, done, total) of the running operation
+        self.start = None  # (time, done) of the first report of the running operation, speed is measured from there
+        self.dirty = False  # state changed since it was last drawn
+        self.line_length = 0  # length of the progress line on screen, in text mode
+        self.stopped = threading.Event()
+        self.thread = None
+        if mode != 'none':
+            self.thread = threading.Thread(target=self.run, name='progress', daemon=True)
+            self.thread.start()
+
+    def update(self, operation:str, target:str, done:int, total:int):
+        """ progress callback, only records the numbers, unless the operation just finished """
+        if self.mode == 'none':
+            return
+        with self.lock:
+            if self.state is None or self.state[:2] != (operation, target):
+                self.end_line()
+                self.start = (time.monotonic(), done)
+            self.state = (operation, target, done, total)
+            self.dirty = True
+            if done >= total:
+                # always show the final numbers, instead of whatever was drawn last
+                self.draw()
+                self.end_line()
+                self.state = None
+
+    def log(self, message:str):
+        """ log callback, prints a message without garbling the progress line """
+        with self.lock:
+            if self.mode == 'json':
+                self.write_event({'event': 'log', 'message': message})
+                return
+            self.clear_line()
+            self.stream.write(f'{message}\n')
+            self.stream.flush()
+            # progress line gets drawn again on the next tick
+            self.dirty = self.state is not None
+
+    def metrics(self, name:str, values:dict):
+        """ metrics callback, shows a summary when an operation finishes """
+        if self.mode == 'json':
+            with self.lock:
+                self.write_event({'event': 'metrics', 'name': name, **values})
+        elif self.mode == 'text':
+            label = f'{name} "{values["part_name"]}"' if 'part_name' in values else name
+            self.log(f'{label}: {round(values["bytes"] / 1024 / 1024)}MB in {round(values["seconds"], 2)}s ({round(values["bytes_per_second"] / 1024 / 1024, 2)}MB/s)')
+
+    def run(self):
+        """ background thread, draws at most once per interval, and only if something changed """
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                if self.dirty:
+                    self.draw()
+
+    def draw(self):
+        """ draw the current state, must hold lock """
+        self.dirty = False
+        if self.state is None:
+            return
+        (operation, target, done, total) = self.state
+        elapsed = time.monotonic() - self.start[0]
+        speed = (done - self.start[1]) / elapsed if elapsed > 0 else 0
+        if self.mode == 'json':
+            self.write_event({'event': 'progress', 'operation': operation, 'target': target, 'done': done, 'total': total, 'elapsed': round(elapsed, 3), 'bytes_per_second': round(speed)})
+            return
+        percent = round(done / total * 100) if total else 100
+        line = f'{operation} "{target}": {percent}% | {round(done / 1024 / 1024)}MB / {round(total / 1024 / 1024)}MB | speed: {round(speed / 1024 / 1024, 2)}MB/s'
+        if speed > 0 and done < total:
+            line += f' | eta: {round((total - done) / speed)}s'
+        # pad with spaces instead of using ANSI escapes, so this works on every console
+        self.stream.write('\r' + line.ljust(self.line_length))
+        self.stream.flush()
+        self.line_length = len(line)
+
+    def clear_line(self):
+        """ blank out the progress line, must hold lock """
+        if self.line_length:
+            self.stream.write('\r' + ' ' * self.line_length + '\r')
+            self.line_length = 0
+
+    def end_line(self):
+        """ leave the progress line on screen, and move past it, must hold lock """
+        if self.line_length:
+            self.stream.write('\n')
+            self.stream.flush()
+            self.line_length = 0
+
+    def write_event(self, event:dict):
+        """ write one JSON line, must hold lock """
+        self.stream.write(json.dumps(event) + '\n')
+        self.stream.flush()
+
+    def close(self):
+        """ stop the background thread, and draw whatever is left """
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+        with self.lock:
+            if self.dirty:
+                self.draw()
+            self.end_line()
+
+
+class LogStream:
+    """ file-like object which sends each line written to it to ProgressRenderer.log
+            used as sys.stdout in json mode, so that print() anywhere (and in pyamlboot) cannot break up the JSON lines
+            lines are collected per thread, since print() writes the text and the newline separately
+    """
+    def __init__(self, renderer:ProgressRenderer):
+        self.renderer = renderer
+        self.pending = threading.local()
+
+    def write(self, text:str) -> int:
+        """ log every complete line, and keep the rest until the next write """
+        buffered = getattr(self.pending, 'text', '') + text
+        *lines, self.pending.text = buffered.split('\n')
+        for line in lines:
+            self.renderer.log(line)
+        return len(text)
+
+    def flush(self):
+        """ nothing to do, lines are logged as soon as they are complete """
+
+    def isatty(self) -> bool:
+        """ never a terminal, so nothing tries to draw on it """
+        return False
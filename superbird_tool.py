@@ -10,16 +10,21 @@ import argparse
 import os
 import shutil
 import platform
-import tempfile
+import traceback
 
 from pathlib import Path
 
-from uboot_env import read_environ
+from uboot_env import read_environ, parse_environ, write_environ, diff_environ, parse_env_text, format_env_text
 
-from superbird_device import SuperbirdDevice
-from superbird_device import find_device, check_device_mode, enter_burn_mode
+from superbird_partitions import SUPERBIRD_PARTITIONS, SECTOR_SIZE, partition_image_offset, sibling_partition, dump_file_path
+from superbird_errors import SuperbirdError, TransferError
+from superbird_preflight import test_if_empty, check_restore_folder, RestorePreflight
+from superbird_progress import ProgressRenderer, LogStream, PROGRESS_MODES
 
-VERSION = '0.2.0'
+# superbird_device (pyusb, pyamlboot) and the other heavier modules are imported only when a command needs them,
+#   so that commands which do not touch the device start up quickly
+
+VERSION = '0.3.0'
 
 # this method chosen specifically because it works correctly when bundled using nuitka --onefile
 IMAGES_PATH = Path(os.path.dirname(__file__)).joinpath('images')
@@ -28,30 +33,82 @@ IMAGES_PATH = Path(os.path.dirname(__file__)).joinpath('images')
 def convert_env_dump(env_dump:str, env_file:str):
     """ convert a dumped env partition image into a human-readable text file """
     print(f'Converting partition dump: {env_dump} to textfile: {env_file}')
-    (environ, _length, _crc) = read_environ(env_dump)
+    (environ, _length, crc_ok) = read_environ(env_dump)
+    if not crc_ok:
+        print(f'Warning: env crc does not match in {env_dump}, u-boot would ignore this env and use its defaults')
     with open(env_file, 'w', encoding='utf-8') as oef:
-        lines = []
-        for key, value in environ.items():
-            lines.append(f'{key}={value}\n')
-        oef.writelines(lines)
-
-def test_if_empty(part):
-    # test if partiton is actually all zeros (dumped a wiped filesystem)
-    #   A true stock image has the data and settings partitions erased, and they get formatted at first boot
-    #   if this dump is from stock, then we can save time by just erasing those partitions
-    TEST_CHUNK = None
-    with open(f'{FOLDER_NAME}/{part}', 'rb') as daf:
-        # read the first 1024KB
-        TEST_CHUNK = daf.read(1024 * 1024)
-    try:
-        DECODED_CHUNK = TEST_CHUNK.decode('ascii').strip('\x00')
-        return DECODED_CHUNK
-    except Exception:
-        # since it is not really ascii, decoding will only work if all the
-        # bytes are within the appropriate range for ascii
-        # however, if it fails to decode, then it is definitely NOT all zeroed out
-        DECODED_CHUNK = '42' # just needs to not be empty
-        return DECODED_CHUNK
+        oef.write(format_env_text(environ))
+
+def convert_env_txt(env_file:str, env_dump:str):
+    """ convert a human-readable env text file into a binary env image, with correct crc """
+    print(f'Converting textfile: {env_file} to env image: {env_dump}')
+    with open(env_file, 'r', encoding='utf-8') as ief:
+        environ = parse_env_text(ief.read())
+    used = write_environ(env_dump, environ)
+    print(f'Wrote {len(environ)} variables, {used} bytes used')
+
+def load_env(env_file:str):
+    """ load an env from either env.txt format, or a binary env dump """
+    with open(env_file, 'rb') as lef:
+        is_text = b'\x00' not in lef.read(4096)
+    if is_text:
+        with open(env_file, 'r', encoding='utf-8') as lef:
+            return parse_env_text(lef.read())
+    (environ, _length, _crc_ok) = read_environ(env_file)
+    return environ
+
+def print_env_diff(old_file:str, new_file:str):
+    """ print the differences between two envs, each either env.txt format or a binary env dump """
+    (added, changed, removed) = diff_environ(load_env(old_file), load_env(new_file))
+    for key, value in added.items():
+        print(f'+ {key}={value}')
+    for key, value in changed.items():
+        print(f'~ {key}={value}')
+    for key in removed:
+        print(f'- {key}')
+    print(f'{len(added)} added, {len(changed)} changed, {len(removed)} removed')
+
+def print_env_sync(result:tuple):
+    """ print a summary of what SuperbirdDevice.sync_env changed """
+    (added, changed, removed) = result
+    if not (added or changed or removed):
+        print('env already up to date')
+    else:
+        print(f'env updated: {len(added)} added, {len(changed)} changed, {len(removed)} removed')
+
+def image_region_is_empty(image_file:str, part_name:str):
+    """ test if a partition within a raw eMMC image is empty: either a hole, or all zeros """
+    start = partition_image_offset(part_name)
+    part = SUPERBIRD_PARTITIONS[part_name]
+    end = start + max(part['size'], part.get('size_alt', 0)) * SECTOR_SIZE
+    with open(image_file, 'rb') as imf:
+        if hasattr(os, 'SEEK_DATA'):
+            # on filesystems which support it, skip straight past any holes
+            try:
+                start = os.lseek(imf.fileno(), start, os.SEEK_DATA)
+            except OSError:
+                # nothing but holes until the end of the file
+                return True
+            if start >= end:
+                return True
+        imf.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = imf.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            if chunk.count(0) != len(chunk):
+                return False
+            remaining -= len(chunk)
+    return True
+
+def image_env_text(image_file:str):
+    """ extract the env partition from a raw eMMC image, in env.txt format """
+    part_size = SUPERBIRD_PARTITIONS['env']['size'] * SECTOR_SIZE
+    with open(image_file, 'rb') as imf:
+        imf.seek(partition_image_offset('env'))
+        (environ, _length, _crc) = parse_environ(imf.read(part_size))
+    return format_env_text(environ)
 
 def rename_parts(folderpath):
     old_to_new_mapping = {'system_a.dump':"system_a.ext2",'system_b.dump':'system_b.ext2','settings.dump':'settings.ext4','data.dump':'data.ext4'}
@@ -62,101 +119,143 @@ def rename_parts(folderpath):
         except:
             continue
 
+# every command line option, in the order shown by --help
+#   device: True if the option needs the device, which means importing superbird_device (pyusb, pyamlboot)
+#   metavar: names of the values the option takes, none means it is a flag
+COMMANDS = [
+    {'section': 'General', 'flags': ['-h', '--help'], 'help': 'Show this help message and exit'},
+    {'section': 'General', 'flags': ['--find_device'], 'device': True, 'help': 'Find superbird device and show its current boot mode'},
+    {'section': 'General', 'flags': ['--burn_mode'], 'device': True, 'help': 'Enter USB Burn Mode (if currently in USB Mode)'},
+    {'section': 'General', 'flags': ['--continue_boot'], 'device': True, 'help': 'Continue booting normally (if currently in USB Burn Mode)'},
+    {'section': 'Booting', 'flags': ['--boot_adb_kernel'], 'device': True, 'metavar': ['BOOT_SLOT'], 'help': 'Boot a kernel with adb enabled on chosen slot (A or B)(not persistent)'},
+    {'section': 'Booting', 'flags': ['--persist_adb_kernel'], 'help': 'Keep the adb kernel in the other slot\'s boot partition (replacing it), so later boots load it from eMMC instead of uploading it. Use in combination with --boot_adb_kernel.'},
+    {'section': 'Booting', 'flags': ['--disable_avb2'], 'device': True, 'metavar': ['BOOT_SLOT'], 'help': 'Disable A/B booting, lock to chosen slot(A or B)'},
+    {'section': 'Booting', 'flags': ['--enable_burn_mode'], 'device': True, 'help': 'Enable USB Burn Mode at every boot (when connected to USB host)'},
+    {'section': 'Booting', 'flags': ['--enable_burn_mode_button'], 'device': True, 'help': 'Enable USB Burn Mode if preset button 4 is held while booting (when connected to USB host)'},
+    {'section': 'Booting', 'flags': ['--disable_burn_mode'], 'device': True, 'help': 'Disable USB Burn Mode'},
+    {'section': 'Booting', 'flags': ['--disable_charger_check'], 'device': True, 'help': 'Disable check for valid charger at boot'},
+    {'section': 'Booting', 'flags': ['--enable_charger_check'], 'device': True, 'help': 'Enable check for valid charger at boot'},
+    {'section': 'Restoring', 'flags': ['--restore_device'], 'device': True, 'metavar': ['INPUT_FOLDER'], 'help': 'Restore all partitions from a folder'},
+    {'section': 'Restoring', 'flags': ['--restore_partition'], 'device': True, 'metavar': ['PARTITION_NAME', 'INPUT_FILE'], 'help': 'Restore a partition from a dump file'},
+    {'section': 'Restoring', 'flags': ['--restore_range'], 'device': True, 'metavar': ['PARTITION_NAME', 'OFFSET', 'INPUT_FILE'], 'help': 'Write a file into a partition, starting at a byte offset'},
+    {'section': 'Restoring', 'flags': ['--restore_image'], 'device': True, 'metavar': ['INPUT_IMAGE'], 'help': 'Restore all partitions from a raw eMMC image, in one sweep'},
+    {'section': 'Restoring', 'flags': ['--build_bundle'], 'metavar': ['INPUT_FOLDER', 'BUNDLE'], 'help': 'Compile a dump folder into a flash bundle, for flashing many devices (no device needed)'},
+    {'section': 'Restoring', 'flags': ['--flash_bundle'], 'device': True, 'metavar': ['BUNDLE'], 'help': 'Restore all partitions from a flash bundle made by --build_bundle'},
+    {'section': 'Restoring', 'flags': ['--fastboot'], 'help': 'Write partitions using fastboot, which is faster. Use in combination with --restore_device or --restore_partition.'},
+    {'section': 'Restoring', 'flags': ['--dont_reset'], 'help': 'Don\'t factory reset when restoring device. Use in combination with restore commands.'},
+    {'section': 'Restoring', 'flags': ['--slow_burn'], 'help': 'Use a slower burning speed. Use this if restoring crashes mid-flash.'},
+    {'section': 'Restoring', 'flags': ['--slower_burn'], 'help': 'Use an even slower burning speed. Use this if --slow_burn doesn\'t work.'},
+    {'section': 'Restoring', 'flags': ['--reuse_slot'], 'help': 'Only upload chunks of an A/B partition which are not already on the device; chunks matching the other slot are copied on the device. Use in combination with --restore_device or --restore_partition.'},
+    # hidden until its speed has been measured on hardware, see scripts/benchmark-restore.sh
+    {'section': 'Restoring', 'flags': ['--pre_erase'], 'hidden': True, 'help': 'Erase each partition before writing it. Use in combination with --restore_device or --restore_partition.'},
+    {'section': 'Dumping', 'flags': ['--dump_device'], 'device': True, 'metavar': ['OUTPUT_FOLDER'], 'help': 'Dump all partitions to a folder'},
+    {'section': 'Dumping', 'flags': ['--dump_partition'], 'device': True, 'metavar': ['PARTITION_NAME', 'OUTPUT_FILE'], 'help': 'Dump a partition to a file'},
+    {'section': 'Dumping', 'flags': ['--dump_range'], 'device': True, 'metavar': ['PARTITION_NAME', 'OFFSET', 'LENGTH', 'OUTPUT_FILE'], 'help': 'Dump a byte range of a partition to a file'},
+    {'section': 'Dumping', 'flags': ['--dump_image'], 'device': True, 'metavar': ['OUTPUT_IMAGE'], 'help': 'Dump the whole eMMC into a sparse raw image, in one sweep'},
+    {'section': 'Dumping', 'flags': ['--compress'], 'help': 'Gzip dump files (except env). Use in combination with --dump_device.'},
+    {'section': 'U-Boot Enviroment', 'flags': ['--get_env'], 'device': True, 'metavar': ['ENV_TXT'], 'help': 'Dump device env partition, and convert it to env.txt format'},
+    {'section': 'U-Boot Enviroment', 'flags': ['--send_env'], 'device': True, 'metavar': ['ENV_TXT'], 'help': 'Import contents of given env.txt file (without wiping)'},
+    {'section': 'U-Boot Enviroment', 'flags': ['--send_full_env'], 'device': True, 'metavar': ['ENV_TXT'], 'help': 'Wipe env, then import contents of given env.txt file'},
+    {'section': 'U-Boot Enviroment', 'flags': ['--restore_stock_env'], 'device': True, 'help': 'Wipe env, then restore default env values from stock_env.txt'},
+    {'section': 'U-Boot Enviroment', 'flags': ['--convert_env_dump'], 'metavar': ['ENV_DUMP', 'OUTPUT_TXT'], 'help': 'Convert a local dump of env partition into text format'},
+    {'section': 'U-Boot Enviroment', 'flags': ['--convert_env_txt'], 'metavar': ['ENV_TXT', 'OUTPUT_DUMP'], 'help': 'Convert an env.txt into a binary env image, with correct crc'},
+    {'section': 'U-Boot Enviroment', 'flags': ['--diff_env'], 'metavar': ['OLD_ENV', 'NEW_ENV'], 'help': 'Show differences between two envs (env.txt or env dump)'},
+    {'section': 'U-Boot Enviroment', 'flags': ['--analyze_dump'], 'metavar': ['INPUT_FOLDER'], 'help': 'Analyze a local dump folder (zeros, hashes, filesystems, env crc) into its manifest'},
+    {'section': 'Catalog', 'flags': ['--catalog'], 'metavar': ['FILE'], 'help': 'SQLite catalog of units and dumps, updated by every dump and restore (default ~/.superbird_catalog.db or $SUPERBIRD_CATALOG, none to disable)'},
+    {'section': 'Catalog', 'flags': ['--catalog_add'], 'metavar': ['INPUT_FOLDER'], 'help': 'Add an existing dump folder to the catalog, using its manifest'},
+    {'section': 'Catalog', 'flags': ['--catalog_devices'], 'help': 'List units in the catalog, and which dump each partition matched when last dumped or restored'},
+    {'section': 'Catalog', 'flags': ['--catalog_match'], 'metavar': ['DEVICE_ID'], 'help': 'Rank dump folders by how much of them differs from a unit, closest first'},
+    {'section': 'Catalog', 'flags': ['--catalog_find'], 'metavar': ['PARTITION_NAME', 'HASH'], 'help': 'List units and dumps whose partition has the given sha256 or crc32'},
+    {'section': 'Catalog', 'flags': ['--device_id'], 'device': True, 'help': 'Show the catalog identity of the connected unit'},
+    {'section': 'Advanced', 'flags': ['--bulkcmd'], 'device': True, 'metavar': ['COMMAND'], 'help': 'Run a uboot command on the device'},
+    {'section': 'Advanced', 'flags': ['--bulkcmd_shell'], 'device': True, 'help': 'Open a pseudo-shell for sending uboot commands'},
+    {'section': 'Advanced', 'flags': ['--enable_uart_shell'], 'device': True, 'help': 'Enable Linux UART shell'},
+    {'section': 'Advanced', 'flags': ['--usbnet'], 'help': 'Dump or restore over USB networking, on a device booted with USB Gadget (adb and usbnet). Use in combination with --dump_device, --dump_partition or --restore_partition.'},
+    {'section': 'Advanced', 'flags': ['--emmc_geometry'], 'help': 'Read the eMMC erase group size through adb, and keep it in the catalog, so restores align writes to it'},
+    {'section': 'Advanced', 'flags': ['--net_streams'], 'metavar': ['STREAMS'], 'help': 'Number of parallel streams per partition with --usbnet (default 4)'},
+    {'section': 'Advanced', 'flags': ['--progress'], 'metavar': ['MODE'], 'choices': PROGRESS_MODES, 'help': 'How to show progress: text (default), json (one JSON object per line, for dashboards) or none'},
+]
+
+# renders progress of device operations, set up once we have a device
+PROGRESS = None
+
+def format_help():
+    """ build the help text from COMMANDS, laid out the same way argparse would """
+    lines = []
+    section = None
+    for command in COMMANDS:
+        if command.get('hidden'):
+            continue
+        if command['section'] != section:
+            if section is not None:
+                lines.append('')
+            section = command['section']
+            lines.append(f'{section}:')
+        invocation = ' '.join([', '.join(command['flags'])] + command.get('metavar', []))
+        if len(invocation) <= 20:
+            lines.append(f'  {invocation:<20}  {command["help"]}')
+        else:
+            lines.append(f'  {invocation}')
+            lines.append(f'{"":<24}{command["help"]}')
+    return '\n'.join(lines) + '\n'
+
+def build_argument_parser():
+    """ build an argparse parser from COMMANDS """
+    parser = argparse.ArgumentParser(
+        description='Options cannot be combined; do one thing at a time :)',
+        add_help=False
+    )
+    for command in COMMANDS:
+        # longest flag first, so argparse uses it as dest (--help, not -h)
+        flags = sorted(command['flags'], key=len, reverse=True)
+        if 'metavar' in command:
+            parser.add_argument(*flags, action='store', type=str, nargs=len(command['metavar']), metavar=tuple(command['metavar']), choices=command.get('choices'), help=command['help'])
+        else:
+            parser.add_argument(*flags, action='store_true', help=argparse.SUPPRESS if command.get('hidden') else command['help'])
+    return parser
+
+def needs_device(args) -> bool:
+    """ check if any option given needs the device """
+    for command in COMMANDS:
+        if command.get('device') and getattr(args, max(command['flags'], key=len).lstrip('-')):
+            return True
+    return False
+
+def report_error(exc_type, exc_value, exc_traceback):
+    """ sys.excepthook, errors from the device layer are shown as a message instead of a traceback
+            the exit status is still 1, same as before SuperbirdDevice raised exceptions instead of exiting
+    """
+    if PROGRESS is not None:
+        PROGRESS.close()
+    if not issubclass(exc_type, SuperbirdError):
+        sys.__excepthook__(exc_type, exc_value, exc_traceback)
+        return
+    print(exc_value)
+    if isinstance(exc_value, TransferError) and exc_value.__cause__ is not None:
+        print(''.join(traceback.format_exception(type(exc_value.__cause__), exc_value.__cause__, exc_value.__cause__.__traceback__)))
+    sys.stdout.flush()
+
 if __name__ == '__main__':
+    sys.excepthook = report_error
+    argument_parser = build_argument_parser()
+    args = argument_parser.parse_args()
+    PROGRESS = ProgressRenderer(args.progress[0] if args.progress else 'text')
+    if PROGRESS.mode == 'json':
+        # every message becomes a log event, so that each line on stdout is one JSON object
+        sys.stdout = LogStream(PROGRESS)
     print(f'Spotify Car Thing (superbird) toolkit, v{VERSION}, by Thing Labs and Bishop Dynamics')
     print('     https://github.com/thinglabsoss/superbird-tool   ')
     print('     Forked from https://github.com/bishopdynamics/superbird-tool')
     print('')
-    argument_parser = argparse.ArgumentParser(
-        description='Options cannot be combined; do one thing at a time :)',
-        add_help=False
-    )
 
     def print_help():
-        print("""General:
-  -h, --help            Show this help message and exit
-  --find_device         Find superbird device and show its current boot mode
-  --burn_mode           Enter USB Burn Mode (if currently in USB Mode)
-  --continue_boot       Continue booting normally (if currently in USB Burn Mode)
-
-Booting:
-  --boot_adb_kernel BOOT_SLOT
-                        Boot a kernel with adb enabled on chosen slot (A or B)(not persistent)
-  --disable_avb2 BOOT_SLOT
-                        Disable A/B booting, lock to chosen slot(A or B)
-  --enable_burn_mode    Enable USB Burn Mode at every boot (when connected to USB host)
-  --enable_burn_mode_button
-                        Enable USB Burn Mode if preset button 4 is held while booting (when connected to USB host)
-  --disable_burn_mode   Disable USB Burn Mode
-  --disable_charger_check
-                        Disable check for valid charger at boot
-  --enable_charger_check
-                        Enable check for valid charger at boot
-
-Restoring:
-  --restore_device INPUT_FOLDER
-                        Restore all partitions from a folder
-  --restore_partition PARTITION_NAME INPUT_FILE
-                        Restore a partition from a dump file
-  --dont_reset          Don't factory reset when restoring device. Use in combination with restore commands.
-  --slow_burn           Use a slower burning speed. Use this if restoring crashes mid-flash.
-  --slower_burn         Use an even slower burning speed. Use this if --slow_burn doesn't work.
-
-Dumping:
-  --dump_device OUTPUT_FOLDER
-                        Dump all partitions to a folder
-  --dump_partition PARTITION_NAME OUTPUT_FILE
-                        Dump a partition to a file
-
-U-Boot Enviroment:
-  --get_env ENV_TXT     Dump device env partition, and convert it to env.txt format
-  --send_env ENV_TXT    Import contents of given env.txt file (without wiping)
-  --send_full_env ENV_TXT
-                        Wipe env, then import contents of given env.txt file
-  --restore_stock_env   Wipe env, then restore default env values from stock_env.txt
-  --convert_env_dump ENV_DUMP OUTPUT_TXT
-                        Convert a local dump of env partition into text format
-Advanced:
-  --bulkcmd COMMAND     Run a uboot command on the device
-  --bulkcmd_shell       Open a pseudo-shell for sending uboot commands
-  --enable_uart_shell   Enable Linux UART shell
-
-""")
-
-    argument_parser.add_argument('--find_device', action='store_true', help='find superbird device and show its current boot mode')
-    argument_parser.add_argument('--burn_mode', action='store_true', help='enter USB Burn Mode (if currently in USB Mode)')
-    argument_parser.add_argument('--continue_boot', action='store_true', help='continue booting normally (if currently in USB Burn Mode)')
-    argument_parser.add_argument('--bulkcmd', action='store', type=str, nargs=1, metavar=('COMMAND'), help='run a uboot command on the device')
-    argument_parser.add_argument('--bulkcmd_shell', action='store_true', help='Open a pseudo-shell for sending uboot commands')
-    argument_parser.add_argument('--boot_adb_kernel', action='store', type=str, nargs=1, metavar=('BOOT_SLOT'), help='boot a kernel with adb enabled on chosen slot (A or B)(not persistent)')
-    argument_parser.add_argument('--enable_uart_shell', action='store_true', help='Enable Linux UART shell')
-    argument_parser.add_argument('--disable_avb2', action='store', type=str, nargs=1, metavar=('BOOT_SLOT'), help='disable A/B booting, lock to chosen slot(A or B)')
-    argument_parser.add_argument('--enable_burn_mode', action='store_true', help='enable USB Burn Mode at every boot (when connected to USB host)')
-    argument_parser.add_argument('--enable_burn_mode_button', action='store_true', help='enable USB Burn Mode if preset button 4 is held while booting (when connected to USB host)')
-    argument_parser.add_argument('--disable_burn_mode', action='store_true', help='Disable USB Burn Mode at every boot (when connected to USB host)')
-    argument_parser.add_argument('--disable_charger_check', action='store_true', help='disable check for valid charger at boot')
-    argument_parser.add_argument('--enable_charger_check', action='store_true', help='enable check for valid charger at boot')
-    argument_parser.add_argument('--dump_device', action='store', type=str, nargs=1, metavar=('OUTPUT_FOLDER'), help='Dump all partitions to a folder')
-    argument_parser.add_argument('--restore_device', action='store', type=str, nargs=1, metavar=('INPUT_FOLDER'), help='Restore all partitions from a folder')
-    argument_parser.add_argument('--dont_reset', action='store_true', help='Don\'t factory reset when restoring device. This option does nothing on its own')
-    argument_parser.add_argument('--slow_burn', action='store_true', help='Use a slower burning speed. Use this if restoring crashes mid-flash.')
-    argument_parser.add_argument('--slower_burn', action='store_true', help='Use an even slower burning speed. Use this if --slow_burn doesn\'t work.')
-    argument_parser.add_argument('--dump_partition', action='store', type=str, nargs=2, metavar=('PARTITION_NAME', 'OUTPUT_FILE'), help='Dump a partition to a file')
-    argument_parser.add_argument('--restore_partition', action='store', type=str, nargs=2, metavar=('PARTITION_NAME', 'INPUT_FILE'), help='Restore a partition from a dump file')
-    argument_parser.add_argument('--restore_stock_env', action='store_true', help='wipe env, then restore default env values from stock_env.txt')
-    argument_parser.add_argument('--send_env', action='store', type=str, nargs=1, metavar=('ENV_TXT'), help='import contents of given env.txt file (without wiping)')
-    argument_parser.add_argument('--send_full_env', action='store', type=str, nargs=1, metavar=('ENV_TXT'), help='wipe env, then import contents of given env.txt file')
-    argument_parser.add_argument('--convert_env_dump', action='store', type=str, nargs=2, metavar=('ENV_DUMP', 'OUTPUT_TXT'), help='convert a local dump of env partition into text format')
-    argument_parser.add_argument('--get_env', action='store', type=str, nargs=1, metavar=('ENV_TXT'), help='dump device env partition, and convert it to env.txt format')
-    argument_parser.add_argument('--help', '-h', action='store_true', dest='help')
+        print(format_help())
 
     # Override the default help text
     if len(sys.argv) == 1:
         print_help()
         sys.exit(1)
 
-    args = argument_parser.parse_args()
-
     if len(sys.argv) <= 1:
         argument_parser.print_help()
         sys.exit()
@@ -169,25 +268,146 @@ Advanced:
     if args.help:
         print_help()
         sys.exit()
-    if args.find_device:
-        find_device()
-        sys.exit()
-    elif args.convert_env_dump:
+    if args.convert_env_dump:
         ENV_DUMP = args.convert_env_dump[0]
         ENV_FILE = args.convert_env_dump[1]
         convert_env_dump(ENV_DUMP, ENV_FILE)
         sys.exit()
+    elif args.convert_env_txt:
+        ENV_FILE = args.convert_env_txt[0]
+        ENV_DUMP = args.convert_env_txt[1]
+        convert_env_txt(ENV_FILE, ENV_DUMP)
+        sys.exit()
+    elif args.diff_env:
+        print_env_diff(args.diff_env[0], args.diff_env[1])
+        sys.exit()
+    elif args.analyze_dump:
+        FOLDER_NAME = args.analyze_dump[0]
+        START_TIME = time.time()
+        from superbird_analyze import analyze_folder, print_analysis
+        print_analysis(analyze_folder(FOLDER_NAME))
+        print(f'Analysis took: {str(time.time() - START_TIME)}')
+        sys.exit()
+    elif args.build_bundle:
+        FOLDER_NAME = args.build_bundle[0]
+        BUNDLE_NAME = args.build_bundle[1]
+        from superbird_bundle import build_bundle
+        # same files and decisions as --restore_device, made once here instead of on every device
+        rename_parts(FOLDER_NAME)
+        RESTORE_LIST = [
+            ('fip_a', 'fip_a.dump'), ('fip_b', 'fip_b.dump'), ('logo', 'logo.dump'), ('dtbo_a', 'dtbo_a.dump'), ('dtbo_b', 'dtbo_b.dump'),
+            ('vbmeta_a', 'vbmeta_a.dump'), ('vbmeta_b', 'vbmeta_b.dump'), ('boot_a', 'boot_a.dump'), ('boot_b', 'boot_b.dump'),
+            ('misc', 'misc.dump'), ('system_a', 'system_a.ext2'), ('system_b', 'system_b.ext2'), ('bootloader', 'bootloader.dump'),
+        ]
+        for (part_name, file_name) in RESTORE_LIST:
+            if not os.path.isfile(dump_file_path(FOLDER_NAME, part_name)):
+                print(f'Error: missing expected dump file: {FOLDER_NAME}/{file_name}')
+                sys.exit(1)
+        if not os.path.isfile(f'{FOLDER_NAME}/env.txt'):
+            if not os.path.isfile(f'{FOLDER_NAME}/env.dump'):
+                print(f'Error: missing expected dump file: {FOLDER_NAME}/env.dump')
+                sys.exit(1)
+            convert_env_dump(f'{FOLDER_NAME}/env.dump', f'{FOLDER_NAME}/env.txt')
+        ENVIRON = load_env(f'{FOLDER_NAME}/env.txt')
+        # data and settings go before bootloader, which is always last
+        for (part_name, file_name) in [('data', 'data.ext4'), ('settings', 'settings.ext4')]:
+            if os.path.exists(dump_file_path(FOLDER_NAME, part_name)) and not test_if_empty(dump_file_path(FOLDER_NAME, part_name)):
+                RESTORE_LIST.insert(-1, (part_name, file_name))
+            else:
+                print(f'did not find {FOLDER_NAME}/{file_name}, or it is empty, the bundle will factory reset instead')
+                ENVIRON['firstboot'] = '0' if args.dont_reset else '1'
+        build_bundle(BUNDLE_NAME, [(part_name, dump_file_path(FOLDER_NAME, part_name)) for (part_name, _file_name) in RESTORE_LIST], ENVIRON, source=FOLDER_NAME)
+        sys.exit()
+    elif args.catalog_add or args.catalog_devices or args.catalog_match or args.catalog_find:
+        from superbird_catalog import Catalog, catalog_path, print_devices, print_match, print_find
+        CATALOG_PATH = catalog_path(args.catalog[0] if args.catalog else None)
+        if CATALOG_PATH is None:
+            print('Catalog is disabled, give one with --catalog')
+            sys.exit(1)
+        CATALOG = Catalog(CATALOG_PATH)
+        if args.catalog_add:
+            FOLDER_NAME = args.catalog_add[0]
+            print(f'added {CATALOG.add_folder(FOLDER_NAME)} dump files from {FOLDER_NAME} to {CATALOG_PATH}')
+        elif args.catalog_devices:
+            print_devices(CATALOG.devices())
+        elif args.catalog_match:
+            DEVICE_ID = args.catalog_match[0]
+            print_match(DEVICE_ID, CATALOG.match(DEVICE_ID))
+        elif args.catalog_find:
+            print_find(*CATALOG.find(args.catalog_find[0], args.catalog_find[1]))
+        sys.exit()
+    elif args.emmc_geometry:
+        # bulkcmd cannot return output, so this needs the device booted up with adb
+        from superbird_net import AdbDeviceEnd
+        from superbird_catalog import Catalog, catalog_path
+        GEOMETRY = AdbDeviceEnd().emmc_geometry()
+        print(f'eMMC {GEOMETRY["name"]} ({GEOMETRY["cid"]}): erase group {GEOMETRY["erase_size"] // 1024}KB, preferred erase size {GEOMETRY["preferred_erase_size"] // 1024}KB')
+        CATALOG_PATH = catalog_path(args.catalog[0] if args.catalog else None)
+        if CATALOG_PATH is not None:
+            CATALOG = Catalog(CATALOG_PATH)
+            CATALOG.record_emmc(GEOMETRY)
+            print(f'recorded in {CATALOG_PATH}, restores will write in whole erase groups of {CATALOG.erase_size() // 1024}KB')
+        sys.exit()
+
+    if args.usbnet:
+        # the device is booted up, so this goes through adb and usbnet instead of USB Burn Mode
+        from superbird_net import AdbDeviceEnd, NET_STREAMS, net_dump_partition, net_restore_partition, net_dump_device
+        START_TIME = time.time()
+        DEVICE_END = AdbDeviceEnd()
+        NET_STREAM_COUNT = int(args.net_streams[0]) if args.net_streams else NET_STREAMS
+        if args.dump_partition:
+            net_dump_partition(DEVICE_END, args.dump_partition[0], args.dump_partition[1], NET_STREAM_COUNT)
+        elif args.restore_partition:
+            net_restore_partition(DEVICE_END, args.restore_partition[0], args.restore_partition[1], NET_STREAM_COUNT)
+        elif args.dump_device:
+            FOLDER_NAME = args.dump_device[0]
+            net_dump_device(DEVICE_END, FOLDER_NAME, NET_STREAM_COUNT)
+            convert_env_dump(f'{FOLDER_NAME}/env.dump', f'{FOLDER_NAME}/env.txt')
+            print('device dump complete')
+        else:
+            print('--usbnet can only be used with --dump_device, --dump_partition or --restore_partition')
+            sys.exit(1)
+        print(f'Transfer took: {str(time.time() - START_TIME)}')
+        sys.exit()
+
+    if not needs_device(args):
+        print_help()
+        sys.exit(1)
+
+    if args.restore_device:
+        # a bad folder is rejected before the device is touched,
+        #   and everything that reads the dump files runs in the background while the device enters USB Burn Mode
+        from superbird_catalog import catalog_path
+        rename_parts(args.restore_device[0])
+        check_restore_folder(args.restore_device[0])
+        # files are hashed for the catalog here, instead of while they are written
+        PREFLIGHT = RestorePreflight(args.restore_device[0], dont_reset=args.dont_reset, hash_files=catalog_path(args.catalog[0] if args.catalog else None) is not None)
 
     # Now get the device, and check options that need it
+    from superbird_device import SuperbirdDevice
+    from superbird_device import find_device, check_device_mode, enter_burn_mode, wait_for_device_mode, BURN_MODE_TIMEOUT
+    from superbird_writer import DumpPipeline
+    from superbird_catalog import Catalog, catalog_path
+
+    if args.find_device:
+        find_device()
+        sys.exit()
+
     START_TIME = time.time()
+    DEVICE_OPTIONS = {'log': PROGRESS.log, 'progress': PROGRESS.update, 'metrics': PROGRESS.metrics, 'pre_erase': args.pre_erase}
+    CATALOG_PATH = catalog_path(args.catalog[0] if args.catalog else None)
+    if CATALOG_PATH is not None:
+        # dumps and restores keep the catalog up to date
+        DEVICE_OPTIONS['catalog'] = Catalog(CATALOG_PATH)
+        DEVICE_OPTIONS['erase_size'] = DEVICE_OPTIONS['catalog'].erase_size()
     if args.slower_burn:
         print("Using slower burn speed")
-        dev = SuperbirdDevice(slowerBurn=True)
+        dev = SuperbirdDevice(slowerBurn=True, **DEVICE_OPTIONS)
     elif args.slow_burn:
         print("Using slow burn speed")
-        dev = SuperbirdDevice(slowBurn=True)
+        dev = SuperbirdDevice(slowBurn=True, **DEVICE_OPTIONS)
     else:
-        dev = SuperbirdDevice()
+        dev = SuperbirdDevice(**DEVICE_OPTIONS)
     
 
     if args.bulkcmd:
@@ -195,6 +415,10 @@ Advanced:
         if dev is not None:
             BULKCMD_STRING = args.bulkcmd[0]
             dev.bulkcmd(BULKCMD_STRING)
+    elif args.device_id:
+        dev = enter_burn_mode(dev)
+        if dev is not None:
+            print(f'device identity: {dev.device_identity()}')
     elif args.bulkcmd_shell:
         dev = enter_burn_mode(dev)
         if dev is not None:
@@ -220,7 +444,12 @@ Advanced:
                 FILE_ENV = str(IMAGES_PATH.joinpath('env_b.txt'))
             FILE_KERNEL = str(IMAGES_PATH.joinpath('superbird.kernel.img'))
             FILE_INITRD = str(IMAGES_PATH.joinpath('superbird.initrd.img'))
-            dev.boot(FILE_ENV, FILE_KERNEL, FILE_INITRD)
+            if args.persist_adb_kernel:
+                STORE_PART = 'boot_b' if SLOT.lower() == 'a' else 'boot_a'
+                print(f'Keeping adb kernel in {STORE_PART}, replacing the kernel of that slot')
+                dev.boot_stored(FILE_ENV, FILE_KERNEL, FILE_INITRD, STORE_PART)
+            else:
+                dev.boot(FILE_ENV, FILE_KERNEL, FILE_INITRD)
     elif args.enable_uart_shell:
         dev = enter_burn_mode(dev)
         if dev is not None:
@@ -313,8 +542,32 @@ Advanced:
         if dev is not None:
             PARTITION_NAME = args.restore_partition[0]
             INFILE = args.restore_partition[1]
-            dev.restore_partition(PARTITION_NAME, INFILE)
+            if args.fastboot and PARTITION_NAME != 'bootloader':
+                if not dev.restore_partitions_fastboot([(PARTITION_NAME, INFILE)]):
+                    print('Device did not return to USB Burn Mode after fastboot, replug it to continue')
+            elif args.reuse_slot:
+                dev.restore_partition(PARTITION_NAME, INFILE, sibling_part=sibling_partition(PARTITION_NAME))
+            else:
+                dev.restore_partition(PARTITION_NAME, INFILE)
             print(f'restored partition from {INFILE}')
+    elif args.dump_range:
+        dev = enter_burn_mode(dev)
+        if dev is not None:
+            PARTITION_NAME = args.dump_range[0]
+            # offsets and lengths can be given in decimal or hex
+            OFFSET = int(args.dump_range[1], 0)
+            LENGTH = int(args.dump_range[2], 0)
+            OUTFILE = args.dump_range[3]
+            dev.dump_range(PARTITION_NAME, OFFSET, LENGTH, OUTFILE)
+            print(f'dumped range to {OUTFILE}')
+    elif args.restore_range:
+        dev = enter_burn_mode(dev)
+        if dev is not None:
+            PARTITION_NAME = args.restore_range[0]
+            OFFSET = int(args.restore_range[1], 0)
+            INFILE = args.restore_range[2]
+            dev.restore_range(PARTITION_NAME, OFFSET, INFILE)
+            print(f'restored range from {INFILE}')
     elif args.dump_device:
         dev = enter_burn_mode(dev)
         if dev is not None:
@@ -322,86 +575,116 @@ Advanced:
             print(f'dumping entire device to {FOLDER_NAME}')
             shutil.rmtree(FOLDER_NAME, ignore_errors=True)
             os.mkdir(FOLDER_NAME)
-            dev.dump_partition('bootloader', f'{FOLDER_NAME}/bootloader.dump')
-            dev.dump_partition('env', f'{FOLDER_NAME}/env.dump')
-            # convert dumped env to txt version, for ease of access,
-            #   and so it is present when restoring later
-            convert_env_dump(f'{FOLDER_NAME}/env.dump', f'{FOLDER_NAME}/env.txt')
-            dev.dump_partition('fip_a', f'{FOLDER_NAME}/fip_a.dump')
-            dev.dump_partition('fip_b', f'{FOLDER_NAME}/fip_b.dump')
-            dev.dump_partition('logo', f'{FOLDER_NAME}/logo.dump')
-            dev.dump_partition('dtbo_a', f'{FOLDER_NAME}/dtbo_a.dump')
-            dev.dump_partition('dtbo_b', f'{FOLDER_NAME}/dtbo_b.dump')
-            dev.dump_partition('vbmeta_a', f'{FOLDER_NAME}/vbmeta_a.dump')
-            dev.dump_partition('vbmeta_b', f'{FOLDER_NAME}/vbmeta_b.dump')
-            dev.dump_partition('boot_a', f'{FOLDER_NAME}/boot_a.dump')
-            dev.dump_partition('boot_b', f'{FOLDER_NAME}/boot_b.dump')
-            dev.dump_partition('misc', f'{FOLDER_NAME}/misc.dump')
-            dev.dump_partition('settings', f'{FOLDER_NAME}/settings.ext4')
-            dev.dump_partition('system_a', f'{FOLDER_NAME}/system_a.ext2')
-            dev.dump_partition('system_b', f'{FOLDER_NAME}/system_b.ext2')
-            dev.dump_partition('data', f'{FOLDER_NAME}/data.ext4')
+            # file writes, hashing and compression happen in a background thread, while we keep the USB link busy
+            #   each B slot is compared against the A slot file as it was actually written (.gz with --compress)
+            PIPELINE = DumpPipeline(manifest_folder=FOLDER_NAME, compress=args.compress)
+            try:
+                dev.dump_partition('bootloader', f'{FOLDER_NAME}/bootloader.dump', pipeline=PIPELINE)
+                # convert dumped env to txt version, for ease of access,
+                #   and so it is present when restoring later
+                #   env is never compressed, and gets converted by the writer thread while we move on
+                dev.dump_partition('env', f'{FOLDER_NAME}/env.dump', pipeline=PIPELINE, compress=False, post_process=lambda env_dump: convert_env_dump(env_dump, f'{FOLDER_NAME}/env.txt'))
+                SIBLING_FILE = dev.dump_partition('fip_a', f'{FOLDER_NAME}/fip_a.dump', pipeline=PIPELINE)
+                dev.dump_partition('fip_b', f'{FOLDER_NAME}/fip_b.dump', sibling_file=SIBLING_FILE, pipeline=PIPELINE)
+                dev.dump_partition('logo', f'{FOLDER_NAME}/logo.dump', pipeline=PIPELINE)
+                SIBLING_FILE = dev.dump_partition('dtbo_a', f'{FOLDER_NAME}/dtbo_a.dump', pipeline=PIPELINE)
+                dev.dump_partition('dtbo_b', f'{FOLDER_NAME}/dtbo_b.dump', sibling_file=SIBLING_FILE, pipeline=PIPELINE)
+                SIBLING_FILE = dev.dump_partition('vbmeta_a', f'{FOLDER_NAME}/vbmeta_a.dump', pipeline=PIPELINE)
+                dev.dump_partition('vbmeta_b', f'{FOLDER_NAME}/vbmeta_b.dump', sibling_file=SIBLING_FILE, pipeline=PIPELINE)
+                SIBLING_FILE = dev.dump_partition('boot_a', f'{FOLDER_NAME}/boot_a.dump', pipeline=PIPELINE)
+                dev.dump_partition('boot_b', f'{FOLDER_NAME}/boot_b.dump', sibling_file=SIBLING_FILE, pipeline=PIPELINE)
+                dev.dump_partition('misc', f'{FOLDER_NAME}/misc.dump', pipeline=PIPELINE)
+                dev.dump_partition('settings', f'{FOLDER_NAME}/settings.ext4', pipeline=PIPELINE)
+                SIBLING_FILE = dev.dump_partition('system_a', f'{FOLDER_NAME}/system_a.ext2', pipeline=PIPELINE)
+                dev.dump_partition('system_b', f'{FOLDER_NAME}/system_b.ext2', sibling_file=SIBLING_FILE, pipeline=PIPELINE)
+                dev.dump_partition('data', f'{FOLDER_NAME}/data.ext4', pipeline=PIPELINE)
+                PIPELINE.close()
+            except BaseException:
+                # marks the file it was writing as .partial, and keeps the manifest of the ones which were finished
+                PIPELINE.abort()
+                raise
             print('device dump complete')
     elif args.restore_device:
+        # the preflight started before connecting, see above
         dev = enter_burn_mode(dev)
         reset_recommend = False
         if dev is not None:
             # NOTE: here we do NOT touch bootloader partition
             FOLDER_NAME = args.restore_device[0]
-            rename_parts(FOLDER_NAME)
             print(f'restoring entire device from dumpfiles in {FOLDER_NAME}')
-            FILE_LIST = [
-                'fip_a.dump', 'fip_b.dump', 'logo.dump', 'dtbo_a.dump', 'dtbo_b.dump', 'vbmeta_a.dump',
-                'vbmeta_b.dump', 'boot_a.dump', 'boot_b.dump', 'misc.dump', 'system_a.ext2', 'system_b.ext2',
-            ]
-            for part_name in FILE_LIST:
-                if not os.path.isfile(f'{FOLDER_NAME}/{part_name}'):
-                    print(f'Error: missing expected dump file: {FOLDER_NAME}/{part_name}')
-                    sys.exit(1)
-            # we use the .txt instead of .dump because sometimes the partition size does not line up perfectly
-            #   also probably the safer way to interact with env partition
-            #   if txt version does not exist, we create it for you
-            if not os.path.isfile(f'{FOLDER_NAME}/env.txt'):
-                if not os.path.isfile(f'{FOLDER_NAME}/env.dump'):
-                    print(f'Error: missing expected dump file: {FOLDER_NAME}/env.dump')
-                    sys.exit(1)
-                convert_env_dump(f'{FOLDER_NAME}/env.dump', f'{FOLDER_NAME}/env.txt')
-            dev.send_env_file(f'{FOLDER_NAME}/env.txt')
+            PLAN = PREFLIGHT.result()
+            for message in PLAN['messages']:
+                print(message)
+            dev.send_env_file(PLAN['env_file'])
             dev.bulkcmd('env save')
-            dev.restore_partition('fip_a', f'{FOLDER_NAME}/fip_a.dump')
-            dev.restore_partition('fip_b', f'{FOLDER_NAME}/fip_b.dump')
-            dev.restore_partition('logo', f'{FOLDER_NAME}/logo.dump')
-            dev.restore_partition('dtbo_a', f'{FOLDER_NAME}/dtbo_a.dump')
-            dev.restore_partition('dtbo_b', f'{FOLDER_NAME}/dtbo_b.dump')
-            dev.restore_partition('vbmeta_a', f'{FOLDER_NAME}/vbmeta_a.dump')
-            dev.restore_partition('vbmeta_b', f'{FOLDER_NAME}/vbmeta_b.dump')
-            dev.restore_partition('boot_a', f'{FOLDER_NAME}/boot_a.dump')
-            dev.restore_partition('boot_b', f'{FOLDER_NAME}/boot_b.dump')
-            dev.restore_partition('misc', f'{FOLDER_NAME}/misc.dump')
-            dev.restore_partition('system_a', f'{FOLDER_NAME}/system_a.ext2')
-            dev.restore_partition('system_b', f'{FOLDER_NAME}/system_b.ext2')
-            # handle data and settings partitions last
-            if not os.path.exists(f'{FOLDER_NAME}/data.ext4'):
-                print(f'did not find {FOLDER_NAME}/data.ext4, factory resetting instead')
+            # data and settings are only in the plan if they are not empty, otherwise the device is factory reset instead
+            if PLAN['firstboot'] is not None:
                 try:
                     if args.dont_reset:
                         print("--dont_reset specified. Not erasing data.")
-                        dev.bulkcmd('setenv firstboot 0')
-                        dev.bulkcmd('saveenv')
-                    else:
-                        dev.bulkcmd('setenv firstboot 1')
-                        dev.bulkcmd('saveenv')
+                    dev.bulkcmd(f'setenv firstboot {PLAN["firstboot"]}')
+                    dev.bulkcmd('saveenv')
                 except:
                     print("\nErasing data failed. A factory reset is recommended\n")
                     reset_recommend = True
+
+            RESTORE_BOOTLOADER = PLAN['bootloader'] is not None
+            if args.fastboot:
+                if not dev.restore_partitions_fastboot([(part_name, path) for (part_name, path, _entry) in PLAN['partitions']]):
+                    print('Device did not return to USB Burn Mode after fastboot, skipping bootloader')
+                    RESTORE_BOOTLOADER = False
             else:
-                dev.restore_partition('data', f'{FOLDER_NAME}/data.ext4')
+                for (part_name, path, entry) in PLAN['partitions']:
+                    # with --reuse_slot, the B slot is mostly copied from the A slot that was just written
+                    dev.restore_partition(part_name, path, sibling_part=sibling_partition(part_name) if args.reuse_slot else None, entry=entry)
 
-            if not os.path.exists(f'{FOLDER_NAME}/settings.ext4'):
-                print(f'did not find {FOLDER_NAME}/settings.ext4, erasing settings partition instead')
+            # always do bootloader last
+            if RESTORE_BOOTLOADER:
+                try:
+                    dev.restore_partition('bootloader', PLAN['bootloader'])
+                except:
+                    print("Flashing bootloader failed. If you encounter any issues, try flashing again.")
+            print('Device restore complete. Replug your Car Thing to start using it.')
+            if reset_recommend:
+                print("\n\nFactory reseting your Car Thing is recommended. You can do this by unplugging your device then replugging it while holding the preset 2 and back buttons. You can let go of the buttons when the Spotify logo appears.")
+    elif args.flash_bundle:
+        dev = enter_burn_mode(dev)
+        if dev is not None:
+            BUNDLE_NAME = args.flash_bundle[0]
+            from superbird_bundle import flash_bundle
+            print(f'flashing entire device from bundle {BUNDLE_NAME}')
+            flash_bundle(dev, BUNDLE_NAME)
+            print('Device restore complete. Replug your Car Thing to start using it.')
+    elif args.dump_image:
+        dev = enter_burn_mode(dev)
+        if dev is not None:
+            IMAGE_FILE = args.dump_image[0]
+            print(f'dumping entire device to raw image {IMAGE_FILE}')
+            dev.dump_image(IMAGE_FILE)
+            print('device dump complete')
+    elif args.restore_image:
+        dev = enter_burn_mode(dev)
+        reset_recommend = False
+        if dev is not None:
+            IMAGE_FILE = args.restore_image[0]
+            if not os.path.isfile(IMAGE_FILE):
+                print(f'Error: missing image file: {IMAGE_FILE}')
+                sys.exit(1)
+            print(f'restoring entire device from raw image {IMAGE_FILE}')
+            # before env is touched, so an image from a unit with a different data partition size changes nothing
+            dev.check_image(IMAGE_FILE)
+            # env is imported as text, same as --restore_device
+            dev.bulkcmd('amlmmc env')
+            dev.send_env(image_env_text(IMAGE_FILE))
+            dev.bulkcmd('env save')
+            # data and settings which were erased when dumped are not written, we factory reset instead
+            EMPTY_PARTS = [part_name for part_name in ['data', 'settings'] if image_region_is_empty(IMAGE_FILE, part_name)]
+            dev.restore_image(IMAGE_FILE, skip_partitions=EMPTY_PARTS)
+            if EMPTY_PARTS:
+                print(f'image has empty {", ".join(EMPTY_PARTS)}, factory resetting instead')
                 try:
                     if args.dont_reset:
-                        print("--dont_reset specified. Not erasing settings.")
+                        print("--dont_reset specified. Not erasing data.")
                         dev.bulkcmd('setenv firstboot 0')
                         dev.bulkcmd('saveenv')
                     else:
@@ -410,14 +693,6 @@ Advanced:
                 except:
                     print("\nErasing data failed. A factory reset is recommended\n")
                     reset_recommend = True
-            else:
-                dev.restore_partition('settings', f'{FOLDER_NAME}/settings.ext4')
-
-            # always do bootloader last
-            try:
-                dev.restore_partition('bootloader', f'{FOLDER_NAME}/bootloader.dump')
-            except:
-                print("Flashing bootloader failed. If you encounter any issues, try flashing again.")
             print('Device restore complete. Replug your Car Thing to start using it.')
             if reset_recommend:
                 print("\n\nFactory reseting your Car Thing is recommended. You can do this by unplugging your device then replugging it while holding the preset 2 and back buttons. You can let go of the buttons when the Spotify logo appears.")
@@ -444,10 +719,9 @@ Advanced:
             print("Device already in USB Burn Mode")
         elif check_device_mode('usb'):
             print('Entering USB Burn Mode')
-            dev.bl2_boot(str(IMAGES_PATH.joinpath('superbird.bl2.encrypted.bin')), str(IMAGES_PATH.joinpath('superbird.bootloader.img')))
+            dev.bl2_boot()
             print('Waiting for device...')
-            time.sleep(5)  # wait for it to boot up in USB Burn Mode
-            if check_device_mode('usb-burn'):
+            if wait_for_device_mode('usb-burn', BURN_MODE_TIMEOUT):
                 print('Device is now in USB Burn Mode')
             else:
                 print('Failed to enter USB Burn Mode!')
@@ -459,45 +733,36 @@ Advanced:
         ENV_FILE = 'stock_env.txt'
         dev = enter_burn_mode(dev)
         if dev is not None:
-            print('Restoring env by first wiping env, then importing stock_env.txt')
-            dev.bulkcmd('amlmmc env')
-            time.sleep(1)
-            dev.bulkcmd('amlmmc erase env')
-            time.sleep(1)
-            dev.send_env_file(ENV_FILE)
-            dev.bulkcmd('env save')
+            print('Restoring env to the default values from stock_env.txt')
+            print_env_sync(dev.sync_env(load_env(ENV_FILE), full=True))
     elif args.send_env:
         ENV_FILE = args.send_env[0]
         dev = enter_burn_mode(dev)
         if dev is not None:
-            # Do not wipe env partition first, just import values from given file
+            # Do not remove anything from env, just import values from given file
             print(f'Importing the contents of {ENV_FILE}')
-            dev.bulkcmd('amlmmc env')
-            dev.send_env_file(ENV_FILE)
-            dev.bulkcmd('env save')
+            print_env_sync(dev.sync_env(load_env(ENV_FILE)))
     elif args.send_full_env:
         ENV_FILE = args.send_full_env[0]
         dev = enter_burn_mode(dev)
         if dev is not None:
-            # wipe the env partition, then import from given file
-            print('Wiping env partition')
-            dev.bulkcmd('amlmmc env')
-            time.sleep(1)
-            dev.bulkcmd('amlmmc erase env')
-            time.sleep(1)
-            print(f'Importing the contents of {ENV_FILE}')
-            dev.send_env_file(ENV_FILE)
-            dev.bulkcmd('env save')
+            # make env match given file exactly, removing any values not in it
+            print(f'Replacing env with the contents of {ENV_FILE}')
+            print_env_sync(dev.sync_env(load_env(ENV_FILE), full=True))
     elif args.get_env:
         ENV_FILE = args.get_env[0]
         dev = enter_burn_mode(dev)
         if dev is not None:
-            with tempfile.NamedTemporaryFile() as TEMP_FILE:
-                print(f'Getting current env and writing to text file: {ENV_FILE}')
-                dev.bulkcmd("amlmmc env")
-                dev.dump_partition('env', TEMP_FILE.name)
-                convert_env_dump(TEMP_FILE.name, ENV_FILE)
+            print(f'Getting current env and writing to text file: {ENV_FILE}')
+            dev.bulkcmd("amlmmc env")
+            # only the used part of env gets read, not the whole 8MB partition
+            (ENVIRON, _length, CRC_OK) = parse_environ(dev.read_env())
+            if not CRC_OK:
+                print('Warning: env crc does not match, u-boot is using its default env instead of this one')
+            with open(ENV_FILE, 'w', encoding='utf-8') as oef:
+                oef.write(format_env_text(ENVIRON))
 
+    PROGRESS.close()
     END_TIME = time.time()
     TIME_DELTA = END_TIME - START_TIME
     print(f'Operation took: {str(TIME_DELTA)}')
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""
+Transports for talking to the device in USB Mode and USB Burn Mode
+
+SuperbirdDevice does all of its device I/O through a Transport: bulkcmd, memory reads and writes, and the AMLC exchange with bl2.
+PyamlbootTransport works everywhere, but reads memory 64 bytes at a time.
+LargeReadTransport reads memory in large blocks, using the bulk upload request of the burning protocol (the one used by update mread),
+and is picked by select_transport if the device answers it correctly.
+"""
+# pylint: disable=line-too-long,broad-except
+
+from abc import ABC, abstractmethod
+
+SIMPLE_READ_SIZE = 64  # bytes, largest readSimpleMemory
+LARGE_READ_SIZE = 64 * 1024  # bytes, read per readLargeMemory
+PROBE_SIZE = 4096  # bytes, compared between both read methods by select_transport
+
+
+class Transport(ABC):
+    """ interface for device I/O
+            name is shown to the user
+            read_chunk_size is how much SuperbirdDevice should read from mmc at a time, to make good use of this transport
+    """
+    name = 'none'
+    read_chunk_size = 128 * 512
+
+    @abstractmethod
+    def bulk_cmd(self, command:str) -> str:
+        """ run a u-boot command, returns the response (success or failed) """
+        raise NotImplementedError
+
+    @abstractmethod
+    def read_memory(self, address:int, length:int) -> bytes:
+        """ read length bytes from device memory """
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_memory(self, address:int, data, block_length:int, append_zeros:bool=True):
+        """ write data to device memory, in blocks of block_length, zero-padding the last one if append_zeros
+                data can be anything with the buffer protocol, like a memoryview of a memory-mapped file, and is not copied
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def get_boot_amlc(self):
+        """ get the next request from bl2, returns a tuple of: length, offset """
+        raise NotImplementedError
+
+    @abstractmethod
+    def write_amlc_data(self, seq:int, offset:int, data):
+        """ answer a request from bl2 """
+        raise NotImplementedError
+
+    @abstractmethod
+    def run(self, address:int):
+        """ jump to code at address """
+        raise NotImplementedError
+
+
+class PyamlbootTransport(Transport):
+    """ device I/O using pyamlboot AmlogicSoC, memory is read 64 bytes at a time """
+    name = 'pyamlboot'
+
+    def __init__(self, device):
+        self.device = device
+
+    def bulk_cmd(self, command:str) -> str:
+        return self.device.bulkCmd(command).tobytes().decode('utf-8')
+
+    def read_memory(self, address:int, length:int) -> bytes:
+        # accumulate into a bytearray, concatenating bytes gets quadratically slower with larger chunks
+        data = bytearray()
+        offset = 0
+        while offset < length:
+            read_length = min(SIMPLE_READ_SIZE, length - offset)
+            data += self.device.readSimpleMemory(address + offset, read_length).tobytes()
+            offset += read_length
+        return bytes(data)
+
+    def write_memory(self, address:int, data, block_length:int, append_zeros:bool=True):
+        # pyamlboot pads with data += zeros, which copies all of data (and fails on a memoryview),
+        #   so whole blocks are sent straight from data, and only a partial last block is copied to pad it
+        view = memoryview(data).cast('B')
+        whole = len(view) - len(view) % block_length
+        if whole:
+            self.device.writeLargeMemory(address, view[:whole], block_length, appendZeros=False)
+        if whole < len(view):
+            if not append_zeros:
+                raise ValueError(f'Data must be a multiple of block length: {len(view)} vs {block_length}')
+            self.device.writeLargeMemory(address + whole, bytes(view[whole:]) + bytes(block_length - (len(view) - whole)), block_length, appendZeros=False)
+
+    def get_boot_amlc(self):
+        return self.device.getBootAMLC()
+
+    def write_amlc_data(self, seq:int, offset:int, data):
+        self.device.writeAMLCData(seq, offset, data)
+
+    def run(self, address:int):
+        self.device.run(address)
+
+
+class LargeReadTransport(PyamlbootTransport):
+    """ device I/O using pyamlboot AmlogicSoC, memory is read in large bulk transfers (readLargeMemory) """
+    name = 'pyamlboot large reads'
+    read_chunk_size = 2048 * 512
+
+    def read_memory(self, address:int, length:int) -> bytes:
+        data = bytearray()
+        offset = 0
+        while offset < length:
+            read_length = min(LARGE_READ_SIZE, length - offset)
+            block = self.device.readLargeMemory(address + offset, read_length)
+            data += block.tobytes() if hasattr(block, 'tobytes') else bytes(block)
+            offset += read_length
+        if len(data) != length:
+            raise ValueError(f'readLargeMemory returned {len(data)} bytes instead of {length}')
+        return bytes(data)
+
+
+def select_transport(device, probe_address:int) -> Transport:
+    """ pick the fastest transport that works with this device
+            large reads are checked against simple reads of the same memory, at probe_address, which must not change in between
+    """
+    simple = PyamlbootTransport(device)
+    if not hasattr(device, 'readLargeMemory'):
+        return simple
+    large = LargeReadTransport(device)
+    try:
+        if large.read_memory(probe_address, PROBE_SIZE) == simple.read_memory(probe_address, PROBE_SIZE):
+            return large
+    except Exception:
+        pass  # not supported by this pyamlboot or bootloader
+    return simple
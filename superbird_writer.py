@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+"""
+Background writer for partition dumps
+
+The transfer loop only moves bytes from the device, and hands each chunk to a bounded queue.
+A writer thread takes care of file I/O, hashing, optional compression, and post-processing,
+so that slow storage (like a network mount) does not stall the USB transfer.
+"""
+# pylint: disable=line-too-long,broad-except
+
+import os
+import gzip
+import queue
+import struct
+import shutil
+import hashlib
+import binascii
+import tempfile
+import threading
+import contextlib
+
+from superbird_manifest import MANIFEST_CHUNK_SIZE, update_manifest
+
+
+def open_dump(path:str):
+    """ open a dump file for reading, decompressing it if it ends in .gz (see DumpPipeline.open) """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def dump_size(path:str) -> int:
+    """ size of the data in a dump file, for a .gz this is the uncompressed size
+            which comes from the gzip trailer, holding it modulo 4GB, but every partition is smaller than that
+    """
+    if not path.endswith('.gz'):
+        return os.path.getsize(path)
+    with open(path, 'rb') as dmf:
+        dmf.seek(-4, os.SEEK_END)
+        (size,) = struct.unpack('<I', dmf.read(4))
+    return size
+
+
+@contextlib.contextmanager
+def decompressed(path:str):
+    """ path of an uncompressed dump file, for code which memory-maps it
+            a .gz is decompressed into a temporary file, which is removed afterwards, anything else is used as it is
+    """
+    if not path.endswith('.gz'):
+        yield path
+        return
+    (handle, tmp_path) = tempfile.mkstemp(prefix='superbird-', suffix=os.path.basename(path)[:-3])
+    try:
+        with os.fdopen(handle, 'wb') as tmf, gzip.open(path, 'rb') as dmf:
+            shutil.copyfileobj(dmf, tmf, 1024 * 1024)
+        yield tmp_path
+    finally:
+        os.remove(tmp_path)
+
+
+def copy_file_chunk(src, dst, offset:int, length:int, data:bytes):
+    """ copy a chunk from one open file to the same offset in another, and leave dst positioned after it
+            uses copy_file_range where available, which lets filesystems like btrfs and xfs share (reflink) the blocks,
+            otherwise falls back to writing data, which must already hold the chunk
+    """
+    copied = 0
+    if hasattr(os, 'copy_file_range'):
+        try:
+            while copied < length:
+                count = os.copy_file_range(src.fileno(), dst.fileno(), length - copied, offset + copied, offset + copied)
+                if count == 0:
+                    break
+                copied += count
+        except OSError:
+            pass
+    dst.seek(offset + copied)
+    if copied < length:
+        dst.write(data[copied:])
+
+
+class FileHashes:
+    """ incremental sha256 and crc32 of a file, plus crc32 of every chunk_size chunk """
+    def __init__(self, chunk_size:int=MANIFEST_CHUNK_SIZE):
+        self.chunk_size = chunk_size
+        self.sha256 = hashlib.sha256()
+        self.crc32 = 0
+        self.size = 0
+        self.empty = True  # stays True as long as everything seen is zeros
+        self.chunk_crc32 = []
+        self._chunk_crc = 0
+        self._chunk_fill = 0
+
+    def update(self, data:bytes):
+        """ hash the next piece of the file, data can be bytes or a memoryview """
+        self.sha256.update(data)
+        self.crc32 = binascii.crc32(data, self.crc32)
+        self.size += len(data)
+        # works for a memoryview too, which has no count()
+        if self.empty and data != bytes(len(data)):
+            self.empty = False
+        view = memoryview(data)
+        while view:
+            take = min(len(view), self.chunk_size - self._chunk_fill)
+            self._chunk_crc = binascii.crc32(view[:take], self._chunk_crc)
+            self._chunk_fill += take
+            if self._chunk_fill == self.chunk_size:
+                self.chunk_crc32.append(self._chunk_crc)
+                self._chunk_crc = 0
+                self._chunk_fill = 0
+            view = view[take:]
+
+    def entry(self) -> dict:
+        """ finish hashing, and return a manifest entry """
+        if self._chunk_fill:
+            self.chunk_crc32.append(self._chunk_crc)
+            self._chunk_crc = 0
+            self._chunk_fill = 0
+        return {
+            'size': self.size,
+            'sha256': self.sha256.hexdigest(),
+            'crc32': f'{self.crc32:08x}',
+            'chunk_crc32': [f'{crc:08x}' for crc in self.chunk_crc32],
+            'empty': self.empty,
+        }
+
+
+class DumpPipeline:
+    """ Write dump files from a background thread
+            open(), write(), copy() and close_file() only queue work, and return immediately (unless the queue is full)
+            manifest entries are collected for every file, and written to manifest_folder (if given) by close()
+            errors from the writer thread are raised on the next call from the transfer loop, and by close()
+            a file which was not finished (the writer failed, or abort() was called) is renamed to .partial
+    """
+    QUEUE_DEPTH = 32  # chunks, bounded so a stalled disk eventually applies backpressure
+
+    def __init__(self, manifest_folder:str=None, compress:bool=False):
+        self.manifest_folder = manifest_folder
+        self.compress = compress
+        self.entries = {}
+        self.error = None
+        self._queue = queue.Queue(maxsize=self.QUEUE_DEPTH)
+        self._file = None
+        self._path = None
+        self._hashes = None
+        self._post_process = None
+        self._sources = {}
+        self._thread = threading.Thread(target=self._run, name='dump-writer', daemon=True)
+        self._thread.start()
+
+    def _put(self, item):
+        if self.error is not None:
+            raise self.error
+        self._queue.put(item)
+
+    def open(self, outfile:str, compress:bool=None, post_process=None) -> str:
+        """ start writing a new file, returns the actual path (with .gz added if compressed)
+                post_process is called with the path, from the writer thread, once the file is complete
+        """
+        if compress is None:
+            compress = self.compress
+        if compress:
+            outfile = f'{outfile}.gz'
+        self._put(('open', outfile, compress, post_process))
+        return outfile
+
+    def write(self, data:bytes):
+        """ append data to the current file """
+        self._put(('data', data))
+
+    def copy(self, src_path:str, offset:int, data:bytes):
+        """ append data to the current file, which is also the chunk at the same offset within src_path
+                if both files are uncompressed, the chunk is copied from src_path (letting the filesystem reflink it)
+        """
+        self._put(('copy', src_path, offset, data))
+
+    def close_file(self):
+        """ finish the current file """
+        self._put(('close',))
+
+    def flush(self):
+        """ wait for everything queued so far to be written """
+        self._queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """ wait for everything to be written, stop the writer thread, and write the manifest
+                if the writer failed, this raises its error, after the manifest is written for the files which were finished
+        """
+        self._stop()
+        if self.error is not None:
+            raise self.error
+        return self.entries
+
+    def abort(self):
+        """ stop the writer thread after a failed transfer, without raising
+                whatever was queued is still written, but the file being written is not finished, so it becomes .partial
+        """
+        try:
+            self._stop()
+        except Exception:
+            pass
+
+    def _stop(self):
+        if self._thread.is_alive():
+            # not _put(), the writer keeps draining the queue after an error, and only stops once it sees this
+            self._queue.put(None)
+            self._thread.join()
+        if self.manifest_folder is not None and self.entries:
+            update_manifest(self.manifest_folder, self.entries)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    break
+                if self.error is None:
+                    self._handle(item)
+            except Exception as ex:
+                # keep draining the queue so the transfer loop does not block, it will see the error
+                self.error = ex
+            finally:
+                self._queue.task_done()
+        self._cleanup()
+
+    def _handle(self, item):
+        operation = item[0]
+        if operation == 'open':
+            (_op, path, compress, post_process) = item
+            self._path = path
+            self._post_process = post_process
+            self._hashes = FileHashes()
+            if compress:
+                self._file = gzip.open(path, 'wb', compresslevel=1)
+            else:
+                self._file = open(path, 'wb')
+        elif operation == 'data':
+            self._hashes.update(item[1])
+            self._file.write(item[1])
+        elif operation == 'copy':
+            (_op, src_path, offset, data) = item
+            self._hashes.update(data)
+            if isinstance(self._file, gzip.GzipFile) or src_path.endswith('.gz'):
+                self._file.write(data)
+            else:
+                if src_path not in self._sources:
+                    self._sources[src_path] = open(src_path, 'rb')
+                self._file.flush()
+                copy_file_chunk(self._sources[src_path], self._file, offset, len(data), data)
+        elif operation == 'close':
+            self._file.close()
+            self._file = None
+            entry = self._hashes.entry()
+            entry['compressed'] = self._path.endswith('.gz')
+            self.entries[os.path.basename(self._path)] = entry
+            if self._post_process is not None:
+                self._post_process(self._path)
+
+    def _cleanup(self):
+        if self._file is not None:
+            # still open, so it was never finished, keep it from being mistaken for a complete dump
+            try:
+                self._file.close()
+            except Exception:
+                pass
+            self._file = None
+            if os.path.exists(self._path):
+                os.replace(self._path, f'{self._path}.partial')
+        for src in self._sources.values():
+            src.close()
+        self._sources = {}
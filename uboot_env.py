@@ -50,24 +50,138 @@ https://chromium.googlesource.com/chromiumos/platform/uboot-env
 #   to bring it to python3, and satisfy my linter
 #   and removed anything I was not going to use
 
-import binascii
+# later extended into a small env engine:
+#   lazy parsing (over mmap) which stops at the terminator, crc checking against ENV_SIZE,
+#   building a binary env image from a dict, and diffing two envs
+
+import mmap
 import struct
+import binascii
+
+# size of the env area at the start of the env partition, CONFIG_ENV_SIZE in u-boot
+#   the crc covers everything after itself, up to ENV_SIZE
+ENV_SIZE = 64 * 1024
+ENV_HEADER_SIZE = 4  # crc32
+ENV_ENCODING = 'latin-1'  # maps every byte to a character and back, so nothing is lost
+
+
+class EnvCrcError(ValueError):
+    """ env crc does not match its contents """
+
+
+def iter_environ(data, start:int=ENV_HEADER_SIZE):
+    """ lazily yield (key, value) pairs from raw env data (bytes or mmap), stopping at the empty string terminator
+            segments without '=' are skipped, they only show up in a corrupt env, which the crc check reports
+    """
+    pos = start
+    end = len(data)
+    while pos < end:
+        nul = data.find(b'\x00', pos)
+        if nul == -1:
+            nul = end
+        if nul == pos:
+            break
+        segment = data[pos:nul].decode(ENV_ENCODING)
+        if '=' in segment:
+            key, value = segment.split('=', 1)
+            yield (key, value)
+        pos = nul + 1
+
+
+def environ_used_length(data, start:int=ENV_HEADER_SIZE):
+    """ length of the used part of raw env data: header, then all variables, up to and including the \\0\\0 terminator
+        returns None if no terminator was found in data
+    """
+    if len(data) > start and data[start:start + 1] == b'\x00':
+        # empty env, the terminator is just one \0
+        return start + 1
+    end = data.find(b'\x00\x00', start)
+    if end == -1:
+        return None
+    return end + 2
+
+
+def environ_crc(data, env_size:int=ENV_SIZE):
+    """ calculate crc of raw env data, as u-boot would over env_size
+            if data is shorter than env_size, the rest is treated as zeros, which is how u-boot saves it
+    """
+    body = data[ENV_HEADER_SIZE:env_size]
+    crc = binascii.crc32(body)
+    padding = env_size - ENV_HEADER_SIZE - len(body)
+    if padding > 0:
+        crc = binascii.crc32(bytes(padding), crc)
+    return crc & 0xffffffff
 
 
-def read_environ(file):
+def parse_environ(data, env_size:int=ENV_SIZE, strict:bool=False):
+    """ Parse u-boot environment variables from the raw contents of an env partition, or the used part of it
+        returns a tuple containing: env as a dict, length of data, wether crc match
+        if strict, raises EnvCrcError instead of returning a bad env
+    """
+    (crc,) = struct.unpack("<I", data[0:ENV_HEADER_SIZE])
+    crc_ok = crc == environ_crc(data, env_size)
+    if strict and not crc_ok:
+        raise EnvCrcError(f'env crc mismatch: stored {crc:08x}, calculated {environ_crc(data, env_size):08x}')
+    environ = dict(iter_environ(data))
+    return (environ, len(data), crc_ok)
+
+
+def read_environ(file, env_size:int=ENV_SIZE, strict:bool=False):
     """ Reads the u-boot environment variables from a partition dump file.
+        the file is memory-mapped, and only read up to the terminator (and env_size for the crc)
         returns a tuple containing: env as a dict, length of data in file, wether crc match
     """
-    data = None
     with open(file, "rb") as evf:
-        data = evf.read()
-    (crc,) = struct.unpack("I", data[0:4])
-    real_data = data[4:]
-    real_crc = binascii.crc32(real_data) & 0xffffffff
+        with mmap.mmap(evf.fileno(), 0, access=mmap.ACCESS_READ) as evm:
+            (environ, _length, crc_ok) = parse_environ(evm, env_size, strict)
+            return (environ, len(evm), crc_ok)
+
+
+def build_environ(environ:dict, env_size:int=ENV_SIZE):
+    """ Build a binary env image of env_size from a dict, with correct crc
+        variables are sorted by name, same as u-boot env export
+        returns a tuple containing: the image, and length of the used part (see environ_used_length)
+    """
+    body = b''.join(f'{key}={value}\x00'.encode(ENV_ENCODING) for key, value in sorted(environ.items())) + b'\x00'
+    if len(body) > env_size - ENV_HEADER_SIZE:
+        raise ValueError(f'env is too large: {len(body)} bytes, only {env_size - ENV_HEADER_SIZE} available')
+    body = body.ljust(env_size - ENV_HEADER_SIZE, b'\x00')
+    used = ENV_HEADER_SIZE + len(body.rstrip(b'\x00')) + 2
+    if not environ:
+        used = ENV_HEADER_SIZE + 1
+    image = struct.pack("<I", binascii.crc32(body) & 0xffffffff) + body
+    return (image, used)
+
+
+def write_environ(file, environ:dict, env_size:int=ENV_SIZE):
+    """ write a binary env image of env_size to a file, returns length of the used part """
+    (image, used) = build_environ(environ, env_size)
+    with open(file, "wb") as evf:
+        evf.write(image)
+    return used
+
+
+def diff_environ(old:dict, new:dict):
+    """ compare two envs
+        returns a tuple containing: added (dict), changed (dict of new values), removed (list of names)
+    """
+    added = {key: value for key, value in new.items() if key not in old}
+    changed = {key: value for key, value in new.items() if key in old and old[key] != value}
+    removed = [key for key in old if key not in new]
+    return (added, changed, removed)
+
+
+def parse_env_text(text:str):
+    """ parse env.txt format: one key=value per line """
     environ = {}
-    for segment in real_data.decode('ascii').split("\x00"):
-        if not segment:
-            break
-        key, value = segment.split('=', 1)
+    for line in text.splitlines():
+        if '=' not in line:
+            continue
+        key, value = line.split('=', 1)
         environ[key] = value
-    return (environ, len(data), crc == real_crc)
+    return environ
+
+
+def format_env_text(environ:dict):
+    """ format an env as env.txt: one key=value per line """
+    return ''.join(f'{key}={value}\n' for key, value in environ.items())